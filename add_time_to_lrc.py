@@ -1,38 +1,173 @@
 import argparse
 import os
 import re
+import time
+
+'''
+Spreads timestamps evenly over the lines of an LRC file.
+
+    python add_time_to_lrc.py -f song.lrc -t 240
+        one file, the song is 240 seconds long.
+
+    python add_time_to_lrc.py -d /music -j 4
+        every .lrc under the folder that has a music file with the same name,
+        the length comes from the header of that music file.
+
+The original file is kept as .lrc.bak, an existing .bak is never replaced.
+ID tags like [ti:...] or [offset:...] are kept as they are. In --dir mode an
+LRC file that already has a timestamp on every lyric line is left alone
+unless --force is given, so downloaded synced lyrics are not lost.
+'''
+
+# music files an .lrc can belong to, the same surfixes music_tag_loader.py reads.
+AUDIO_SURFIXES = ['flac', 'ape', 'mp3', 'wav', 'dff', 'dsf', 'mp4', 'm4a']
+TIMESTAMP = re.compile(r'\[.*?\]')
+TIMED_LINE = re.compile(r'\[\d+:\d+(\.\d+)?\]')
+# [ti:title], [ar:artist], [offset:+100] ... kept as they are.
+ID_TAG = re.compile(r'^\[[a-z]+:.*\]$', re.IGNORECASE)
+
+
+def retime_lines(lines, length):
+    lyric_count = len([line for line in lines if not ID_TAG.match(line.strip())])
+    avg_interval = length/(lyric_count+2)
+    timing = 0
+    for line in lines:
+        if ID_TAG.match(line.strip()):
+            yield line.rstrip('\r\n') + '\n'
+            continue
+        line = TIMESTAMP.sub('', line)
+        line = line.strip()
+        minutes = int(timing / 60)
+        seconds = int(timing % 60)
+        yield f'[{minutes:02d}:{seconds:02d}.00]{line}\n'
+        timing += avg_interval
+
+
+def write_lines(filename, lines, encoding=None):
+    # the new file replaces the old one. The first original is kept as .bak,
+    # a later run never overwrites it.
+    newfilename = os.path.join(os.path.dirname(filename), 'new_'+os.path.basename(filename))
+    with open(newfilename, 'w', encoding=encoding) as OUT:
+        OUT.writelines(lines)
+
+    if not os.path.exists(filename+'.bak'):
+        os.replace(filename, filename+'.bak')
+    os.replace(newfilename, filename)
 
 
 def append_timestamp(filename: str, length: int):
     with open(filename, 'r') as IN:
-        lines = [1 for line in IN]
-        linecount = len(lines)
-        avg_interval = length/(linecount+2)
+        lines = IN.readlines()
+    write_lines(filename, retime_lines(lines, length))
 
-    newfilename = 'new_'+filename
-    with open(filename, 'r') as IN:
-        with open(newfilename, 'w') as OUT:
-            timing = 0
-            for line in IN:
-                line = re.sub(r'\[.*?\]', '', line)
-                line = line.strip()
-                minutes = int(timing / 60)
-                seconds = int(timing % 60)
-                newline = f'[{minutes:02d}:{seconds:02d}.00]{line}'
-                timing += avg_interval
-                OUT.writelines(newline+'\n')
 
-    os.rename(filename, filename+'.bak')
-    os.rename(newfilename, filename)
+def stem_key(filename):
+    # remove_lyric_name_space.py renames '01 - song.lrc' to '01-song.lrc', pair them anyway.
+    return os.path.splitext(filename)[0].replace(' - ', '-').lower()
+
+
+def lrc_pairs(baseroot):
+    # yields (lrc path, music path or None, music surfix)
+    for (root, dirs, files) in os.walk(baseroot):
+        dirs.sort()
+        music_files = {}
+        for filename in sorted(files):
+            surfix = filename.split('.')[-1].lower()
+            if surfix in AUDIO_SURFIXES:
+                music_files.setdefault(stem_key(filename), (filename, surfix))
+        for filename in sorted(files):
+            if not filename.lower().endswith('.lrc'):
+                continue
+            (music, surfix) = music_files.get(stem_key(filename), (None, None))
+            yield (os.path.join(root, filename), os.path.join(root, music) if music else None, surfix)
+
+
+def retime_file(task):
+    # runs in the pool: returns (lrc path, status, seconds, line count)
+    (lrcfile, musicfile, surfix, force, act) = task
+    from cue_sheet import decode_bytes, CueParseError
+    from fast_tags import FastPathUnsupported, read_length
+
+    try:
+        with open(lrcfile, 'rb') as IN:
+            data = IN.read()
+        (text, encoding) = decode_bytes(data)
+    except (OSError, CueParseError) as e:
+        return (lrcfile, f'unreadable: {e}', 0, 0)
+    if encoding == 'utf-8-sig' and not data.startswith(b'\xef\xbb\xbf'):
+        encoding = 'utf8'
+    lines = text.splitlines()
+    if len(lines) == 0:
+        return (lrcfile, 'empty', 0, 0)
+    if not force and all(TIMED_LINE.match(line) for line in lines if line.strip() and not ID_TAG.match(line.strip())):
+        return (lrcfile, 'timed', 0, len(lines))
+    try:
+        length = read_length(musicfile, surfix)
+    except (OSError, FastPathUnsupported) as e:
+        return (lrcfile, f'no length: {e}', 0, len(lines))
+    except Exception as e:
+        from mutagen import MutagenError
+        if not isinstance(e, MutagenError):
+            raise
+        return (lrcfile, f'no length: {e}', 0, len(lines))
+    if act:
+        write_lines(lrcfile, retime_lines(lines, length), encoding)
+    return (lrcfile, 'retimed', length, len(lines))
+
+
+def retime_folder(baseroot, jobs=1, force=False, act=True):
+    started = time.perf_counter()
+    counts = {'retimed': 0, 'timed': 0, 'no music': 0, 'failed': 0}
+    tasks = []
+    for (lrcfile, musicfile, surfix) in lrc_pairs(baseroot):
+        if musicfile is None:
+            print(f'NO MUSIC {lrcfile}')
+            counts['no music'] += 1
+            continue
+        tasks.append((lrcfile, musicfile, surfix, force, act))
+
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(retime_file, tasks, chunksize=16))
+    else:
+        results = [retime_file(task) for task in tasks]
+
+    for (lrcfile, status, length, line_count) in results:
+        if status == 'retimed':
+            counts['retimed'] += 1
+            print(f'RETIMED  {lrcfile}: {line_count} lines over {int(length // 60)}:{int(length % 60):02d}')
+        elif status == 'timed':
+            counts['timed'] += 1
+        else:
+            counts['failed'] += 1
+            print(f'FAILED   {lrcfile}: {status}')
+    print(f"{counts['retimed']} LRC files {'retimed' if act else 'to retime'}, "
+          f"{counts['timed']} already timed, {counts['no music']} without music file, "
+          f"{counts['failed']} failed in {time.perf_counter() - started:.2f}s.")
+    return counts
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("-f", "--file", type=str, required=True,
+    parser.add_argument("-f", "--file", type=str, required=False,
                         help="lrc file name to append timestamp")
     parser.add_argument("-t", "--time", type=int, required=False,
                         default=240,
                         help="total length of the song in seconds. Default to 240.")
+    parser.add_argument("-d", "--dir", type=str, required=False,
+                        help="folder to retime every .lrc file recursively, with the length of its music file")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes for --dir. Default to 1.")
+    parser.add_argument("--force", default=False, action='store_true',
+                        help="whether --dir also retimes files that already have timestamps")
+    parser.add_argument("--dry-run", default=False, action='store_true',
+                        help="whether --dir only prints what it would change")
     args = parser.parse_args()
-    append_timestamp(args.file, args.time)
+    if args.dir is not None:
+        retime_folder(args.dir, args.jobs, args.force, not args.dry_run)
+    elif args.file is not None:
+        append_timestamp(args.file, args.time)
+    else:
+        parser.error('give --file or --dir')
@@ -0,0 +1,301 @@
+import os
+import time
+import struct
+import hashlib
+import argparse
+import logging
+
+from bounded_pool import bounded_map
+
+logger = logging.getLogger('tag_loader')
+
+'''
+Content hashes of the audio in music files, kept in the audio_hashes table
+of the library DB.
+
+Only the audio payload is hashed, never the tags, so re-tagging a file does
+not change its hash while two copies of the same rip with different tags
+get the same one:
+
+    flac  everything after the metadata blocks
+    mp3   everything between the ID3v2 tag and the APEv2/ID3v1 tags at the end
+    ape   the same as mp3
+    wav   the payload of the data chunk
+    dsf   the payload of the data chunk
+    dff   the payload of the DSD (or DST) chunk
+    mp4   the payload of the mdat atoms
+
+A file whose size and mtime match its row is not read again. --verify reads
+every file and reports the ones whose audio changed while size and mtime did
+not, a sign of silent corruption.
+
+    python audio_hash.py -d /music -s library.db -j 4 [--verify]
+'''
+
+AUDIO_HASHES_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS audio_hashes (
+    path TEXT PRIMARY KEY,
+    albumid INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    payload_offset INTEGER,
+    payload_size INTEGER,
+    hash TEXT,
+    hashed_at REAL
+)
+'''
+
+AUDIO_HASH_INSERT = ("INSERT OR REPLACE INTO audio_hashes(path, albumid, size, mtime_ns, payload_offset, payload_size, "
+                     "hash, hashed_at) VALUES (?,?,?,?,?,?,?,?)")
+
+HASH_SURFIXES = {'flac', 'ape', 'mp3', 'wav', 'dff', 'dsf', 'mp4', 'm4a'}
+BLOCK_SIZE = 1024 * 1024
+
+
+class PayloadNotFound(Exception):
+    pass
+
+
+def _read_exact(f, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise PayloadNotFound('truncated file')
+    return data
+
+
+def _trailing_tags(f, start, end):
+    # end of the audio before an APEv2 and/or ID3v1 tag at the end of the file.
+    if end - start >= 128 and _read_exact(f, end - 128, 3) == b'TAG':
+        end -= 128
+    if end - start >= 32:
+        footer = _read_exact(f, end - 32, 32)
+        if footer[:8] == b'APETAGEX':
+            (version, size, count, flags) = struct.unpack('<IIII', footer[8:24])
+            # size counts the footer, not the optional 32 byte header.
+            end -= size + (32 if flags & 0x80000000 else 0)
+    return end
+
+
+def flac_payload(f, file_size):
+    if _read_exact(f, 0, 4) != b'fLaC':
+        raise PayloadNotFound('no fLaC header')
+    offset = 4
+    last_block = False
+    while not last_block:
+        header = _read_exact(f, offset, 4)
+        last_block = bool(header[0] & 0x80)
+        offset += 4 + int.from_bytes(header[1:4], 'big')
+    return offset, _trailing_tags(f, offset, file_size)
+
+
+def id3_payload(f, file_size):
+    offset = 0
+    header = _read_exact(f, 0, 10) if file_size >= 10 else b''
+    if header[:3] == b'ID3':
+        size = 0
+        for b in header[6:10]:
+            size = (size << 7) | (b & 0x7F)
+        # flag 0x10: a 10 byte footer follows the tag.
+        offset = 10 + size + (10 if header[5] & 0x10 else 0)
+    return offset, _trailing_tags(f, offset, file_size)
+
+
+def riff_payload(f, file_size):
+    header = _read_exact(f, 0, 12)
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        raise PayloadNotFound('no RIFF WAVE header')
+    offset = 12
+    while offset + 8 <= file_size:
+        (cid, size) = struct.unpack('<4sI', _read_exact(f, offset, 8))
+        if cid == b'data':
+            # a truncated file is hashed up to its end.
+            return offset + 8, min(offset + 8 + size, file_size)
+        offset += 8 + size + (size & 1)
+    raise PayloadNotFound('no data chunk')
+
+
+def dsf_payload(f, file_size):
+    header = _read_exact(f, 0, 28)
+    if header[:4] != b'DSD ':
+        raise PayloadNotFound('no DSD chunk')
+    offset = struct.unpack('<Q', header[4:12])[0]
+    while offset + 12 <= file_size:
+        (cid, size) = struct.unpack('<4sQ', _read_exact(f, offset, 12))
+        if cid == b'data':
+            return offset + 12, min(offset + size, file_size)
+        if size < 12:
+            break
+        offset += size
+    raise PayloadNotFound('no data chunk')
+
+
+def dff_payload(f, file_size):
+    header = _read_exact(f, 0, 16)
+    if header[:4] != b'FRM8' or header[12:16] != b'DSD ':
+        raise PayloadNotFound('no FRM8 DSD header')
+    offset = 16
+    while offset + 12 <= file_size:
+        (cid, size) = struct.unpack('>4sQ', _read_exact(f, offset, 12))
+        if cid in (b'DSD ', b'DST '):
+            return offset + 12, min(offset + 12 + size, file_size)
+        offset += 12 + size + (size & 1)
+    raise PayloadNotFound('no DSD chunk')
+
+
+def mp4_payload(f, file_size):
+    # the mdat atoms, usually one. Returns a list of ranges.
+    ranges = []
+    offset = 0
+    while offset + 8 <= file_size:
+        (size, name) = struct.unpack('>I4s', _read_exact(f, offset, 8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', _read_exact(f, offset + 8, 8))[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - offset
+        if size < header_size:
+            raise PayloadNotFound(f'bad atom size at {offset}')
+        if name == b'mdat':
+            ranges.append((offset + header_size, min(offset + size, file_size)))
+        offset += size
+    if len(ranges) == 0:
+        raise PayloadNotFound('no mdat atom')
+    return ranges
+
+
+payload_func_map = {'flac': flac_payload,
+                    'mp3': id3_payload,
+                    'ape': id3_payload,
+                    'wav': riff_payload,
+                    'dsf': dsf_payload,
+                    'dff': dff_payload,
+                    'mp4': mp4_payload,
+                    'm4a': mp4_payload,
+                    }
+
+
+def hash_file(task):
+    # runs in the pool: (path, surfix, size, mtime_ns) -> (path, size, mtime_ns, offset, payload size, hash, error)
+    (path, surfix, size, mtime_ns) = task
+    digest = hashlib.blake2b(digest_size=20)
+    buffer = bytearray(BLOCK_SIZE)
+    view = memoryview(buffer)
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            ranges = payload_func_map[surfix](f, size)
+            if isinstance(ranges, tuple):
+                ranges = [ranges]
+            payload_size = 0
+            for (start, end) in ranges:
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    count = f.readinto(view[:min(remaining, BLOCK_SIZE)])
+                    if not count:
+                        raise PayloadNotFound('file shrank while hashing')
+                    digest.update(view[:count])
+                    remaining -= count
+                payload_size += end - start
+    except (OSError, PayloadNotFound, struct.error) as e:
+        return (path, size, mtime_ns, 0, 0, None, str(e))
+    return (path, size, mtime_ns, ranges[0][0], payload_size, digest.hexdigest(), None)
+
+
+def hash_tasks(baseroot, hashed, verify, walk_threads, counts):
+    from folder_walker import walk_folders
+
+    for (root, entries) in walk_folders(os.path.abspath(baseroot), walk_threads):
+        for (name, size, mtime_ns, inode) in entries:
+            surfix = name.rsplit('.', 1)[-1].lower()
+            if surfix not in HASH_SURFIXES:
+                continue
+            path = os.path.join(root, name)
+            old = hashed.get(path)
+            if not verify and old is not None and old[:2] == (size, mtime_ns):
+                counts['unchanged'] += 1
+                continue
+            yield (path, surfix, size, mtime_ns)
+
+
+def hash_library(dirs, sqlitefile, executor=None, jobs=1, verify=False, walk_threads=4, batch_size=1000):
+    from library_db import connect, ensure_schema
+
+    conn = connect(sqlitefile)
+    ensure_schema(conn)
+    conn.execute(AUDIO_HASHES_SCHEMA)
+    conn.execute("CREATE INDEX IF NOT EXISTS audio_hashes_hash ON audio_hashes(hash)")
+    # path -> (size, mtime_ns, hash)
+    hashed = {path: (size, mtime_ns, digest) for (path, size, mtime_ns, digest) in conn.execute(
+        "select path, size, mtime_ns, hash from audio_hashes")}
+    album_paths = dict(conn.execute("select path, seq from albums where path is not null"))
+
+    counts = {'unchanged': 0, 'hashed': 0, 'retagged': 0, 'corrupted': 0, 'failed': 0, 'bytes': 0}
+    rows = []
+    started = time.perf_counter()
+    for dir in dirs:
+        tasks = hash_tasks(dir, hashed, verify, walk_threads, counts)
+        if executor is None:
+            results = map(hash_file, tasks)
+        else:
+            results = bounded_map(executor, hash_file, tasks, jobs * 4)
+        for (path, size, mtime_ns, offset, payload_size, digest, error) in results:
+            if error is not None:
+                logger.error(f'{path}: {error}')
+                counts['failed'] += 1
+                continue
+            counts['hashed'] += 1
+            counts['bytes'] += payload_size
+            old = hashed.get(path)
+            if old is not None and old[2] == digest and old[:2] != (size, mtime_ns):
+                counts['retagged'] += 1
+            elif old is not None and old[2] != digest and old[:2] == (size, mtime_ns):
+                print(f'AUDIO CHANGED, same size and mtime: {path}')
+                counts['corrupted'] += 1
+            rows.append((path, album_paths.get(os.path.dirname(path)), size, mtime_ns, offset, payload_size,
+                         digest, time.time()))
+            if len(rows) >= batch_size:
+                with conn:
+                    conn.executemany(AUDIO_HASH_INSERT, rows)
+                rows = []
+    with conn:
+        conn.executemany(AUDIO_HASH_INSERT, rows)
+    shared = conn.execute("select count(*) from audio_hashes where hash in "
+                          "(select hash from audio_hashes group by hash having count(*) > 1)").fetchone()[0]
+    conn.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Hashed {counts['hashed']} music files, {counts['bytes'] / 1e6:.1f} MB of audio in {elapsed:.2f}s "
+          f"({counts['bytes'] / 1e6 / elapsed if elapsed > 0 else 0:.1f} MB/s), skipped {counts['unchanged']} unchanged, "
+          f"{counts['failed']} failed.")
+    print(f"{counts['retagged']} files were re-tagged with the same audio, {counts['corrupted']} changed audio "
+          f"without a new mtime. {shared} files in the DB share their audio with another file.")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--dir", type=str, default='.',
+                        help="folder to hash recursively, separted with ;")
+    parser.add_argument("-s", "--sqlite", type=str, required=True,
+                        help="path to sqlite3 db file")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes hashing files. Default to 1 (no worker process).")
+    parser.add_argument("--verify", default=False, action='store_true',
+                        help="whether to hash unchanged files again and report audio that changed silently")
+    parser.add_argument("--walk-threads", type=int, default=4,
+                        help="number of threads listing folders. Default to 4.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    executor = None
+    if args.jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+    hash_library([dir for dir in args.dir.split(';') if dir != ''], args.sqlite, executor, args.jobs,
+                 args.verify, args.walk_threads)
+    if executor is not None:
+        executor.shutdown()
@@ -0,0 +1,73 @@
+import argparse
+import os
+import time
+import logging
+from collections import Counter
+
+from cue_sheet import read_cue_text, parse_cue_text, CueParseError
+
+'''
+Throughput of cue_sheet.py over a corpus of CUE sheets.
+
+    python bench_cue.py -d L:\\music
+
+Malformed sheets are listed with the reason instead of stopping the run.
+'''
+
+
+def bench(baseroot, repeat):
+    filenames = []
+    for (root, dirs, files) in os.walk(baseroot):
+        for filename in files:
+            if filename.lower().endswith('.cue'):
+                filenames.append(os.path.join(root, filename))
+
+    total_bytes = sum(os.path.getsize(filename) for filename in filenames)
+    encodings = Counter()
+    errors = {}
+    warnings = 0
+    tracks = 0
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for filename in filenames:
+            try:
+                text, encoding = read_cue_text(filename)
+            except CueParseError as e:
+                errors[filename] = str(e)
+                continue
+            sheet = parse_cue_text(text, filename, encoding)
+            if len(sheet.title.strip()) == 0:
+                errors[filename] = 'cannot find album name'
+            encodings[encoding] += 1
+            warnings += len(sheet.warnings)
+            tracks += len(sheet.tracks)
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return {'files': len(filenames), 'bytes': total_bytes, 'seconds': best,
+            'tracks': tracks // repeat, 'warnings': warnings // repeat,
+            'encodings': {k: v // repeat for (k, v) in encodings.items()}, 'errors': errors}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--dir", type=str, default='.',
+                        help="folder with CUE sheets, scanned recursively")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="parse the corpus this many times and keep the best time. Default to 3.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    result = bench(args.dir, args.repeat)
+    seconds = result['seconds'] or 0
+    files_per_second = result['files'] / seconds if seconds > 0 else 0
+    mb_per_second = result['bytes'] / seconds / 1e6 if seconds > 0 else 0
+    print(f"{result['files']} CUE sheets, {result['bytes']} bytes, {result['tracks']} tracks in {seconds:.3f}s: "
+          f"{files_per_second:.0f} files/s, {mb_per_second:.1f} MB/s")
+    print(f"encodings: {result['encodings']}, malformed lines: {result['warnings']}")
+    print(f"{len(result['errors'])} sheets rejected:")
+    for (filename, error) in sorted(result['errors'].items()):
+        print(f'  {filename}: {error}')
@@ -0,0 +1,113 @@
+import argparse
+import os
+import time
+import logging
+
+from music_tag_loader import music_func_map, get_file_surfix
+from fast_tags import fast_func_map, FastPathUnsupported
+
+'''
+Compare the header-only readers in fast_tags.py with the mutagen readers of
+music_tag_loader.py: bytes read and time per file, and whether both return
+the same tuple.
+
+    python bench_fast_tags.py -d L:\\music\\songs
+'''
+
+
+class CountingFile(object):
+    # wraps a binary file and counts the bytes handed out by read().
+    def __init__(self, filename):
+        self.f = open(filename, 'rb', buffering=0)
+        self.name = filename
+        self.bytes_read = 0
+        self.reads = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        self.reads += 1
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+
+def measure(func, filename, repeat):
+    best = None
+    for _ in range(repeat):
+        f = CountingFile(filename)
+        started = time.perf_counter()
+        try:
+            result = func(f)
+        except FastPathUnsupported as e:
+            result = e
+        except Exception as e:
+            result = repr(e)
+        elapsed = time.perf_counter() - started
+        f.close()
+        if best is None or elapsed < best[0]:
+            best = (elapsed, f.bytes_read, result)
+    return best
+
+
+def bench(baseroot, repeat):
+    stats = {}
+    for (root, dirs, files) in os.walk(baseroot):
+        for filename in files:
+            surfix = get_file_surfix(filename)
+            if surfix not in fast_func_map:
+                continue
+            fullpath = os.path.join(root, filename)
+            (slow_time, slow_bytes, slow_result) = measure(
+                music_func_map[surfix], fullpath, repeat)
+            (fast_time, fast_bytes, fast_result) = measure(
+                fast_func_map[surfix], fullpath, repeat)
+
+            stat = stats.setdefault(surfix, {'files': 0, 'fallback': 0, 'mismatch': 0,
+                                             'slow_time': 0.0, 'slow_bytes': 0, 'fast_time': 0.0, 'fast_bytes': 0})
+            stat['files'] += 1
+            stat['slow_time'] += slow_time
+            stat['slow_bytes'] += slow_bytes
+            if isinstance(fast_result, FastPathUnsupported):
+                # read_tags() would pay for both attempts.
+                stat['fallback'] += 1
+                stat['fast_time'] += fast_time + slow_time
+                stat['fast_bytes'] += fast_bytes + slow_bytes
+                logging.info(f'{fullpath}: {fast_result}')
+                continue
+            stat['fast_time'] += fast_time
+            stat['fast_bytes'] += fast_bytes
+            if fast_result != slow_result:
+                stat['mismatch'] += 1
+                logging.error(f'{fullpath}: mutagen {slow_result} fast {fast_result}')
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--dir", type=str, default='.',
+                        help="folder to scan recursively")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="read every file this many times and keep the best time. Default to 3.")
+    parser.add_argument("--info", default=False, action='store_true',
+                        help="whether to log the files that fall back to mutagen")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.info else logging.ERROR)
+
+    stats = bench(args.dir, args.repeat)
+    print(f"{'format':<6} {'files':>7} {'fallback':>8} {'mismatch':>8} "
+          f"{'mutagen B/file':>15} {'fast B/file':>12} {'mutagen ms/file':>16} {'fast ms/file':>13}")
+    for (surfix, stat) in sorted(stats.items()):
+        files = stat['files']
+        print(f"{surfix:<6} {files:>7} {stat['fallback']:>8} {stat['mismatch']:>8} "
+              f"{stat['slow_bytes'] / files:>15.0f} {stat['fast_bytes'] / files:>12.0f} "
+              f"{stat['slow_time'] * 1000 / files:>16.3f} {stat['fast_time'] * 1000 / files:>13.3f}")
@@ -0,0 +1,291 @@
+import argparse
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import contextlib
+
+import music_tag_loader
+from music_tag_loader import music_func_map, get_file_surfix, get_albums, load_album_index
+from folder_manifest import load_manifest
+from library_db import LibraryWriter
+
+'''
+Benchmarks of the scan path over a library on disk, usually one built by
+gen_music_library.py. Results are saved as JSON so two runs can be compared.
+
+    python gen_music_library.py -d /tmp/library -n 500
+    python bench_scan.py -d /tmp/library -o before.json
+    python bench_scan.py -d /tmp/library -o after.json --compare before.json
+
+Measured:
+    scan           get_albums() over the library into an empty DB
+    rescan         get_albums() again with the manifest, nothing changed
+    read_<format>  every music_func_map reader on the files of its format
+    parse_cue      parse_cue() on every CUE sheet
+    set_tags       set_music_tags.set_tags() on a copy of one album per format
+    db_write       LibraryWriter with synthetic album and song rows
+    memory         peak and retained memory of a scan, with --memory
+'''
+
+logger = logging.getLogger('tag_loader')
+
+
+def summarize(timings, **extra):
+    # timings in seconds -> totals and per item latency in ms
+    ordered = sorted(timings)
+    result = {'count': len(ordered), 'seconds': sum(ordered)}
+    if len(ordered) > 0:
+        result.update({'mean_ms': result['seconds'] * 1000 / len(ordered),
+                       'p50_ms': ordered[len(ordered) // 2] * 1000,
+                       'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+                       'max_ms': ordered[-1] * 1000})
+    result.update(extra)
+    return result
+
+
+def best_of(repeat, func):
+    # runs func repeat times, returns (best seconds, result of the last run)
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def list_library(baseroot):
+    # {surfix: [fullpath, ...]} of the files music_tag_loader.py can read
+    library = {}
+    for (root, dirs, files) in os.walk(os.path.abspath(baseroot)):
+        for filename in files:
+            surfix = get_file_surfix(filename)
+            if surfix in music_func_map:
+                library.setdefault(surfix, []).append(os.path.join(root, filename))
+    return library
+
+
+def bench_scan(baseroot, tmpdir, repeat, jobs, fast_tags):
+    results = {}
+    sqlitefile = os.path.join(tmpdir, 'scan.db')
+
+    def scan(sqlitefile, executor=None):
+        writer = LibraryWriter(sqlitefile)
+        album_index, max_seq = load_album_index(sqlitefile)
+        manifest = load_manifest(sqlitefile)
+        counts = get_albums(baseroot, max_seq, album_index, False, manifest, writer,
+                            executor=executor, fast_tags=fast_tags)
+        writer.close()
+        return counts
+
+    def fresh_scan(executor=None):
+        if os.path.exists(sqlitefile):
+            os.remove(sqlitefile)
+        return scan(sqlitefile, executor)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds, (album_count, song_count, max_seq) = best_of(repeat, fresh_scan)
+        results['scan'] = {'seconds': seconds, 'albums': album_count, 'songs': song_count}
+        seconds, (album_count, song_count, max_seq) = best_of(repeat, lambda: scan(sqlitefile))
+        results['rescan'] = {'seconds': seconds, 'albums': album_count, 'songs': song_count}
+
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=jobs, initializer=music_tag_loader.init_worker,
+                                     initargs=(logger.level,)) as executor:
+                seconds, (album_count, song_count, max_seq) = best_of(
+                    repeat, lambda: fresh_scan(executor))
+            results[f'scan_jobs{jobs}'] = {'seconds': seconds, 'albums': album_count, 'songs': song_count}
+    return results
+
+
+def bench_memory(baseroot, tmpdir, fast_tags):
+    # tracemalloc slows the scan down a lot, so it is measured once and apart from the timings.
+    import tracemalloc
+
+    sqlitefile = os.path.join(tmpdir, 'memory.db')
+    with contextlib.redirect_stdout(io.StringIO()):
+        writer = LibraryWriter(sqlitefile)
+        album_index, max_seq = load_album_index(sqlitefile)
+        manifest = load_manifest(sqlitefile)
+        tracemalloc.start()
+        counts = get_albums(baseroot, max_seq, album_index, False, manifest, writer, fast_tags=fast_tags)
+        (retained, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        writer.close()
+    songs = counts[1]
+    return {'memory': {'peak_mb': peak / 1e6, 'retained_mb': retained / 1e6, 'albums': counts[0], 'songs': songs,
+                       'peak_bytes_per_song': peak / songs if songs > 0 else 0}}
+
+
+def bench_readers(library, repeat):
+    # returns (results, folders with a file that did not read)
+    results = {}
+    failed_folders = set()
+    for (surfix, filenames) in sorted(library.items()):
+        name = 'parse_cue' if surfix == 'cue' else f'read_{surfix}'
+        timings = []
+        errors = 0
+        total_bytes = 0
+        for filename in filenames:
+            best = None
+            for _ in range(repeat):
+                started = time.perf_counter()
+                try:
+                    result = music_func_map[surfix](filename)
+                except Exception as e:
+                    logger.info(f'{filename}: {e!r}')
+                    result = None
+                elapsed = time.perf_counter() - started
+                if best is None or elapsed < best:
+                    best = elapsed
+            if result is None:
+                errors += 1
+                failed_folders.add(os.path.dirname(filename))
+            timings.append(best)
+            total_bytes += os.path.getsize(filename)
+        results[name] = summarize(timings, errors=errors, bytes=total_bytes)
+    return results, failed_folders
+
+
+def bench_set_tags(library, failed_folders, tmpdir):
+    # set_music_tags imports every mutagen format, keep it out of the other measurements.
+    import set_music_tags
+
+    results = {}
+    for (surfix, filenames) in sorted(library.items()):
+        if surfix == 'cue':
+            continue
+        folders = [os.path.dirname(filename) for filename in filenames
+                   if os.path.dirname(filename) not in failed_folders]
+        if len(folders) == 0:
+            continue
+        folder = os.path.join(tmpdir, f'set_tags_{surfix}')
+        shutil.copytree(folders[0], folder)
+        count = len([filename for filename in os.listdir(folder) if set_music_tags.is_music_file(filename)])
+        song_title_list = [[f'Song {idx + 1}', 'Bench Performer'] for idx in range(count)]
+
+        oldpath = os.getcwd()
+        started = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                summary = set_music_tags.set_tags(folder, 'Bench Album', '2000', str(count), 'Bench Band',
+                                                  song_title_list)
+            seconds = time.perf_counter() - started
+            if len(summary['failed']) > 0:
+                raise RuntimeError(f"{len(summary['failed'])} files failed: {summary['failed'][0][1]}")
+            results[f'set_tags_{surfix}'] = {'seconds': seconds, 'files': count,
+                                             'ms_per_file': seconds * 1000 / count if count > 0 else 0}
+        except Exception as e:
+            # report the failure in the results instead of stopping the whole run.
+            results[f'set_tags_{surfix}'] = {'files': count, 'error': repr(e)}
+        finally:
+            os.chdir(oldpath)
+    return results
+
+
+def bench_db_write(tmpdir, albums, songs_per_album, batch_size):
+    sqlitefile = os.path.join(tmpdir, 'write.db')
+    rows = []
+    for seq in range(1, albums + 1):
+        album_row = [f'Album {seq}', f'Performer {seq % 97}', '2000', seq, f'Performer {seq % 97}', f'/music/{seq}']
+        song_rows = [(f'Song {idx}', f'Performer {seq % 97}', idx) for idx in range(1, songs_per_album + 1)]
+        rows.append((album_row, song_rows))
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        writer = LibraryWriter(sqlitefile, batch_size)
+        for (album_row, song_rows) in rows:
+            writer.add_album(album_row)
+            writer.add_songs(album_row[3], song_rows)
+            writer.end_folder()
+        writer.close()
+    seconds = time.perf_counter() - started
+    total = albums * (songs_per_album + 1)
+    return {'db_write': {'seconds': seconds, 'rows': total, 'rows_per_second': total / seconds if seconds > 0 else 0,
+                         'commits': writer.commit_count, 'batch_size': batch_size}}
+
+
+def compare(old_file, results):
+    with open(old_file, 'r', encoding='utf8') as IN:
+        old_results = json.load(IN)['results']
+    print(f"{'benchmark':<16} {'old s':>10} {'new s':>10} {'new/old':>8}")
+    for (name, result) in results.items():
+        old = old_results.get(name, {})
+        if 'seconds' not in result or 'seconds' not in old:
+            continue
+        ratio = result['seconds'] / old['seconds'] if old['seconds'] > 0 else 0
+        print(f"{name:<16} {old['seconds']:>10.4f} {result['seconds']:>10.4f} {ratio:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--dir", type=str, required=True,
+                        help="library to benchmark, see gen_music_library.py")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="JSON file for the results")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="JSON file of an earlier run to compare with")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="run every measurement this many times and keep the best time. Default to 3.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="also time the scan with this many worker processes. Default to 1 (serial only).")
+    parser.add_argument("--fast-tags", default=False, action='store_true',
+                        help="whether the scans use the header-only readers in fast_tags.py")
+    parser.add_argument("--db-albums", type=int, default=2000,
+                        help="number of synthetic albums for db_write. Default to 2000.")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="LibraryWriter batch size for db_write. Default to 1000.")
+    parser.add_argument("--memory", default=False, action='store_true',
+                        help="whether to also measure the memory of one scan with tracemalloc")
+    parser.add_argument("--info", default=False, action='store_true',
+                        help="whether to log the files that fail to read")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.info else logging.CRITICAL)
+
+    library = list_library(args.dir)
+    meta = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+            'platform': platform.platform(), 'library': os.path.abspath(args.dir),
+            'files': {surfix: len(filenames) for (surfix, filenames) in library.items()},
+            'bytes': sum(os.path.getsize(filename) for filenames in library.values() for filename in filenames),
+            'repeat': args.repeat, 'jobs': args.jobs, 'fast_tags': args.fast_tags}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results.update(bench_scan(args.dir, tmpdir, args.repeat, args.jobs, args.fast_tags))
+        reader_results, failed_folders = bench_readers(library, args.repeat)
+        results.update(reader_results)
+        results.update(bench_set_tags(library, failed_folders, tmpdir))
+        results.update(bench_db_write(tmpdir, args.db_albums, 10, args.batch_size))
+        if args.memory:
+            results.update(bench_memory(args.dir, tmpdir, args.fast_tags))
+
+    for (name, result) in results.items():
+        if 'error' in result:
+            print(f"{name:<16} failed: {result['error']}")
+        elif 'peak_mb' in result:
+            print(f"{name:<16} peak {result['peak_mb']:.2f} MB  retained {result['retained_mb']:.2f} MB  "
+                  f"{result['peak_bytes_per_song']:.0f} bytes per song")
+        elif 'mean_ms' in result:
+            print(f"{name:<16} {result['seconds']:8.4f}s  {result['count']:>6} items  "
+                  f"mean {result['mean_ms']:7.3f} ms  p95 {result['p95_ms']:7.3f} ms")
+        else:
+            print(f"{name:<16} {result['seconds']:8.4f}s")
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf8') as OUT:
+            json.dump({'meta': meta, 'results': results}, OUT, ensure_ascii=False, indent=1)
+        print(f'Saved results to {args.output}')
+
+    if args.compare is not None:
+        compare(args.compare, results)
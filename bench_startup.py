@@ -0,0 +1,48 @@
+import argparse
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import statistics
+import subprocess
+
+'''
+Cold-start time of music_tag_loader.py: the interpreter plus module imports
+(--help), and a rescan of one empty folder against an empty DB.
+
+    python bench_startup.py -r 10
+'''
+
+
+def run(cmd, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-r", "--repeat", type=int, default=10,
+                        help="number of runs per measurement. Default to 10.")
+    args = parser.parse_args()
+
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'music_tag_loader.py')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sqlitefile = os.path.join(tmpdir, 'library.db')
+        sqlite3.connect(sqlitefile).close()
+        folder = os.path.join(tmpdir, 'empty')
+        os.mkdir(folder)
+
+        measurements = {
+            'import (--help)': [sys.executable, script, '--help'],
+            'empty rescan': [sys.executable, script, '-s', sqlitefile, '-d', folder],
+        }
+        for (name, cmd) in measurements.items():
+            timings = run(cmd, args.repeat)
+            print(f'{name:<16} min {min(timings) * 1000:7.1f} ms   median {statistics.median(timings) * 1000:7.1f} ms')
@@ -0,0 +1,35 @@
+from collections import deque
+
+'''
+Bounded, ordered map over a concurrent.futures executor, shared by
+music_tag_loader.py, audio_hash.py and check_wav_file.py.
+
+executor.map submits every task before it returns the first result, so a
+library walk would be listed and queued up front. bounded_map() keeps at
+most in_flight_max tasks submitted and not yet taken by the caller: a slow
+consumer holds back the walk and the workers. Results come back in task
+order no matter which worker finishes first.
+'''
+
+
+def run_chunk(func, chunk):
+    # runs in the worker: one submit per chunk of tasks.
+    return [func(task) for task in chunk]
+
+
+def bounded_map(executor, func, tasks, in_flight_max, chunksize=1):
+    # chunksize > 1 sends that many tasks per submit, which saves round trips to worker processes.
+    in_flight = deque()
+    chunk = []
+    for task in tasks:
+        chunk.append(task)
+        if len(chunk) < chunksize:
+            continue
+        in_flight.append(executor.submit(run_chunk, func, chunk))
+        chunk = []
+        if len(in_flight) * chunksize >= in_flight_max:
+            yield from in_flight.popleft().result()
+    if len(chunk) > 0:
+        in_flight.append(executor.submit(run_chunk, func, chunk))
+    while in_flight:
+        yield from in_flight.popleft().result()
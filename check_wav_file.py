@@ -1,8 +1,59 @@
 #!/usr/bin/env python
 
+import os
 import sys
+import time
+import struct
+import argparse
+import logging
 
-from mutagen._riff import RiffFile
+from bounded_pool import bounded_map
+
+logger = logging.getLogger('tag_loader')
+
+'''
+Checks the RIFF chunk tree of WAV files.
+
+    python check_wav_file.py song.wav
+        prints every chunk of one or more files, exits 1 if one is invalid.
+
+    python check_wav_file.py -d /music -s library.db -j 8 [--repair]
+        checks every WAV file under the folder and records the result in the
+        wav_checks table of the library DB.
+
+The batch mode reads only the 8 byte header of each chunk and seeks over
+the chunk data, so a 2 GB image costs a few small reads. A file whose size
+and mtime are unchanged since its last clean check is not opened again.
+
+--repair fixes the two size fields a truncated or unfinished rip gets wrong,
+by rewriting only those header bytes:
+    - the data chunk is the last one and claims more bytes than the file has,
+      or 0 bytes with PCM after it: its size becomes the bytes present,
+      rounded down to whole sample frames (fmt block_align) and to an even
+      size. The bytes of a partial frame stay in the file after the chunk,
+      where less than one frame after the data chunk is not a problem.
+    - the RIFF size does not match the file size while the chunks end exactly
+      at the end of the file: it becomes the file size - 8.
+Anything else is only reported.
+'''
+
+WAV_CHECKS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS wav_checks (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    status TEXT,
+    problems TEXT,
+    checked_at REAL
+)
+'''
+
+WAV_CHECK_INSERT = "INSERT OR REPLACE INTO wav_checks(path, size, mtime_ns, status, problems, checked_at) VALUES (?,?,?,?,?,?)"
+
+CHUNK_HEADER = struct.Struct('<4sI')
+SIZE_FIELD = struct.Struct('<I')
+# wFormatTag, nChannels, nSamplesPerSec, nAvgBytesPerSec, nBlockAlign of the fmt chunk
+FMT_HEADER = struct.Struct('<HHIIH')
 
 
 def validate_chunk(chunk, level=0):
@@ -26,8 +77,10 @@ def validate_chunk(chunk, level=0):
     return valid
 
 
-def main():
-    f = open(sys.argv[1], 'rb')
+def validate_file(filename):
+    from mutagen._riff import RiffFile
+
+    f = open(filename, 'rb')
     riff = RiffFile(f)
     valid = validate_chunk(riff.root)
 
@@ -37,10 +90,205 @@ def main():
     valid &= sizes_match
     print("\nFile size: {0} bytes{1}".format(
         size, "" if sizes_match else " !SIZE MISMATCH!"))
+    f.close()
+    return valid
+
+
+def is_chunk_id(cid):
+    return all(0x20 <= c <= 0x7e for c in cid)
+
+
+def frame_step(block_align):
+    # whole sample frames, and an even size so no pad byte is needed.
+    step = block_align if block_align > 0 else 1
+    if step & 1:
+        step *= 2
+    return step
+
+
+def scan_riff(f, file_size):
+    '''
+    Walks the top level chunks of an open WAV file reading only their headers.
+    Returns (problems, fixes) where fixes are (offset, new size field value)
+    that --repair may write.
+    '''
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        if header[:4] == b'RF64':
+            return ['RF64 file, not checked'], []
+        return ['not a RIFF WAVE file'], []
+    problems = []
+    fixes = []
+    root_size = SIZE_FIELD.unpack_from(header, 4)[0]
+    chunks = set()
+    block_align = 0
+    # (id, offset, size) of the last chunk read
+    last = None
+    offset = 12
+    end = 12
+
+    def partial_frame(offset):
+        # less than a sample frame after the data chunk, as --repair leaves it.
+        return last is not None and last[0] == b'data' and 0 < file_size - offset < frame_step(block_align)
+
+    while offset + CHUNK_HEADER.size <= file_size:
+        if partial_frame(offset):
+            end = file_size
+            break
+        f.seek(offset)
+        (cid, size) = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+        if not is_chunk_id(cid):
+            if last is not None and last[0] == b'data' and last[2] == 0:
+                # a writer that never went back to fill in the data size.
+                problems.append(f'data chunk at {last[1]} has size 0, PCM follows it')
+                available = file_size - last[1] - CHUNK_HEADER.size
+                fixes.append((last[1] + 4, available - available % frame_step(block_align)))
+                end = file_size
+            else:
+                problems.append(f'no chunk header at {offset}')
+            break
+        chunks.add(cid)
+        last = (cid, offset, size)
+        if cid == b'fmt ' and size >= FMT_HEADER.size:
+            block_align = FMT_HEADER.unpack(f.read(FMT_HEADER.size))[4]
+        available = file_size - offset - CHUNK_HEADER.size
+        if size > available:
+            problems.append(f'{cid.decode("ascii")} chunk at {offset} claims {size} bytes, {available} present')
+            if cid == b'data':
+                fixes.append((offset + 4, available - available % frame_step(block_align)))
+                end = file_size
+            break
+        # chunks are padded to an even size, the pad byte of the last one is often missing.
+        offset += CHUNK_HEADER.size + size + (size & 1)
+        end = min(offset, file_size)
+    else:
+        if partial_frame(offset):
+            end = file_size
+        elif offset < file_size:
+            problems.append(f'{file_size - offset} stray bytes at the end')
+
+    if b'fmt ' not in chunks:
+        problems.append('no fmt chunk')
+    if b'data' not in chunks:
+        problems.append('no data chunk')
+    if root_size != file_size - 8:
+        problems.append(f'RIFF size is {root_size}, file has {file_size - 8} bytes after the header')
+        if end == file_size and len(problems) == len(fixes) + 1:
+            fixes.append((4, file_size - 8))
+    if len(fixes) < len(problems):
+        # only repair a file when every problem it has is a size field.
+        fixes = []
+    return problems, fixes
+
+
+def check_file(task):
+    # runs in the pool: (path, size, mtime_ns, repair) -> wav_checks row
+    (path, size, mtime_ns, repair) = task
+    try:
+        with open(path, 'r+b' if repair else 'rb') as f:
+            (problems, fixes) = scan_riff(f, size)
+            if repair and len(fixes) > 0:
+                for (offset, value) in fixes:
+                    f.seek(offset)
+                    f.write(SIZE_FIELD.pack(value))
+                status = 'repaired'
+                # the row gets the new mtime; only 'ok' rows are skipped, so the
+                # next run checks the repaired file again.
+                f.flush()
+                mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            else:
+                status = 'ok' if len(problems) == 0 else 'bad'
+    except OSError as e:
+        (problems, status) = ([str(e)], 'bad')
+    return (path, size, mtime_ns, status, '; '.join(problems), time.time())
+
+
+def wav_files(baseroot, checked, recheck, walk_threads):
+    # yields check_file tasks, skipping the files that were clean last time and are unchanged.
+    from folder_walker import walk_folders
+
+    unchanged = 0
+    for (root, entries) in walk_folders(os.path.abspath(baseroot), walk_threads):
+        for (name, size, mtime_ns, inode) in entries:
+            if not name.lower().endswith('.wav'):
+                continue
+            path = os.path.join(root, name)
+            if not recheck and checked.get(path) == (size, mtime_ns, 'ok'):
+                unchanged += 1
+                continue
+            yield (path, size, mtime_ns)
+    print(f'{unchanged} unchanged WAV files were not checked again.')
+
+
+def check_library(dirs, sqlitefile, jobs=4, repair=False, recheck=False, walk_threads=4, batch_size=1000):
+    from concurrent.futures import ThreadPoolExecutor
+    from library_db import connect
+
+    conn = connect(sqlitefile)
+    conn.execute(WAV_CHECKS_SCHEMA)
+    checked = {path: (size, mtime_ns, status) for (path, size, mtime_ns, status) in conn.execute(
+        "select path, size, mtime_ns, status from wav_checks")}
+
+    counts = {'ok': 0, 'bad': 0, 'repaired': 0}
+    rows = []
+    started = time.perf_counter()
+    # the checks wait on disk seeks, threads are enough to keep many of them in flight.
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for dir in dirs:
+            tasks = (task + (repair,) for task in wav_files(dir, checked, recheck, walk_threads))
+            for row in bounded_map(executor, check_file, tasks, jobs * 4):
+                (path, size, mtime_ns, status, problems, checked_at) = row
+                counts[status] += 1
+                if status != 'ok':
+                    print(f'{status.upper():<8} {path}: {problems}')
+                rows.append(row)
+                if len(rows) >= batch_size:
+                    with conn:
+                        conn.executemany(WAV_CHECK_INSERT, rows)
+                    rows = []
+    with conn:
+        conn.executemany(WAV_CHECK_INSERT, rows)
+    conn.close()
+    print(f"Checked {sum(counts.values())} WAV files in {time.perf_counter() - started:.2f}s: "
+          f"{counts['ok']} ok, {counts['bad']} bad, {counts['repaired']} repaired.")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("files", nargs='*',
+                        help="WAV files whose chunks are printed")
+    parser.add_argument("-d", "--dir", type=str, default=None,
+                        help="folder to check recursively, separted with ;")
+    parser.add_argument("-s", "--sqlite", type=str, default=None,
+                        help="path to sqlite3 db file for the results of --dir")
+    parser.add_argument("-j", "--jobs", type=int, default=8,
+                        help="number of files checked at the same time. Default to 8.")
+    parser.add_argument("--repair", default=False, action='store_true',
+                        help="whether to rewrite wrong RIFF and data size fields")
+    parser.add_argument("--all", default=False, action='store_true',
+                        help="whether to check again the files that were ok and are unchanged")
+    parser.add_argument("--walk-threads", type=int, default=4,
+                        help="number of threads listing folders. Default to 4.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.dir is None:
+        if len(args.files) == 0:
+            parser.error('give WAV files, or --dir and --sqlite')
+        valid = True
+        for filename in args.files:
+            valid &= validate_file(filename)
+        sys.exit(0 if valid else 1)
 
-    sys.exit(0 if valid else 1)
+    if args.sqlite is None:
+        parser.error('--dir needs --sqlite')
+    counts = check_library([dir for dir in args.dir.split(';') if dir != ''], args.sqlite, args.jobs,
+                           args.repair, args.all, args.walk_threads)
+    sys.exit(0 if counts['bad'] == 0 else 1)
 
 
 if __name__ == "__main__":
     main()
-   
\ No newline at end of file
@@ -0,0 +1,217 @@
+import sys
+import logging
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+'''
+CUE sheet parser shared by music_tag_loader.py, set_music_tags.py and replace_cue_titles.py.
+
+The file is read once, decoded in memory with the first encoding that fits,
+and every line is tokenized by its leading keyword:
+
+    REM DATE 1987
+    PERFORMER "Erich Kunzel, CINCINNATI POPS ORCHESTRA"
+    TITLE "Pomp & Pizazz"
+    FILE "Erich Kunzel, CINCINNATI POPS ORCHESTRA - Pomp & Pizazz.wav" WAVE
+      TRACK 01 AUDIO
+        TITLE "Olympic Fanfare"
+        PERFORMER "Williams, John"
+        INDEX 01 00:00:00
+
+Another cue format puts the song title in front of its TRACK line:
+
+    FILE "01 - Call My Name.flac" WAVE
+        TITLE "Call My Name"
+        TRACK 01 AUDIO
+        INDEX 01 00:00:00
+
+TITLE and PERFORMER before the first FILE or TRACK line belong to the album,
+and so do unindented ones before the first TRACK line; the later ones belong
+to a track. Malformed input raises CueParseError, it never exits.
+'''
+
+logger = logging.getLogger('tag_loader')
+
+CUE_ENCODINGS = ['utf-8-sig', 'gbk', 'big5']
+
+
+class CueParseError(Exception):
+    pass
+
+
+@dataclass
+class CueLine:
+    indent: str
+    keyword: str    # upper case, empty for a blank line
+    args: str
+    raw: str        # the line without its line break
+
+    @property
+    def head(self):
+        # indent plus the keyword as written in the file
+        return self.raw[:len(self.indent) + len(self.keyword)]
+
+
+@dataclass
+class CueTrack:
+    number: int
+    audio: bool = True
+    title: str = ""
+    performer: Optional[str] = None
+    file: Optional[str] = None
+    indexes: dict = field(default_factory=dict)   # index number -> "mm:ss:ff"
+
+
+@dataclass
+class CueSheet:
+    filename: str
+    encoding: str
+    title: str = ""
+    performer: str = ""
+    date: str = ""
+    tracks: List[CueTrack] = field(default_factory=list)
+    lines: List[CueLine] = field(default_factory=list)
+    # malformed lines that were skipped
+    warnings: List[str] = field(default_factory=list)
+
+    def songs(self):
+        # [(song_title, song_performer, track number), ...] of the audio tracks that have an INDEX
+        song_list = []
+        for track in self.tracks:
+            if not track.audio or len(track.indexes) == 0:
+                continue
+            performer = track.performer if track.performer is not None else self.performer
+            song_list.append((track.title.strip(), sys.intern(performer.strip()), track.number))
+        return song_list
+
+
+def decode_bytes(data, encodings=CUE_ENCODINGS):
+    # returns (text, encoding) with the first encoding that decodes the whole file.
+    err_str_list = []
+    for encoding in encodings:
+        try:
+            return data.decode(encoding), encoding
+        except UnicodeDecodeError as e:
+            err_str_list.append(f'{encoding}: {e}')
+    raise CueParseError("\n".join(err_str_list))
+
+
+def tokenize(text):
+    lines = []
+    for raw in text.splitlines():
+        stripped = raw.lstrip()
+        # blank lines are kept with an empty keyword so a sheet can be written back as it was.
+        parts = stripped.split(None, 1) or [""]
+        lines.append(CueLine(indent=raw[:len(raw) - len(stripped)], keyword=parts[0].upper(),
+                             args=parts[1].strip() if len(parts) > 1 else "", raw=raw))
+    return lines
+
+
+def unquote(value):
+    # "Pomp & Pizazz" -> Pomp & Pizazz, text after the closing quote is dropped.
+    if value.startswith('"'):
+        end = value.rfind('"')
+        if end > 0:
+            return value[1:end]
+        return value[1:]
+    return value
+
+
+class _CueBuilder:
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.in_header = True
+        self.track = None
+        self.file = None
+        # TITLE or PERFORMER found after FILE but before its TRACK line.
+        self.pending = {}
+
+    def album_level(self, line):
+        # some sheets put the album fields unindented after the FILE line.
+        return self.in_header or (line.indent == '' and self.track is None)
+
+    def rem(self, line):
+        parts = line.args.split(None, 1)
+        if self.album_level(line) and len(parts) == 2 and parts[0].upper() == 'DATE':
+            self.sheet.date = parts[1].strip()
+
+    def title(self, line):
+        value = unquote(line.args)
+        if self.album_level(line):
+            self.sheet.title = value
+        elif self.track is None or len(self.track.indexes) > 0:
+            self.pending['title'] = value
+        else:
+            self.track.title = value
+
+    def performer(self, line):
+        value = line.args.replace('"', "")
+        if self.album_level(line):
+            self.sheet.performer = value
+        elif self.track is None or len(self.track.indexes) > 0:
+            self.pending['performer'] = value
+        else:
+            self.track.performer = value
+
+    def file_(self, line):
+        self.in_header = False
+        self.file = unquote(line.args)
+
+    def track_(self, line):
+        self.in_header = False
+        parts = line.args.split()
+        if len(parts) < 1 or not parts[0].isdigit():
+            self.sheet.warnings.append(f'bad TRACK line: {line.raw}')
+            return
+        self.track = CueTrack(number=int(parts[0]),
+                              audio=len(parts) > 1 and parts[1].upper() == 'AUDIO',
+                              title=self.pending.get('title', ""),
+                              performer=self.pending.get('performer'),
+                              file=self.file)
+        self.pending = {}
+        self.sheet.tracks.append(self.track)
+
+    def index(self, line):
+        parts = line.args.split()
+        if self.track is None or len(parts) != 2 or not parts[0].isdigit() or parts[1].count(':') != 2:
+            self.sheet.warnings.append(f'bad INDEX line: {line.raw}')
+            return
+        self.track.indexes.setdefault(int(parts[0]), parts[1])
+
+    dispatch = {'REM': rem,
+                'TITLE': title,
+                'PERFORMER': performer,
+                'FILE': file_,
+                'TRACK': track_,
+                'INDEX': index,
+                }
+
+
+def parse_cue_text(text, filename="", encoding=""):
+    sheet = CueSheet(filename=filename, encoding=encoding)
+    sheet.lines = tokenize(text)
+    builder = _CueBuilder(sheet)
+    for line in sheet.lines:
+        handler = _CueBuilder.dispatch.get(line.keyword)
+        if handler is not None:
+            handler(builder, line)
+    return sheet
+
+
+def read_cue_text(filename, encodings=CUE_ENCODINGS):
+    with open(filename, 'rb') as IN:
+        data = IN.read()
+    try:
+        return decode_bytes(data, encodings)
+    except CueParseError as e:
+        raise CueParseError(f'{filename}: cannot decode with {encodings}\n{e}')
+
+
+def load_cue_sheet(filename, require_title=True):
+    text, encoding = read_cue_text(filename)
+    sheet = parse_cue_text(text, filename, encoding)
+    for warning in sheet.warnings:
+        logger.warning(f'{filename}: {warning}')
+    if require_title and len(sheet.title.strip()) == 0:
+        raise CueParseError(f'{filename}: cannot find album name')
+    return sheet
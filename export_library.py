@@ -0,0 +1,186 @@
+import os
+import json
+import shutil
+import time
+import sqlite3
+import argparse
+import importlib.util
+import logging
+
+logger = logging.getLogger('tag_loader')
+
+'''
+Columnar snapshot of the library DB for analytics, written with pyarrow:
+
+    python export_library.py -s library.db -o snapshot
+    python export_library.py -s library.db -o snapshot --append
+
+The snapshot folder holds albums/ and songs/ datasets, one file per export
+run, and snapshot.json with the highest album seq exported. --append only
+exports the albums with a higher seq and their songs, as a new file in each
+dataset; without it the datasets are written again from scratch, which also
+picks up albums whose songs or tags changed since. A full export is written
+to a .export folder first and swapped in when it is complete, so a failed
+run leaves the last snapshot as it was.
+
+Rows are read from SQLite and written chunk by chunk, so memory stays flat
+however big the library is. With --format arrow the files are Arrow IPC
+files that readers can memory-map:
+
+    import pyarrow.dataset as ds
+    albums = ds.dataset('snapshot/albums', format='parquet').to_table()
+
+    import pyarrow as pa
+    with pa.memory_map('snapshot/albums/part-000000.arrow') as source:
+        albums = pa.ipc.open_file(source).read_all()
+'''
+
+ALBUMS_SELECT = ("select title, performer, release_date, seq, performer_zh, path, rating "
+                 "from albums where seq > ? order by seq")
+SONGS_SELECT = ("select title, performer, seq, albumid, rating "
+                "from songs where albumid > ? order by albumid, rowid")
+STATE_FILE = 'snapshot.json'
+
+
+def table_schemas():
+    import pyarrow as pa
+
+    albums = pa.schema([('title', pa.string()), ('performer', pa.string()), ('release_date', pa.string()),
+                        ('seq', pa.int64()), ('performer_zh', pa.string()), ('path', pa.string()),
+                        ('rating', pa.int64())])
+    # song seq is the track number as tagged, '3', '3/12' or 'A1', kept as text.
+    songs = pa.schema([('title', pa.string()), ('performer', pa.string()), ('seq', pa.string()),
+                       ('albumid', pa.int64()), ('rating', pa.int64())])
+    return albums, songs
+
+
+def record_batches(cursor, schema, chunk_size):
+    # turns the rows of cursor into record batches of at most chunk_size rows.
+    import pyarrow as pa
+
+    names = schema.names
+    text_columns = [idx for (idx, field) in enumerate(schema) if pa.types.is_string(field.type)]
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if len(rows) == 0:
+            return
+        columns = [list(column) for column in zip(*rows)]
+        for idx in text_columns:
+            # tags read from MP4 files store some numbers as int.
+            columns[idx] = [None if value is None else str(value) for value in columns[idx]]
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(column, type=field.type) for (column, field) in zip(columns, schema)], names=names)
+
+
+def write_dataset(filename, batches, schema, file_format):
+    # returns the number of rows written; no file is left behind for an empty export.
+    import pyarrow as pa
+
+    writer = None
+    rows = 0
+    try:
+        for batch in batches:
+            if writer is None:
+                if file_format == 'parquet':
+                    import pyarrow.parquet as pq
+                    writer = pq.ParquetWriter(filename, schema, compression='zstd')
+                else:
+                    writer = pa.ipc.new_file(filename, schema)
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def load_state(outdir):
+    filename = os.path.join(outdir, STATE_FILE)
+    if not os.path.exists(filename):
+        return {'max_seq': 0, 'part': 0}
+    with open(filename, 'r', encoding='utf8') as IN:
+        return json.load(IN)
+
+
+def save_state(outdir, state):
+    filename = os.path.join(outdir, STATE_FILE)
+    with open(filename + '.tmp', 'w', encoding='utf8') as OUT:
+        json.dump(state, OUT, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def swap_datasets(outdir, workdir):
+    # moves the albums/ and songs/ of workdir into outdir, in place of the old ones.
+    for name in ['albums', 'songs']:
+        old = os.path.join(outdir, name)
+        if os.path.isdir(old):
+            os.rename(old, os.path.join(workdir, f'old-{name}'))
+        os.rename(os.path.join(workdir, name), old)
+    shutil.rmtree(workdir)
+
+
+def export_library(sqlitefile, outdir, append=False, file_format='parquet', chunk_size=50000):
+    started = time.perf_counter()
+    (albums_schema, songs_schema) = table_schemas()
+    state = load_state(outdir) if append else {'max_seq': 0, 'part': 0}
+    first_seq = state['max_seq']
+    surfix = 'parquet' if file_format == 'parquet' else 'arrow'
+    # a full export goes to workdir until it is complete.
+    workdir = outdir if append else os.path.join(outdir, '.export')
+    if not append:
+        shutil.rmtree(workdir, ignore_errors=True)
+    for name in ['albums', 'songs']:
+        os.makedirs(os.path.join(workdir, name), exist_ok=True)
+
+    with sqlite3.connect(sqlitefile) as CONN:
+        # one read transaction, so albums and songs come from the same state of the DB.
+        CONN.execute("BEGIN")
+        max_seq = CONN.execute("select max(seq) from albums").fetchone()[0] or 0
+        part = f"part-{state['part']:06d}.{surfix}"
+        album_count = write_dataset(os.path.join(workdir, 'albums', part),
+                                    record_batches(CONN.execute(ALBUMS_SELECT, (first_seq,)), albums_schema,
+                                                   chunk_size), albums_schema, file_format)
+        song_count = write_dataset(os.path.join(workdir, 'songs', part),
+                                   record_batches(CONN.execute(SONGS_SELECT, (first_seq,)), songs_schema,
+                                                  chunk_size), songs_schema, file_format)
+        CONN.rollback()
+    CONN.close()
+
+    written = album_count > 0 or song_count > 0
+    if not append:
+        swap_datasets(outdir, workdir)
+    if written or not append:
+        # after a full export the state always describes the new snapshot, even an empty one.
+        state = {'max_seq': max(max_seq, first_seq), 'part': state['part'] + (1 if written else 0),
+                 'format': file_format, 'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        save_state(outdir, state)
+    print(f'Exported {album_count} albums and {song_count} songs with seq > {first_seq} to {outdir} '
+          f'in {time.perf_counter() - started:.2f}s.')
+    return album_count, song_count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-s", "--sqlite", type=str, required=True,
+                        help="path to sqlite3 db file")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="snapshot folder")
+    parser.add_argument("--append", default=False, action='store_true',
+                        help="whether to only add the albums with a seq above the last export")
+    parser.add_argument("--format", type=str, default='parquet', choices=['parquet', 'arrow'],
+                        help="parquet files, or Arrow IPC files that can be memory-mapped. Default to parquet.")
+    parser.add_argument("--chunk-size", type=int, default=50000,
+                        help="rows read from SQLite and written per batch. Default to 50000.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    if importlib.util.find_spec('pyarrow') is None:
+        parser.error('export needs pyarrow: pip install pyarrow')
+
+    if args.append:
+        state = load_state(args.output)
+        if state.get('format', args.format) != args.format:
+            parser.error(f"the snapshot in {args.output} is {state['format']}, not {args.format}")
+    export_library(args.sqlite, args.output, args.append, args.format, args.chunk_size)
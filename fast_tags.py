@@ -0,0 +1,531 @@
+import re
+import struct
+import logging
+from contextlib import nullcontext
+
+'''
+Header-only tag readers for FLAC, MP3, DSF and MP4, and track lengths of
+FLAC, WAV and DSF.
+
+The mutagen readers in music_tag_loader parse stream info, cover art and every
+frame of the tag even though only six text fields are needed. The readers here
+seek straight to the tag region, read only the fields we use and return exactly
+the same tuple as the mutagen based readers:
+
+    (album, album_performer, year, song_title, song_performer, song_index)
+
+Anything unusual (compressed or unsynchronised ID3 frames, duplicated fields,
+broken block sizes, ...) raises FastPathUnsupported and read_tags() falls back
+to the mutagen reader. The fast path does not validate the audio stream itself.
+read_length() likewise falls back to mutagen's stream info.
+'''
+
+logger = logging.getLogger('tag_loader')
+
+
+class FastPathUnsupported(Exception):
+    pass
+
+
+def _open(filething):
+    # accept a path or an already opened binary file object.
+    if isinstance(filething, (str, bytes)) or hasattr(filething, '__fspath__'):
+        return open(filething, 'rb', buffering=0)
+    return nullcontext(filething)
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise FastPathUnsupported("truncated file")
+    return data
+
+
+def _file_size(f):
+    pos = f.tell()
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(pos)
+    return size
+
+
+# ---------------------------------------------------------------- FLAC
+
+FLAC_STREAMINFO = 0
+FLAC_VORBIS_COMMENT = 4
+FLAC_PICTURE = 6
+
+
+def _valid_vorbis_key(key):
+    return key != "" and all(0x20 <= ord(c) <= 0x7D and c != '=' for c in key)
+
+
+def _read_vorbis_comment(data):
+    # returns [(key, value), ...] in file order, like mutagen's VCommentDict.
+    try:
+        vendor_length, = struct.unpack_from('<I', data, 0)
+        pos = 4 + vendor_length
+        count, = struct.unpack_from('<I', data, pos)
+        pos += 4
+        comments = []
+        for _ in range(count):
+            length, = struct.unpack_from('<I', data, pos)
+            pos += 4
+            if pos + length > len(data):
+                raise FastPathUnsupported("truncated vorbis comment")
+            string = data[pos:pos + length].decode('utf-8', 'replace')
+            pos += length
+            if '=' not in string:
+                continue
+            key, value = string.split('=', 1)
+            if not key.isascii():
+                raise FastPathUnsupported(f"non ascii vorbis key {key!r}")
+            if _valid_vorbis_key(key):
+                comments.append((key.lower(), value))
+    except struct.error:
+        raise FastPathUnsupported("truncated vorbis comment")
+    if pos != len(data):
+        # mutagen ignores the block size of vorbis comments. Let it decide.
+        raise FastPathUnsupported("vorbis comment size mismatch")
+    return comments
+
+
+def _check_picture_size(f, size):
+    # mutagen does not trust the size of picture blocks either.
+    start = f.tell()
+    header = _read_exact(f, 8)
+    mime_length, = struct.unpack('>I', header[4:8])
+    f.seek(mime_length, 1)
+    desc_length, = struct.unpack('>I', _read_exact(f, 4))
+    f.seek(desc_length + 16, 1)
+    data_length, = struct.unpack('>I', _read_exact(f, 4))
+    if 8 + mime_length + 4 + desc_length + 16 + 4 + data_length != size:
+        raise FastPathUnsupported("picture block size mismatch")
+    f.seek(start + size)
+
+
+def read_flac_tags(filething):
+    with _open(filething) as f:
+        if _read_exact(f, 4) != b'fLaC':
+            raise FastPathUnsupported("no fLaC header at start of file")
+        comments = None
+        first_block = True
+        last_block = False
+        while not last_block:
+            header = _read_exact(f, 4)
+            code = header[0] & 0x7F
+            last_block = bool(header[0] & 0x80)
+            size = int.from_bytes(header[1:4], 'big')
+            if first_block and code != FLAC_STREAMINFO:
+                raise FastPathUnsupported("first block is not STREAMINFO")
+            first_block = False
+            if code == FLAC_VORBIS_COMMENT:
+                if comments is not None:
+                    raise FastPathUnsupported("more than one vorbis comment block")
+                comments = _read_vorbis_comment(_read_exact(f, size))
+            elif code == FLAC_PICTURE:
+                _check_picture_size(f, size)
+            else:
+                f.seek(size, 1)
+
+    if comments is None:
+        raise FastPathUnsupported("no vorbis comment block")
+
+    tags = {}
+    for (key, value) in comments:
+        tags.setdefault(key, value)
+
+    # same rules as music_tag_loader.get_metadata()
+    if 'album' not in tags:
+        raise FastPathUnsupported("no ALBUM tag")
+    album = tags['album']
+    song_performer = tags.get('artist', "")
+    album_performer = tags.get('albumartist', tags.get('album artist', ""))
+    if album_performer == "":
+        album_performer = song_performer
+    year = tags.get('date', tags.get('year', ""))
+    song_index = tags.get('tracknumber', "")
+    song_title = tags.get('title', "")
+
+    return (album.strip(), album_performer.strip(), year, song_title.strip(), song_performer.strip(), song_index)
+
+
+# ---------------------------------------------------------------- ID3v2
+
+ID3_FIELDS = ('TALB', 'TRCK', 'TIT2', 'TPE1', 'TPE2', 'TDRC', 'TYER', 'TDAT', 'TIME')
+ID3_FRAME_ID = re.compile(rb'[A-Z0-9]{4}\Z')
+ID3_TEXT_ENCODINGS = {0: ('latin1', b'\x00'),
+                      1: ('utf16', b'\x00\x00'),
+                      2: ('utf_16_be', b'\x00\x00'),
+                      3: ('utf8', b'\x00')}
+ID3_TIMESTAMP_SPLIT = re.compile('[-T:/.]|\\s+')
+
+
+def _synchsafe(data):
+    if any(b & 0x80 for b in data):
+        raise FastPathUnsupported("invalid synchsafe integer")
+    value = 0
+    for b in data:
+        value = (value << 7) | b
+    return value
+
+
+def _id3_text(body):
+    # first value of a text frame, decoded the same way mutagen does.
+    if len(body) < 2:
+        raise FastPathUnsupported("empty text frame")
+    if body[0] not in ID3_TEXT_ENCODINGS:
+        raise FastPathUnsupported(f"unknown text encoding {body[0]}")
+    codec, term = ID3_TEXT_ENCODINGS[body[0]]
+    data = body[1:]
+    end = data.find(term)
+    while end >= 0 and end % len(term) != 0:
+        end = data.find(term, end + 1)
+    if end < 0:
+        value, rest = data, b""
+    else:
+        value, rest = data[:end], data[end + len(term):]
+    try:
+        return value.decode(codec), rest
+    except UnicodeDecodeError:
+        raise FastPathUnsupported("undecodable text frame")
+
+
+def _id3_timestamp(text):
+    # str(mutagen.id3.ID3TimeStamp(text))
+    formats = ['%04d'] + ['%02d'] * 5
+    seps = ['-', '-', ' ', ':', ':', 'x']
+    pieces = []
+    for (fmt, sep, part) in zip(formats, seps, ID3_TIMESTAMP_SPLIT.split(text + ':::::')[:6]):
+        try:
+            value = int(part)
+        except ValueError:
+            break
+        pieces.append(fmt % value + sep)
+    return ''.join(pieces)[:-1]
+
+
+def _walk_id3_frames(f, start, size, synchsafe_sizes):
+    # yields (frame_id, flags, body_offset, body_size) reading only the frame headers.
+    pos = 0
+    while pos + 10 <= size:
+        f.seek(start + pos)
+        header = _read_exact(f, 10)
+        frame_id = header[:4]
+        if frame_id == b'\x00\x00\x00\x00':
+            # padding
+            return
+        if not ID3_FRAME_ID.match(frame_id):
+            raise FastPathUnsupported(f"invalid frame id {frame_id!r}")
+        if synchsafe_sizes:
+            frame_size = _synchsafe(header[4:8])
+        else:
+            frame_size, = struct.unpack('>I', header[4:8])
+        end = pos + 10 + frame_size
+        if end > size:
+            raise FastPathUnsupported("frame runs past end of tag")
+        yield frame_id.decode('ascii'), header[8:10], start + pos + 10, frame_size
+        pos = end
+
+
+def _count_frames(f, start, size, synchsafe_sizes):
+    try:
+        return sum(1 for _ in _walk_id3_frames(f, start, size, synchsafe_sizes))
+    except FastPathUnsupported:
+        return -1
+
+
+def _read_id3_frames(f, offset):
+    f.seek(offset)
+    header = f.read(10)
+    if header[:3] != b'ID3':
+        # no tags unless there is an ID3v1 tag.
+        _check_id3v1(f, {})
+        return None
+    version, flags = header[3], header[5]
+    if version not in (3, 4):
+        raise FastPathUnsupported(f"ID3v2.{version} tag")
+    if flags & 0xC0:
+        raise FastPathUnsupported("unsynchronised tag or extended header")
+    start = offset + 10
+    size = _synchsafe(header[6:10])
+
+    synchsafe_sizes = version == 4
+    if version == 4:
+        # mutagen accepts iTunes' non synchsafe v2.4 frame sizes. Only go on when there is no doubt.
+        if _count_frames(f, start, size, False) > _count_frames(f, start, size, True):
+            raise FastPathUnsupported("ambiguous ID3v2.4 frame sizes")
+
+    frames = {}
+    for (frame_id, frame_flags, body_offset, body_size) in _walk_id3_frames(f, start, size, synchsafe_sizes):
+        if frame_id not in ID3_FIELDS or body_size == 0:
+            # mutagen drops empty frames.
+            continue
+        if frame_flags[1] != 0:
+            raise FastPathUnsupported(f"{frame_id} is compressed, encrypted or grouped")
+        if frame_id in frames:
+            raise FastPathUnsupported(f"more than one {frame_id} frame")
+        f.seek(body_offset)
+        frames[frame_id] = _id3_text(_read_exact(f, body_size))
+
+    texts = {frame_id: value for (frame_id, (value, rest)) in frames.items()}
+    if 'TDRC' in texts:
+        texts['TDRC'] = _id3_timestamp(texts['TDRC'])
+    elif 'TYER' in texts:
+        # mutagen turns ID3v2.3 TYER, TDAT and TIME into TDRC.
+        if any(rest.strip(b'\x00') for (frame_id, (value, rest)) in frames.items() if frame_id in ('TYER', 'TDAT', 'TIME')):
+            raise FastPathUnsupported("more than one ID3v2.3 date value")
+        ym = re.match(r"([0-9]{4})(-[0-9]{2}-[0-9]{2})?\Z", texts['TYER'])
+        dm = re.match(r"([0-9]{2})([0-9]{2})\Z", texts.get('TDAT', ""))
+        tm = re.match(r"([0-9]{2})([0-9]{2})\Z", texts.get('TIME', ""))
+        if ym:
+            (timestamp, month_day) = ym.groups()
+            if dm:
+                month_day = "-%s-%s" % dm.groups()[::-1]
+            if month_day:
+                timestamp += month_day
+                if tm:
+                    timestamp += "T%s:%s:00" % tm.groups()
+            texts['TDRC'] = _id3_timestamp(timestamp)
+    return texts
+
+
+def _check_id3v1(f, texts):
+    # mutagen fills frames missing from ID3v2 with the ID3v1 tag at the end of the file.
+    if all(frame_id in texts for frame_id in ('TALB', 'TRCK', 'TIT2', 'TPE1', 'TDRC')):
+        return
+    size = _file_size(f)
+    f.seek(max(0, size - 131))
+    if b'TAG' in f.read(131):
+        raise FastPathUnsupported("ID3v1 tag fills missing ID3v2 frames")
+
+
+def _id3_result(texts):
+    # same rules as music_tag_loader.get_mp3_id3_metadata()
+    album = texts.get('TALB', "")
+    song_index = texts['TRCK'].split('/')[0] if 'TRCK' in texts else "0"
+    song_title = texts.get('TIT2', "")
+    song_performer = texts.get('TPE1', "")
+    album_performer = texts.get('TPE2', song_performer)
+    year = texts.get('TDRC', "")
+    return (album.strip(), album_performer.strip(), year, song_title.strip(), song_performer.strip(), song_index)
+
+
+def read_mp3_tags(filething):
+    with _open(filething) as f:
+        texts = _read_id3_frames(f, 0)
+        if texts is None:
+            return None
+        _check_id3v1(f, texts)
+    return _id3_result(texts)
+
+
+def read_dsf_tags(filething):
+    with _open(filething) as f:
+        header = _read_exact(f, 28)
+        if header[:4] != b'DSD ':
+            raise FastPathUnsupported("no DSD chunk")
+        metadata_offset, = struct.unpack('<Q', header[20:28])
+        if metadata_offset == 0:
+            # no ID3 chunk, mutagen reports no tags.
+            return None
+        texts = _read_id3_frames(f, metadata_offset)
+        if texts is None:
+            return None
+        _check_id3v1(f, texts)
+    return _id3_result(texts)
+
+
+# ---------------------------------------------------------------- MP4
+
+MP4_TEXT_ATOMS = {b'\xa9alb', b'\xa9nam', b'\xa9ART', b'aART', b'\xa9day'}
+MP4_TRACK_ATOM = b'trkn'
+
+
+def _mp4_atoms(f, start, end, top_level=False):
+    # yields (name, data_offset, data_end) of the atoms between start and end.
+    pos = start
+    while pos < end:
+        f.seek(pos)
+        length, name = struct.unpack('>I4s', _read_exact(f, 8))
+        data_offset = pos + 8
+        if length == 1:
+            length, = struct.unpack('>Q', _read_exact(f, 8))
+            data_offset += 8
+            if length < 16:
+                raise FastPathUnsupported("bad 64 bit atom length")
+        elif length == 0:
+            if not top_level:
+                raise FastPathUnsupported("zero length atom inside a container")
+            length = end - pos
+        elif length < 8:
+            raise FastPathUnsupported("bad atom length")
+        if pos + length > end:
+            raise FastPathUnsupported(f"atom {name!r} runs past its parent")
+        yield name, data_offset, pos + length
+        pos += length
+
+
+def _mp4_child(f, start, end, name):
+    for (child, data_offset, data_end) in _mp4_atoms(f, start, end):
+        if child == name:
+            return data_offset, data_end
+    return None
+
+
+def _mp4_data_values(data):
+    # payloads of the 'data' atoms of one ilst item, like mutagen's __parse_data.
+    values = []
+    pos = 0
+    while pos < len(data):
+        if pos + 16 > len(data):
+            raise FastPathUnsupported("truncated data atom")
+        length, name = struct.unpack('>I4s', data[pos:pos + 8])
+        flags = int.from_bytes(data[pos + 9:pos + 12], 'big')
+        if name != b'data' or length < 16 or pos + length > len(data):
+            raise FastPathUnsupported("unexpected atom in ilst item")
+        values.append((flags, data[pos + 16:pos + length]))
+        pos += length
+    if len(values) == 0:
+        raise FastPathUnsupported("ilst item without data")
+    return values
+
+
+def read_mp4_tags(filething):
+    with _open(filething) as f:
+        size = _file_size(f)
+        moov = None
+        for (name, data_offset, data_end) in _mp4_atoms(f, 0, size, top_level=True):
+            if name == b'moov' and moov is None:
+                moov = (data_offset, data_end)
+        if moov is None:
+            raise FastPathUnsupported("no moov atom")
+
+        udta = _mp4_child(f, moov[0], moov[1], b'udta')
+        meta = udta and _mp4_child(f, udta[0], udta[1], b'meta')
+        # meta is a full atom: skip version and flags.
+        ilst = meta and _mp4_child(f, meta[0] + 4, meta[1], b'ilst')
+        if not ilst:
+            # mutagen reports no tags.
+            return None
+
+        items = {}
+        for (name, data_offset, data_end) in _mp4_atoms(f, ilst[0], ilst[1]):
+            if name not in MP4_TEXT_ATOMS and name != MP4_TRACK_ATOM:
+                continue
+            if name in items:
+                raise FastPathUnsupported(f"more than one {name!r} atom")
+            f.seek(data_offset)
+            items[name] = _mp4_data_values(_read_exact(f, data_end - data_offset))
+
+    texts = {}
+    for (name, values) in items.items():
+        if name == MP4_TRACK_ATOM:
+            if any(len(value) < 6 for (flags, value) in values):
+                raise FastPathUnsupported("short trkn atom")
+            texts[name] = struct.unpack('>2H', values[0][1][2:6])
+            continue
+        if any(flags not in (0, 1) for (flags, value) in values):
+            raise FastPathUnsupported(f"{name!r} is not text")
+        try:
+            texts[name] = [value.decode('utf-8') for (flags, value) in values][0]
+        except UnicodeDecodeError:
+            raise FastPathUnsupported(f"{name!r} is not utf-8")
+
+    # same rules as music_tag_loader.get_mp4_metadata()
+    album = texts.get(b'\xa9alb', "")
+    song_index = texts[MP4_TRACK_ATOM][0] if MP4_TRACK_ATOM in texts else "0"
+    song_title = texts.get(b'\xa9nam', "")
+    song_performer = texts.get(b'\xa9ART', "")
+    album_performer = texts.get(b'aART', song_performer)
+    year = texts.get(b'\xa9day', "")
+    return (album.strip(), album_performer.strip(), year, song_title.strip(), song_performer.strip(), song_index)
+
+
+# ---------------------------------------------------------------- Durations
+
+def read_flac_length(filething):
+    with _open(filething) as f:
+        if _read_exact(f, 4) != b'fLaC':
+            raise FastPathUnsupported("no fLaC header at start of file")
+        header = _read_exact(f, 4)
+        if header[0] & 0x7F != FLAC_STREAMINFO:
+            raise FastPathUnsupported("first block is not STREAMINFO")
+        info = _read_exact(f, 18)
+    # 20 bits sample rate, 3 bits channels, 5 bits bits per sample, 36 bits total samples
+    value = int.from_bytes(info[10:18], 'big')
+    sample_rate = value >> 44
+    total_samples = value & ((1 << 36) - 1)
+    if sample_rate == 0 or total_samples == 0:
+        raise FastPathUnsupported("unknown number of samples")
+    return total_samples / sample_rate
+
+
+def read_wav_length(filething):
+    with _open(filething) as f:
+        file_size = _file_size(f)
+        header = _read_exact(f, 12)
+        if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            raise FastPathUnsupported("no RIFF WAVE header")
+        byte_rate = None
+        offset = 12
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            (cid, size) = struct.unpack('<4sI', _read_exact(f, 8))
+            if cid == b'fmt ':
+                byte_rate, = struct.unpack('<I', _read_exact(f, 12)[8:12])
+            elif cid == b'data':
+                if not byte_rate:
+                    raise FastPathUnsupported("no fmt chunk before the data chunk")
+                # a truncated file has less PCM than its data chunk claims.
+                return min(size, file_size - offset - 8) / byte_rate
+            offset += 8 + size + (size & 1)
+    raise FastPathUnsupported("no data chunk")
+
+
+def read_dsf_length(filething):
+    with _open(filething) as f:
+        header = _read_exact(f, 28 + 52)
+    if header[:4] != b'DSD ' or header[28:32] != b'fmt ':
+        raise FastPathUnsupported("no DSD and fmt chunks")
+    sampling_frequency, = struct.unpack('<I', header[56:60])
+    sample_count, = struct.unpack('<Q', header[64:72])
+    if sampling_frequency == 0:
+        raise FastPathUnsupported("no sampling frequency")
+    return sample_count / sampling_frequency
+
+
+fast_length_map = {'flac': read_flac_length,
+                   'wav': read_wav_length,
+                   'dsf': read_dsf_length,
+                   }
+
+
+def read_length(filename, music):
+    # track length in seconds, from the stream header where we can parse it.
+    if music in fast_length_map:
+        try:
+            return fast_length_map[music](filename)
+        except (FastPathUnsupported, struct.error) as e:
+            logger.debug(f'fast path skipped for {filename}: {e}')
+    import mutagen
+    audio = mutagen.File(filename)
+    if audio is None:
+        raise FastPathUnsupported("unknown audio format")
+    return audio.info.length
+
+
+fast_func_map = {'flac': read_flac_tags,
+                 'mp3': read_mp3_tags,
+                 'dsf': read_dsf_tags,
+                 'mp4': read_mp4_tags,
+                 'm4a': read_mp4_tags,
+                 }
+
+
+def read_tags(filename, music, fallback):
+    try:
+        return fast_func_map[music](filename)
+    except (FastPathUnsupported, struct.error) as e:
+        logger.debug(f'fast path skipped for {filename}: {e}')
+        return fallback(filename)
@@ -0,0 +1,198 @@
+import re
+import json
+import time
+import sqlite3
+import argparse
+import logging
+import unicodedata
+from collections import Counter
+from difflib import SequenceMatcher
+
+logger = logging.getLogger('tag_loader')
+
+'''
+Finds albums of the library DB that are probably the same album.
+
+music_tag_loader.py only catches folders with exactly the same (title,
+performer). Here both are normalized first:
+    - Unicode NFKC, so full width letters and brackets become plain ones
+    - case folded
+    - traditional Chinese converted to simplified, if opencc is installed
+    - disc and edition suffixes like "(Disc 2)", "CD1" or "[Remastered]" removed
+    - punctuation and extra spaces removed
+
+Albums with the same normalized key form a group. Then, within each block of
+albums by the same normalized performer, titles that are similar enough are
+grouped too. Blocks bigger than --max-block (a "Various Artists" performer)
+are split by the first letter of the title, so the pairs compared stay
+near linear in the number of albums.
+
+    python find_duplicate_albums.py -s library.db [-o groups.json]
+'''
+
+# words that mark a disc or an edition of an album, not a different album.
+EDITION_WORDS = (r'\b(disc|disk|cd|dvd|sacd|vol|volume|remaster|remastered|deluxe|edition|version|'
+                 r'anniversary|expanded|special|limited|bonus|reissue|mono|stereo|hi-?res|24bit|'
+                 r'dsd|xrcd|k2hd|shm|lp|ep)\b|限量|限定|复刻|復刻|纪念|紀念|珍藏|精选|精選|版')
+BRACKETED_EDITION = re.compile(r'[\(\[\{<【「][^\)\]\}>】」]*(' + EDITION_WORDS + r')[^\)\]\}>】」]*[\)\]\}>】」]',
+                               re.IGNORECASE)
+DISC_SUFFIX = re.compile(r'\s*[-_,]?\s*(disc|disk|cd)\s*\d+\s*$', re.IGNORECASE)
+
+
+def load_converter():
+    # traditional to simplified Chinese, None without opencc.
+    try:
+        import opencc
+    except ImportError:
+        return None
+    for config in ['t2s', 't2s.json']:
+        try:
+            return opencc.OpenCC(config)
+        except Exception as e:
+            logger.debug(f'opencc {config}: {e}')
+    return None
+
+
+def normalize_text(text, converter=None):
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    if converter is not None:
+        text = converter.convert(text)
+    text = BRACKETED_EDITION.sub(' ', text)
+    text = DISC_SUFFIX.sub('', text)
+    # keep letters, digits and marks of every script, drop punctuation and symbols.
+    text = ''.join(c if unicodedata.category(c)[0] in 'LNM' else ' ' for c in text)
+    return ' '.join(text.split())
+
+
+class UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        parent = self.parent.setdefault(item, item)
+        if parent != item:
+            parent = self.parent[item] = self.find(parent)
+        return parent
+
+    def union(self, a, b):
+        (a, b) = (self.find(a), self.find(b))
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+
+def title_blocks(albums, max_block):
+    # albums are [(seq, norm title, norm performer)], yields lists of albums to compare pairwise.
+    by_performer = {}
+    for album in albums:
+        by_performer.setdefault(album[2], []).append(album)
+    for block in by_performer.values():
+        if len(block) <= max_block:
+            yield block
+            continue
+        by_letter = {}
+        for album in block:
+            by_letter.setdefault(album[1][:1], []).append(album)
+        yield from by_letter.values()
+
+
+def find_duplicates(rows, similarity=0.9, max_block=200, converter=None):
+    '''
+    rows are (seq, title, performer, release_date, path) from the albums table.
+    Returns groups of two or more rows, each sorted by seq, with the reason
+    they were grouped: 'same key' or 'similar title'.
+    '''
+    union = UnionFind()
+    keys = {}
+    by_key = {}
+    albums = []
+    for row in rows:
+        (seq, title, performer) = row[:3]
+        key = keys[seq] = (normalize_text(title, converter), normalize_text(performer, converter))
+        if key[0] == '':
+            continue
+        first = by_key.setdefault(key, seq)
+        if first != seq:
+            union.union(first, seq)
+        else:
+            albums.append((seq, key[0], key[1]))
+
+    # only one album per normalized key is compared, the others are in its group already.
+    for block in title_blocks(albums, max_block):
+        # same upper bounds as SequenceMatcher.real_quick_ratio() and quick_ratio(),
+        # with the letter counts of every title built once. Sorted by length, the
+        # titles after the first one too long for a are too long as well.
+        block = sorted(block, key=lambda album: len(album[1]))
+        counters = [Counter(album[1]) for album in block]
+        for (idx, a) in enumerate(block):
+            matcher = None
+            for jdx in range(idx + 1, len(block)):
+                b = block[jdx]
+                total = len(a[1]) + len(b[1])
+                if 2 * len(a[1]) < similarity * total:
+                    break
+                if 2 * sum((counters[idx] & counters[jdx]).values()) < similarity * total:
+                    continue
+                if matcher is None:
+                    # SequenceMatcher caches its second sequence.
+                    matcher = SequenceMatcher(None, '', a[1])
+                matcher.set_seq1(b[1])
+                if matcher.ratio() >= similarity:
+                    union.union(a[0], b[0])
+
+    rows_by_seq = {row[0]: row for row in rows}
+    groups = {}
+    for seq in union.parent:
+        groups.setdefault(union.find(seq), []).append(rows_by_seq[seq])
+    result = []
+    for (root, group) in sorted(groups.items()):
+        if len(group) < 2:
+            continue
+        reason = 'same key' if len({keys[row[0]] for row in group}) == 1 else 'similar title'
+        result.append((reason, sorted(group)))
+    return result
+
+
+def load_albums(sqlitefile):
+    with sqlite3.connect(sqlitefile) as CONN:
+        rows = CONN.execute("select seq, title, performer, release_date, path from albums order by seq").fetchall()
+    CONN.close()
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-s", "--sqlite", type=str, required=True,
+                        help="path to sqlite3 db file")
+    parser.add_argument("--similarity", type=float, default=0.9,
+                        help="titles of the same performer this similar are grouped, 1.0 only groups equal keys. Default to 0.9.")
+    parser.add_argument("--max-block", type=int, default=200,
+                        help="performers with more albums are compared by first title letter. Default to 200.")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="JSON file for the groups")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    converter = load_converter()
+    if converter is None:
+        print('opencc is not installed, traditional and simplified Chinese titles are not matched.')
+
+    started = time.perf_counter()
+    rows = load_albums(args.sqlite)
+    groups = find_duplicates(rows, args.similarity, args.max_block, converter)
+    for (reason, group) in groups:
+        print(f'{reason}:')
+        for (seq, title, performer, release_date, path) in group:
+            print(f'  {seq:>6} {title} / {performer} ({release_date}) {path}')
+    print(f'{len(groups)} groups with {sum(len(group) for (reason, group) in groups)} albums '
+          f'out of {len(rows)} in {time.perf_counter() - started:.2f}s.')
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf8') as OUT:
+            json.dump([{'reason': reason,
+                        'albums': [{'seq': seq, 'title': title, 'performer': performer,
+                                    'release_date': release_date, 'path': path}
+                                   for (seq, title, performer, release_date, path) in group]}
+                       for (reason, group) in groups], OUT, ensure_ascii=False, indent=1)
+        print(f'Saved groups to {args.output}')
@@ -0,0 +1,92 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+
+logger = logging.getLogger('tag_loader')
+
+'''
+The manifest remembers what every scanned folder looked like last time:
+file names, sizes, mtimes and inode numbers. A folder whose fingerprint
+is unchanged does not need to be opened again, and a new folder with the
+fingerprint of one that is gone was moved there.
+'''
+
+MANIFEST_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS folder_manifest (
+    path TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    files TEXT NOT NULL,
+    scanned_at REAL
+)
+'''
+
+MANIFEST_INSERT = "INSERT OR REPLACE INTO folder_manifest(path, fingerprint, files, scanned_at) VALUES (?,?,?,?)"
+MANIFEST_DELETE = "DELETE FROM folder_manifest WHERE path=?"
+
+
+def ensure_manifest_table(conn):
+    conn.execute(MANIFEST_SCHEMA)
+
+
+def stat_folder(root, files):
+    # (name, size, mtime_ns, inode) for every file in the folder.
+    entries = []
+    for filename in sorted(files):
+        try:
+            st = os.stat(os.path.join(root, filename))
+        except OSError as e:
+            logger.error(e)
+            continue
+        entries.append((filename, st.st_size, st.st_mtime_ns, st.st_ino))
+    return entries
+
+
+def folder_fingerprint(entries):
+    digest = hashlib.sha1()
+    for (name, size, mtime_ns, inode) in entries:
+        digest.update(f'{name}\0{size}\0{mtime_ns}\0{inode}\n'.encode(
+            'utf8', errors='surrogateescape'))
+    return digest.hexdigest()
+
+
+def loose_fingerprint(entries):
+    # the same without inode numbers, which change when a folder is copied to another disk.
+    digest = hashlib.sha1()
+    for (name, size, mtime_ns, inode) in entries:
+        digest.update(f'{name}\0{size}\0{mtime_ns}\n'.encode(
+            'utf8', errors='surrogateescape'))
+    return digest.hexdigest()
+
+
+def load_move_index(sqlitefile):
+    '''
+    Returns {fingerprint: folder path} of the manifest, keyed by both the
+    fingerprint and the loose fingerprint of every folder. A new folder
+    found under one of them is the old folder moved or renamed.
+    '''
+    move_index = {}
+    with sqlite3.connect(sqlitefile) as CONN:
+        ensure_manifest_table(CONN)
+        for (path, fingerprint, files) in CONN.execute(
+                "select path, fingerprint, files from folder_manifest order by path"):
+            move_index.setdefault(fingerprint, path)
+            move_index.setdefault(loose_fingerprint(json.loads(files)), path)
+    CONN.close()
+    return move_index
+
+
+def load_manifest(sqlitefile):
+    # returns {folder path: fingerprint}
+    with sqlite3.connect(sqlitefile) as CONN:
+        ensure_manifest_table(CONN)
+        manifest = dict(CONN.execute(
+            "select path, fingerprint from folder_manifest"))
+    CONN.close()
+    return manifest
+
+
+def manifest_row(path, fingerprint, entries):
+    return (path, fingerprint, json.dumps(entries, ensure_ascii=False), time.time())
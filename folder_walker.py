@@ -0,0 +1,99 @@
+import os
+import stat
+import logging
+
+logger = logging.getLogger('tag_loader')
+
+'''
+Directory walker for music_tag_loader.py.
+
+Folders are listed with os.scandir by a small thread pool: as soon as a
+folder is listed its subfolders are queued, so on a NAS many listings are
+in flight while the caller reads the folder in front of it. Folders are
+still handed out one at a time in a fixed pre-order (subfolders sorted by
+name), so album seq numbers come out the same on every run.
+
+The stat of every file comes from the DirEntry, which caches it, and the
+process working directory is never changed.
+'''
+
+# files that make a folder worth reading
+ALBUM_SURFIXES = {'flac', 'ape', 'mp3', 'wav', 'dff', 'dsf', 'mp4', 'm4a', 'cue'}
+
+
+def list_folder(path):
+    # returns (subfolders, entries) where entries are (name, size, mtime_ns, inode)
+    # sorted by name, the same tuples as folder_manifest.stat_folder().
+    subdirs = []
+    entries = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        # like os.walk, links to folders are not followed.
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                        continue
+                    st = entry.stat()
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+                    entries.append((entry.name, st.st_size, st.st_mtime_ns, entry.inode()))
+                except OSError as e:
+                    logger.error(e)
+    except OSError as e:
+        logger.error(e)
+    subdirs.sort()
+    entries.sort()
+    return subdirs, entries
+
+
+def is_album_candidate(entries):
+    for entry in entries:
+        if entry[0].rsplit('.', 1)[-1].lower() in ALBUM_SURFIXES:
+            return True
+    return False
+
+
+def walk_folders(baseroot, threads=4, lookahead=None):
+    '''
+    Yields (path, entries) for every folder under baseroot holding a music
+    or CUE file, in pre-order. With threads <= 1 the folders are listed
+    one by one in the calling thread. Otherwise the next lookahead folders
+    to hand out (default 4 per thread) are always being listed.
+    '''
+    if threads <= 1:
+        stack = [baseroot]
+        while stack:
+            path = stack.pop()
+            (subdirs, entries) = list_folder(path)
+            stack.extend(reversed(subdirs))
+            if is_album_candidate(entries):
+                yield (path, entries)
+        return
+
+    if lookahead is None:
+        lookahead = threads * 4
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='walker')
+
+    def fill(stack):
+        # the folders on top of the stack are handed out next, list them first.
+        for idx in range(len(stack) - 1, max(len(stack) - 1 - lookahead, -1), -1):
+            (path, future) = stack[idx]
+            if future is None:
+                stack[idx] = (path, pool.submit(list_folder, path))
+
+    try:
+        # (path, future of its listing or None), the next folder on top.
+        stack = [(baseroot, None)]
+        while stack:
+            fill(stack)
+            (path, future) = stack.pop()
+            (subdirs, entries) = future.result()
+            stack.extend((subdir, None) for subdir in reversed(subdirs))
+            if is_album_candidate(entries):
+                yield (path, entries)
+    finally:
+        # the caller may stop early, drop the listings nobody will ask for.
+        pool.shutdown(wait=True, cancel_futures=True)
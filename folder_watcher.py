@@ -0,0 +1,240 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import logging
+
+from folder_walker import walk_folders
+from folder_manifest import folder_fingerprint
+
+logger = logging.getLogger('tag_loader')
+
+'''
+Change notification for music_tag_loader.py --watch.
+
+A watcher reports the folders that changed under the roots. On Linux it
+uses inotify through ctypes, one watch per folder; elsewhere, or when
+inotify cannot be used, it walks the roots every poll interval and compares
+folder fingerprints. The Debouncer holds a folder back until its events
+stop for a while, so a rip writing 20 files is read once.
+'''
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class WatcherUnavailable(Exception):
+    pass
+
+
+class InotifyWatcher:
+    def __init__(self, roots):
+        import ctypes
+        import ctypes.util
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise WatcherUnavailable('cannot find libc')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise WatcherUnavailable('libc has no inotify')
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatcherUnavailable(os.strerror(ctypes.get_errno()))
+        self.get_errno = ctypes.get_errno
+        self.roots = roots
+        # watch descriptor -> folder path
+        self.watches = {}
+        try:
+            for root in roots:
+                self.add_tree(root)
+        except WatcherUnavailable:
+            self.close()
+            raise
+        logger.info(f'inotify watches {len(self.watches)} folders')
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = self.get_errno()
+            if err == errno.ENOSPC:
+                raise WatcherUnavailable(
+                    f'too many folders for inotify, raise fs.inotify.max_user_watches ({path})')
+            if err not in (errno.ENOENT, errno.ENOTDIR):
+                logger.error(f'{path}: {os.strerror(err)}')
+            return
+        self.watches[wd] = path
+
+    def add_tree(self, top):
+        # returns the folders now watched under top, top included.
+        added = []
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            self.add_watch(path)
+            added.append(path)
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except OSError as e:
+                logger.error(e)
+        return added
+
+    def remove_tree(self, top):
+        prefix = os.path.join(top, '')
+        for (wd, path) in list(self.watches.items()):
+            if path == top or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self, timeout):
+        # returns the set of folders with events, after waiting at most timeout seconds.
+        dirty = set()
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return dirty
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                self.handle_event(wd, mask, os.fsdecode(name), dirty)
+        return dirty
+
+    def handle_event(self, wd, mask, name, dirty):
+        if mask & IN_Q_OVERFLOW:
+            # events were lost, every watched folder may have changed.
+            logger.error('inotify queue overflow, checking all folders')
+            dirty.update(self.watches.values())
+            return
+        folder = self.watches.get(wd)
+        if folder is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            dirty.add(folder)
+            return
+        if mask & IN_ISDIR:
+            subfolder = os.path.join(folder, name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # files may have landed before the watch was added, read the whole new tree.
+                dirty.update(self.add_tree(subfolder))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                dirty.add(subfolder)
+                if mask & IN_MOVED_FROM:
+                    # the watches follow the moved folder, their paths are stale now.
+                    self.remove_tree(subfolder)
+            return
+        dirty.add(folder)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    def __init__(self, roots, interval=30.0, threads=4):
+        self.roots = roots
+        self.interval = interval
+        self.threads = threads
+        self.fingerprints = self.snapshot()
+        self.last_poll = time.monotonic()
+
+    def snapshot(self):
+        fingerprints = {}
+        for root in self.roots:
+            for (path, entries) in walk_folders(root, self.threads):
+                fingerprints[path] = folder_fingerprint(entries)
+        return fingerprints
+
+    def read_events(self, timeout):
+        remaining = self.last_poll + self.interval - time.monotonic()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(remaining, 0))
+        fingerprints = self.snapshot()
+        self.last_poll = time.monotonic()
+        dirty = set()
+        for (path, fingerprint) in fingerprints.items():
+            if self.fingerprints.get(path) != fingerprint:
+                dirty.add(path)
+        # folders that are gone or lost their music files
+        dirty.update(set(self.fingerprints) - set(fingerprints))
+        self.fingerprints = fingerprints
+        return dirty
+
+    def close(self):
+        pass
+
+
+class Debouncer:
+    '''
+    A folder is ready once it had no event for quiet seconds, or at the
+    latest max_wait seconds after its first event, for folders that never
+    settle such as a long copy.
+    '''
+
+    def __init__(self, quiet=2.0, max_wait=60.0):
+        self.quiet = quiet
+        self.max_wait = max_wait
+        # folder -> (first event, last event)
+        self.pending = {}
+
+    def touch(self, folders, now):
+        for folder in folders:
+            (first, last) = self.pending.get(folder, (now, now))
+            self.pending[folder] = (first, now)
+
+    def ready(self, now):
+        folders = [folder for (folder, (first, last)) in self.pending.items()
+                   if now - last >= self.quiet or now - first >= self.max_wait]
+        for folder in folders:
+            del self.pending[folder]
+        return sorted(folders)
+
+    def timeout(self, now, idle=1.0):
+        # how long to wait for events before a pending folder becomes ready
+        if len(self.pending) == 0:
+            return idle
+        return max(min(min(last + self.quiet, first + self.max_wait) - now
+                       for (first, last) in self.pending.values()), 0.05)
+
+
+def open_watcher(roots, poll_interval=30.0, threads=4):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(roots)
+        except WatcherUnavailable as e:
+            logger.error(f'{e}, polling every {poll_interval}s instead')
+    return PollingWatcher(roots, poll_interval, threads)
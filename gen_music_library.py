@@ -0,0 +1,298 @@
+import argparse
+import os
+import random
+import struct
+import shutil
+import json
+
+'''
+Build a synthetic music library on local disk for the benchmarks.
+
+    python gen_music_library.py -d /tmp/library -n 200
+
+Every album folder holds one format: FLAC, MP3, M4A, DSF or WAV files tagged
+with mutagen, or one WAV image with a CUE sheet in utf-8, gbk or big5.
+The audio payload is silence of --audio-kb bytes per file, so the tags and the
+folder layout look real while the library stays small. --broken-ratio of the
+albums get a damaged file: garbage bytes, a truncated ID3 tag or a CUE sheet
+without an album title. The same seed always builds the same library, and
+library.json in the output folder lists what was generated.
+'''
+
+FORMATS = ['flac', 'mp3', 'm4a', 'dsf', 'wav', 'cue']
+
+# words that encode in gbk and big5, so CUE sheets can be saved in both.
+CJK_WORDS = ['夜來香', '月亮', '甜蜜蜜', '小城故事', '我的心', '何日君再來', '海韻', '恰似你的溫柔',
+             '東方之珠', '童年', '光陰的故事', '外婆的澎湖灣', '橄欖樹', '歲月', '故鄉', '雨']
+CJK_NAMES = ['鄧麗君', '羅大佑', '蔡琴', '齊豫', '潘安邦', '費玉清', '高勝美', '甄妮']
+LATIN_WORDS = ['Night', 'Blue', 'River', 'Song', 'Moon', 'Winter', 'Road', 'Dream',
+               'Fire', 'Glass', 'Ocean', 'Summer', 'Light', 'Heart', 'Rain', 'Home']
+LATIN_NAMES = ['The Cinders', 'Ada Marsh', 'North Quartet', 'Lee Hollow', 'Orchestra Nova']
+CUE_ENCODINGS = ['utf-8', 'gbk', 'big5']
+
+
+def flac_bytes(payload):
+    streaminfo_value = (44100 << 44) | (1 << 41) | (15 << 36) | 441000
+    streaminfo = struct.pack('>HH', 4096, 4096) + b'\0' * 6 + streaminfo_value.to_bytes(8, 'big') + b'\0' * 16
+    return b'fLaC' + bytes([0x80]) + len(streaminfo).to_bytes(3, 'big') + streaminfo + b'\xff\xf8' + b'\0' * payload
+
+
+def mp3_bytes(payload):
+    # 128 kbps 44.1 kHz MPEG-1 Layer III frames of 417 bytes
+    frame = b'\xff\xfb\x90\x64' + b'\0' * 413
+    return frame * max(payload // len(frame), 4)
+
+
+def wav_bytes(payload):
+    data = b'\0' * (payload - payload % 4)
+    fmt = struct.pack('<HHIIHH', 1, 2, 44100, 44100 * 4, 4, 16)
+    body = (b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+            + b'data' + struct.pack('<I', len(data)) + data)
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def dsf_bytes(payload):
+    payload = max(payload - payload % 8192, 8192)
+    data = b'\x69' * payload
+    fmt = struct.pack('<IIIIIIQII', 1, 0, 2, 2, 2822400, 1, payload * 8 // 2, 4096, 0)
+    fmt_chunk = b'fmt ' + struct.pack('<Q', 12 + len(fmt)) + fmt
+    data_chunk = b'data' + struct.pack('<Q', 12 + payload) + data
+    total = 28 + len(fmt_chunk) + len(data_chunk)
+    return b'DSD ' + struct.pack('<QQQ', 28, total, 0) + fmt_chunk + data_chunk
+
+
+def atom(name, data):
+    return struct.pack('>I', 8 + len(data)) + name + data
+
+
+def m4a_bytes(payload):
+    mvhd = atom(b'mvhd', b'\0' * 4 + struct.pack('>IIII', 0, 0, 1000, 5000) + b'\0' * 80)
+    mdhd = atom(b'mdhd', b'\0' * 4 + struct.pack('>IIII', 0, 0, 44100, 44100 * 5) + b'\0' * 4)
+    hdlr = atom(b'hdlr', b'\0' * 8 + b'soun' + b'\0' * 13)
+    trak = atom(b'trak', atom(b'mdia', mdhd + hdlr))
+    return (atom(b'ftyp', b'M4A \0\0\0\0M4A mp42isom') + atom(b'moov', mvhd + trak)
+            + atom(b'mdat', b'\0' * payload))
+
+
+audio_bytes_map = {'flac': flac_bytes,
+                   'mp3': mp3_bytes,
+                   'm4a': m4a_bytes,
+                   'dsf': dsf_bytes,
+                   'wav': wav_bytes,
+                   }
+
+
+def tag_flac(filename, album, band, year, title, performer, track_num, total, cover):
+    from mutagen.flac import FLAC, Picture
+    audio = FLAC(filename)
+    audio["ALBUM"] = [album]
+    audio['ALBUMARTIST'] = [band]
+    audio['ARTIST'] = [performer]
+    audio["DATE"] = [year]
+    audio["TITLE"] = [title]
+    audio["TRACKNUMBER"] = [str(track_num)]
+    audio["TRACKTOTAL"] = [str(total)]
+    if cover:
+        picture = Picture()
+        picture.type = 3
+        picture.mime = 'image/jpeg'
+        picture.data = cover
+        audio.add_picture(picture)
+    audio.save()
+
+
+def tag_id3(audio, album, band, year, title, performer, track_num, total, cover, v2_version=4):
+    from mutagen.id3 import TIT2, TALB, TRCK, TPE1, TDRC, TPE2, APIC
+    if audio.tags is None:
+        audio.add_tags()
+    audio['TIT2'] = TIT2(encoding=3 if v2_version == 4 else 1, text=[title])
+    audio['TPE1'] = TPE1(encoding=3 if v2_version == 4 else 1, text=[performer])
+    audio['TPE2'] = TPE2(encoding=3 if v2_version == 4 else 1, text=[band])
+    audio['TRCK'] = TRCK(encoding=0, text=[f'{track_num}/{total}'])
+    audio['TALB'] = TALB(encoding=3 if v2_version == 4 else 1, text=[album])
+    audio['TDRC'] = TDRC(encoding=0, text=[year])
+    if cover:
+        audio.tags.add(APIC(encoding=0, mime='image/jpeg', type=3, desc='', data=cover))
+    audio.save(v2_version=v2_version)
+
+
+def tag_mp3(filename, album, band, year, title, performer, track_num, total, cover, v2_version=4):
+    from mutagen.mp3 import MP3
+    tag_id3(MP3(filename), album, band, year, title, performer, track_num, total, cover, v2_version)
+
+
+def tag_dsf(filename, album, band, year, title, performer, track_num, total, cover):
+    from mutagen.dsf import DSF
+    audio = DSF(filename)
+    if audio.tags is None:
+        audio.add_tags()
+    tag_id3(audio, album, band, year, title, performer, track_num, total, cover)
+
+
+def tag_wav(filename, album, band, year, title, performer, track_num, total, cover):
+    from mutagen.wave import WAVE
+    tag_id3(WAVE(filename), album, band, year, title, performer, track_num, total, cover)
+
+
+def tag_m4a(filename, album, band, year, title, performer, track_num, total, cover):
+    from mutagen.mp4 import MP4, MP4Cover
+    audio = MP4(filename)
+    if audio.tags is None:
+        audio.add_tags()
+    audio["\xa9nam"] = [title]
+    audio['\xa9ART'] = [performer]
+    audio['aART'] = [band]
+    audio['trkn'] = [(track_num, total)]
+    audio['\xa9alb'] = [album]
+    audio['\xa9day'] = [year]
+    if cover:
+        audio['covr'] = [MP4Cover(cover, imageformat=MP4Cover.FORMAT_JPEG)]
+    audio.save()
+
+
+tag_func_map = {'flac': tag_flac,
+                'mp3': tag_mp3,
+                'm4a': tag_m4a,
+                'dsf': tag_dsf,
+                'wav': tag_wav,
+                }
+
+
+def make_words(rng, words, count):
+    return ' '.join(rng.choice(words) for _ in range(count))
+
+
+def make_cue_text(album, band, year, image_name, songs):
+    lines = [f'REM DATE {year}',
+             f'PERFORMER "{band}"',
+             f'TITLE "{album}"',
+             f'FILE "{image_name}" WAVE']
+    for (idx, (title, performer)) in enumerate(songs):
+        seconds = idx * 200
+        lines.append(f'  TRACK {idx + 1:02d} AUDIO')
+        lines.append(f'    TITLE "{title}"')
+        lines.append(f'    PERFORMER "{performer}"')
+        lines.append(f'    INDEX 01 {seconds // 60:02d}:{seconds % 60:02d}:00')
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def write_album(folder, music, album, band, year, songs, rng, audio_kb, cover):
+    os.makedirs(folder)
+    payload = audio_kb * 1024
+    if music == 'cue':
+        encoding = rng.choice(CUE_ENCODINGS)
+        image_name = f'{band} - {album}.wav'
+        with open(os.path.join(folder, image_name), 'wb') as OUT:
+            OUT.write(wav_bytes(payload * len(songs)))
+        with open(os.path.join(folder, f'{band} - {album}.cue'), 'wb') as OUT:
+            OUT.write(make_cue_text(album, band, year, image_name, songs).encode(encoding))
+        return {'encoding': encoding}
+
+    data = audio_bytes_map[music](payload)
+    v2_version = rng.choice([3, 4])
+    for (idx, (title, performer)) in enumerate(songs):
+        filename = os.path.join(folder, f'{idx + 1:02d} - {title}.{music}')
+        with open(filename, 'wb') as OUT:
+            OUT.write(data)
+        kwargs = {'v2_version': v2_version} if music == 'mp3' else {}
+        tag_func_map[music](filename, album, band, year, title, performer, idx + 1, len(songs),
+                            cover, **kwargs)
+    return {'id3': v2_version} if music == 'mp3' else {}
+
+
+def break_album(folder, music, rng):
+    # damage one file of the album and return a description of the damage.
+    names = sorted(os.listdir(folder))
+    if music == 'cue':
+        cue_name = [name for name in names if name.endswith('.cue')][0]
+        cue_file = os.path.join(folder, cue_name)
+        with open(cue_file, 'rb') as IN:
+            lines = IN.read().split(b'\r\n')
+        with open(cue_file, 'wb') as OUT:
+            OUT.write(b'\r\n'.join(line for line in lines if not line.startswith(b'TITLE')))
+        return f'{cue_name}: no album TITLE'
+
+    victim = rng.choice(names)
+    filename = os.path.join(folder, victim)
+    if music in ['mp3', 'wav', 'dsf'] and rng.random() < 0.5:
+        # keep the header of the tag, drop most of the file.
+        with open(filename, 'r+b') as OUT:
+            OUT.truncate(os.path.getsize(filename) // 8)
+        return f'{victim}: truncated'
+    if music == 'flac':
+        # a FLAC file without ALBUM stops music_tag_loader.py, so damage the magic instead.
+        with open(filename, 'r+b') as OUT:
+            OUT.write(b'JUNK')
+        return f'{victim}: bad magic'
+    with open(filename, 'wb') as OUT:
+        OUT.write(bytes(rng.getrandbits(8) for _ in range(4096)))
+    return f'{victim}: garbage'
+
+
+def generate(outdir, albums, tracks, seed, broken_ratio, audio_kb, cover_kb, cover_ratio, formats):
+    rng = random.Random(seed)
+    cover = bytes(rng.getrandbits(8) for _ in range(cover_kb * 1024)) if cover_kb > 0 else b''
+    os.makedirs(outdir, exist_ok=True)
+    layout = []
+    for n in range(albums):
+        music = formats[n % len(formats)]
+        cjk = rng.random() < 0.5 or music == 'cue'
+        words, names = (CJK_WORDS, CJK_NAMES) if cjk else (LATIN_WORDS, LATIN_NAMES)
+        band = rng.choice(names)
+        # the number keeps the (title, performer) key of every album unique.
+        album = f'{make_words(rng, words, 2)} {n + 1}'
+        year = str(rng.randint(1970, 2020))
+        track_count = rng.randint(max(tracks // 2, 1), tracks + tracks // 2)
+        songs = [(make_words(rng, words, rng.randint(1, 3)),
+                  band if rng.random() < 0.8 else rng.choice(names)) for _ in range(track_count)]
+        folder = os.path.join(outdir, band, f'{year} - {album}')
+        info = write_album(folder, music, album, band, year, songs, rng, audio_kb,
+                           cover if music != 'cue' and rng.random() < cover_ratio else b'')
+        info.update({'folder': os.path.relpath(folder, outdir), 'format': music,
+                     'album': album, 'performer': band, 'songs': len(songs)})
+        if rng.random() < broken_ratio:
+            info['broken'] = break_album(folder, music, rng)
+        layout.append(info)
+
+    with open(os.path.join(outdir, 'library.json'), 'w', encoding='utf8') as OUT:
+        json.dump({'seed': seed, 'albums': layout}, OUT, ensure_ascii=False, indent=1)
+    return layout
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--dir", type=str, required=True,
+                        help="output folder of the library")
+    parser.add_argument("-n", "--albums", type=int, default=100,
+                        help="number of albums. Default to 100.")
+    parser.add_argument("-t", "--tracks", type=int, default=10,
+                        help="average number of tracks per album. Default to 10.")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed. Default to 1.")
+    parser.add_argument("--broken-ratio", type=float, default=0.05,
+                        help="fraction of albums with a damaged file. Default to 0.05.")
+    parser.add_argument("--audio-kb", type=int, default=64,
+                        help="audio payload of each file in KB. Default to 64.")
+    parser.add_argument("--cover-kb", type=int, default=0,
+                        help="size of the embedded cover picture in KB, 0 for none. Default to 0.")
+    parser.add_argument("--cover-ratio", type=float, default=0.5,
+                        help="fraction of tagged albums with a cover picture. Default to 0.5.")
+    parser.add_argument("--formats", type=str, default=','.join(FORMATS),
+                        help=f"comma separated album formats to rotate through. Default to {','.join(FORMATS)}.")
+    parser.add_argument("--clean", default=False, action='store_true',
+                        help="remove the output folder first")
+    args = parser.parse_args()
+
+    formats = [music.strip() for music in args.formats.split(',') if music.strip()]
+    for music in formats:
+        if music not in FORMATS:
+            parser.error(f'unknown format {music}, choose from {FORMATS}')
+    if args.clean and os.path.isdir(args.dir):
+        shutil.rmtree(args.dir)
+
+    layout = generate(args.dir, args.albums, args.tracks, args.seed, args.broken_ratio,
+                      args.audio_kb, args.cover_kb, args.cover_ratio, formats)
+    songs = sum(info['songs'] for info in layout)
+    broken = sum(1 for info in layout if 'broken' in info)
+    print(f'Generated {len(layout)} albums with {songs} songs in {args.dir}, {broken} with a damaged file.')
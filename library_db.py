@@ -0,0 +1,288 @@
+import os
+import time
+import sqlite3
+import logging
+from collections import deque
+
+from folder_manifest import MANIFEST_SCHEMA, MANIFEST_INSERT, MANIFEST_DELETE, manifest_row
+from library_search import ensure_search_index, index_albums
+
+logger = logging.getLogger('tag_loader')
+
+ALBUMS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS albums (
+    title TEXT,
+    performer TEXT,
+    release_date TEXT,
+    seq INTEGER,
+    performer_zh TEXT,
+    path TEXT,
+    rating INTEGER
+)
+'''
+
+SONGS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS songs (
+    title TEXT,
+    performer TEXT,
+    seq TEXT,
+    albumid INTEGER,
+    rating INTEGER
+)
+'''
+
+ALBUM_INSERT = "INSERT INTO albums(title, performer, release_date, seq, performer_zh, path) VALUES (?,?,?,?,?,?)"
+SONG_INSERT = "INSERT INTO songs(title, performer, seq, albumid) VALUES (?,?,?,?)"
+# performer_zh and rating are edited by hand and kept.
+ALBUM_UPDATE = "UPDATE albums SET title=?, performer=?, release_date=?, path=? WHERE seq=?"
+SONGS_SELECT = "SELECT rowid, title, performer, seq FROM songs WHERE albumid=? ORDER BY rowid"
+SONG_UPDATE = "UPDATE songs SET title=?, performer=? WHERE rowid=?"
+SONG_DELETE = "DELETE FROM songs WHERE rowid=?"
+ALBUM_PATH_UPDATE = "UPDATE albums SET path=? WHERE path=?"
+# tables of other tools keyed by the path of a music file, kept current when a folder moves.
+FILE_PATH_TABLES = ['audio_hashes', 'wav_checks']
+
+
+def connect(sqlitefile, check_same_thread=True):
+    conn = sqlite3.connect(sqlitefile, check_same_thread=check_same_thread)
+    # WAL lets readers keep querying the library while a scan is writing.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
+    return conn
+
+
+def ensure_schema(conn):
+    conn.execute(ALBUMS_SCHEMA)
+    conn.execute(SONGS_SCHEMA)
+    conn.execute(MANIFEST_SCHEMA)
+    # let the DB enforce the same album identity as the in-memory index.
+    try:
+        conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS albums_title_performer ON albums(title, performer)")
+    except sqlite3.IntegrityError as e:
+        logger.error(e)
+        for row in conn.execute("select title, performer, group_concat(seq) from albums group by title, performer having count(*) > 1"):
+            logger.error(f"Duplicated album in DB: {row}")
+    conn.execute("CREATE INDEX IF NOT EXISTS songs_albumid ON songs(albumid)")
+    conn.execute("CREATE INDEX IF NOT EXISTS albums_seq ON albums(seq)")
+    conn.commit()
+    return ensure_search_index(conn)
+
+
+def diff_songs(stored, fresh, albumid):
+    '''
+    stored are [(rowid, title, performer, seq), ...] from the DB, fresh are
+    [(title, performer, seq), ...] just read for album albumid. The n-th stored song
+    of a track seq is matched with the n-th fresh one, so a box set whose
+    track numbers restart on every disc still pairs up.
+    Returns (updates, inserts, deletes, unchanged count).
+    '''
+    by_seq = {}
+    for row in stored:
+        by_seq.setdefault(str(row[3]), deque()).append(row)
+    updates = []
+    inserts = []
+    unchanged = 0
+    for song in fresh:
+        matches = by_seq.get(str(song[2]))
+        if not matches:
+            inserts.append(song + (albumid,))
+            continue
+        (rowid, title, performer, seq) = matches.popleft()
+        if title == song[0] and performer == song[1]:
+            unchanged += 1
+        else:
+            # rating of the row is kept.
+            updates.append((song[0], song[1], rowid))
+    deletes = [(row[0],) for matches in by_seq.values() for row in matches]
+    return updates, inserts, deletes, unchanged
+
+
+class LibraryWriter:
+    '''
+    Keeps one connection open and writes album, song and manifest rows in batches.
+    Rows are committed at folder boundaries once batch_size rows are pending,
+    so a crash loses at most the last batch and never half of a folder.
+
+    With queue_size > 0 the batches are committed by a writer thread that owns
+    the connection. At most queue_size batches wait for it; after that
+    end_folder() blocks, so a slow disk holds back the scan instead of
+    letting the pending rows grow.
+    '''
+
+    def __init__(self, sqlitefile, batch_size=1000, metrics=None, queue_size=0):
+        # the schema is created here, before the caller loads the album index.
+        self.conn = connect(sqlitefile, check_same_thread=queue_size <= 0)
+        # False when SQLite has no FTS5, see library_search.py
+        self.search_index = ensure_schema(self.conn)
+        self.batch_size = batch_size
+        # optional ScanMetrics, gets the time of every commit
+        self.metrics = metrics
+        self.albums = []
+        self.album_updates = []
+        self.songs = []
+        self.song_syncs = []
+        self.manifest = []
+        self.manifest_deletes = []
+        self.folder_moves = []
+        self.file_moves = []
+        self.album_count = 0
+        # rows of the albums whose songs were synced
+        self.sync_counts = {'albums': 0, 'unchanged': 0, 'changed': 0, 'inserted': 0, 'removed': 0}
+        self.song_count = 0
+        self.move_count = 0
+        self.commit_count = 0
+        self.write_seconds = 0.0
+        self.started = time.perf_counter()
+        self.queue = None
+        self.thread = None
+        self.error = None
+        if queue_size > 0:
+            import queue
+            import threading
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self.write_loop, name='library-writer', daemon=True)
+            self.thread.start()
+
+    def add_album(self, row):
+        # row is [title, performer, release_date, seq, performer_zh, path]
+        self.albums.append(row)
+
+    def add_songs(self, albumid, rows):
+        # rows are [(title, performer, seq), ...] as read_folder() returns them,
+        # albumid is added when they are written instead of copying every row.
+        self.songs.append((albumid, rows))
+
+    def update_album(self, seq, row):
+        # row is [title, performer, release_date, path]
+        self.album_updates.append(list(row) + [seq])
+
+    def sync_songs(self, seq, rows):
+        # the songs of album seq in the DB become rows, [(title, performer, seq), ...],
+        # touching only the rows that differ.
+        self.song_syncs.append((seq, rows))
+
+    def add_manifest(self, path, fingerprint, entries):
+        self.manifest.append(manifest_row(path, fingerprint, entries))
+
+    def remove_manifest(self, path):
+        self.manifest_deletes.append((path,))
+
+    def move_folder(self, old_root, root, fingerprint, entries):
+        # the folder was moved or renamed: only paths change, its album keeps seq and songs.
+        self.folder_moves.append((root, old_root))
+        self.file_moves.extend((os.path.join(root, entry[0]), os.path.join(old_root, entry[0]))
+                               for entry in entries)
+        self.remove_manifest(old_root)
+        self.add_manifest(root, fingerprint, entries)
+
+    def pending(self):
+        return (len(self.albums) + len(self.album_updates)
+                + sum(len(rows) for (seq, rows) in self.songs)
+                + sum(len(rows) for (seq, rows) in self.song_syncs)
+                + len(self.manifest) + len(self.manifest_deletes) + len(self.folder_moves))
+
+    def end_folder(self):
+        if self.pending() >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error
+        if self.pending() == 0:
+            return
+        batch = (self.albums, self.album_updates, self.songs, self.song_syncs,
+                 self.manifest_deletes, self.manifest, self.folder_moves, self.file_moves)
+        self.albums = []
+        self.album_updates = []
+        self.songs = []
+        self.song_syncs = []
+        self.manifest = []
+        self.manifest_deletes = []
+        self.folder_moves = []
+        self.file_moves = []
+        if self.queue is None:
+            self.write(batch)
+        else:
+            self.queue.put(batch)
+
+    def write(self, batch):
+        (albums, album_updates, songs, song_syncs, manifest_deletes, manifest, folder_moves, file_moves) = batch
+        started = time.perf_counter()
+        # the batch holds whole folders and is one transaction, so is every album sync.
+        with self.conn:
+            self.conn.executemany(ALBUM_INSERT, albums)
+            self.conn.executemany(ALBUM_UPDATE, album_updates)
+            self.conn.executemany(SONG_INSERT, (song + (albumid,) for (albumid, rows) in songs for song in rows))
+            for (seq, rows) in song_syncs:
+                self.sync_album_songs(seq, rows)
+            self.conn.executemany(MANIFEST_DELETE, manifest_deletes)
+            self.conn.executemany(MANIFEST_INSERT, manifest)
+            if len(folder_moves) > 0:
+                self.move_paths(folder_moves, file_moves)
+            if self.search_index:
+                # album rows are [title, performer, release_date, seq, ...], updates end with seq.
+                index_albums(self.conn, sorted({row[3] for row in albums} | {row[-1] for row in album_updates}
+                                               | {seq for (seq, rows) in songs} | {seq for (seq, rows) in song_syncs}))
+        elapsed = time.perf_counter() - started
+        self.write_seconds += elapsed
+        if self.metrics is not None:
+            self.metrics.record('db', 'sqlite', elapsed)
+        self.commit_count += 1
+        self.album_count += len(albums)
+        self.song_count += sum(len(rows) for (albumid, rows) in songs)
+
+    def move_paths(self, folder_moves, file_moves):
+        self.conn.executemany(ALBUM_PATH_UPDATE, folder_moves)
+        tables = {name for (name,) in self.conn.execute("select name from sqlite_master where type='table'")}
+        for table in FILE_PATH_TABLES:
+            if table in tables:
+                self.conn.executemany(f"UPDATE {table} SET path=? WHERE path=?", file_moves)
+        self.move_count += len(folder_moves)
+
+    def sync_album_songs(self, seq, rows):
+        stored = self.conn.execute(SONGS_SELECT, (seq,)).fetchall()
+        (updates, inserts, deletes, unchanged) = diff_songs(stored, rows, seq)
+        self.conn.executemany(SONG_UPDATE, updates)
+        self.conn.executemany(SONG_INSERT, inserts)
+        self.conn.executemany(SONG_DELETE, deletes)
+        self.sync_counts['albums'] += 1
+        self.sync_counts['unchanged'] += unchanged
+        self.sync_counts['changed'] += len(updates)
+        self.sync_counts['inserted'] += len(inserts)
+        self.sync_counts['removed'] += len(deletes)
+
+    def write_loop(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                # keep draining so the scan does not block on a full queue.
+                continue
+            try:
+                self.write(batch)
+            except Exception as e:
+                logger.error(e)
+                self.error = e
+
+    def close(self):
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        self.conn.close()
+        if self.error is not None:
+            raise self.error
+        rows = self.album_count + self.song_count
+        rate = rows / self.write_seconds if self.write_seconds > 0 else 0
+        print(f'Inserted {self.album_count} albums and {self.song_count} songs in {self.commit_count} commits, '
+              f'{self.write_seconds:.2f}s in DB ({rate:.0f} rows/s), {time.perf_counter() - self.started:.2f}s total.')
+        if self.move_count > 0:
+            print(f'Updated the paths of {self.move_count} moved folders.')
+        if self.sync_counts['albums'] > 0:
+            counts = self.sync_counts
+            print(f"Songs of {counts['albums']} existing albums: {counts['unchanged']} unchanged, "
+                  f"{counts['changed']} changed, {counts['inserted']} inserted, {counts['removed']} removed.")
@@ -0,0 +1,188 @@
+import re
+import time
+import sqlite3
+import argparse
+import logging
+import unicodedata
+
+logger = logging.getLogger('tag_loader')
+
+'''
+Full text search over album and song titles and performers.
+
+LibraryWriter keeps two FTS5 tables current as it writes: albums_fts, whose
+rowid is the album seq, and songs_fts, whose rowid is albumid * SONG_SLOTS +
+the position of the song in its album, in rowid order. songs has no INTEGER
+PRIMARY KEY, so VACUUM may renumber its rowids, but it keeps their order;
+track numbers are no key either, box sets restart them on every disc. An
+album is indexed again whenever its songs change.
+The text is stored folded by search_text(): NFKC, case folded, and every run
+of CJK characters split into overlapping bigrams plus its last character, so
+"何日君再來" is indexed as "何日 日君 君再 再來 來". A query is folded the
+same way and each of its words becomes a phrase, so any part of a Chinese
+title of two or more characters matches, and one character matches as a
+prefix. Latin words match as prefixes too. Matches are ranked by bm25.
+
+    python library_search.py -s library.db 鄧麗君 甜蜜蜜
+    python library_search.py -s library.db --rebuild
+
+--rebuild indexes the whole DB again, after the tables were edited by hand.
+'''
+
+ALBUMS_FTS_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS albums_fts USING fts5(title, performer, performer_zh)"
+SONGS_FTS_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(title, performer)"
+
+ALBUM_FTS_INSERT = "INSERT OR REPLACE INTO albums_fts(rowid, title, performer, performer_zh) VALUES (?,?,?,?)"
+SONG_FTS_INSERT = "INSERT INTO songs_fts(rowid, title, performer) VALUES (?,?,?)"
+SONG_FTS_DELETE = "DELETE FROM songs_fts WHERE rowid >= ? AND rowid < ?"
+# songs_fts rowids reserved per album
+SONG_SLOTS = 1 << 20
+
+ALBUMS_QUERY = '''
+SELECT a.seq, a.title, a.performer, a.release_date, a.path, bm25(albums_fts, 2.0, 1.0, 1.0)
+FROM albums_fts JOIN albums a ON a.seq = albums_fts.rowid
+WHERE albums_fts MATCH ? ORDER BY rank LIMIT ?
+'''
+SONGS_QUERY = "SELECT rowid, bm25(songs_fts, 2.0, 1.0) FROM songs_fts WHERE songs_fts MATCH ? ORDER BY rank LIMIT ?"
+# the song at a position of its album, see song_rows()
+SONG_AT = '''
+SELECT s.title, s.performer, s.seq, a.seq, a.title, a.path
+FROM songs s JOIN albums a ON a.seq = s.albumid
+WHERE s.albumid = ? ORDER BY s.rowid LIMIT 1 OFFSET ?
+'''
+ALBUM_SONGS = "select title, performer from songs where albumid=? order by rowid"
+
+# Han, kana, hangul and the CJK symbols between them.
+CJK_RUN = re.compile('[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+')
+
+
+def cjk_tokens(run):
+    if len(run) == 1:
+        return run
+    return ' '.join([run[idx:idx + 2] for idx in range(len(run) - 1)] + [run[-1]])
+
+
+def search_text(text):
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    return CJK_RUN.sub(lambda match: f' {cjk_tokens(match.group())} ', text)
+
+
+def match_query(query):
+    # every word of the query is a phrase of its folded tokens, all of them must match.
+    phrases = []
+    for word in query.split():
+        tokens = [token for token in re.split(r'[^\w]+', search_text(word)) if token != '']
+        if len(tokens) == 0:
+            continue
+        last = tokens[-1]
+        if CJK_RUN.fullmatch(last) and len(tokens) > 1 and len(last) == 1:
+            # the final character is already the second half of the last bigram.
+            tokens = tokens[:-1]
+        phrase = '"' + ' '.join(tokens) + '"'
+        if not CJK_RUN.fullmatch(tokens[-1]) or len(tokens[-1]) == 1:
+            phrase += '*'
+        phrases.append(phrase)
+    return ' AND '.join(phrases)
+
+
+def ensure_search_index(conn):
+    # returns False when this SQLite has no FTS5, the library then works without the index.
+    try:
+        conn.execute(ALBUMS_FTS_SCHEMA)
+        conn.execute(SONGS_FTS_SCHEMA)
+    except sqlite3.OperationalError as e:
+        logger.error(f'No search index: {e}')
+        return False
+    rebuild = False
+    if [row[1] for row in conn.execute("PRAGMA table_info(songs_fts)")] != ['title', 'performer']:
+        # an index of an older layout, keyed on the songs rowid or on the track number.
+        conn.execute("DROP TABLE songs_fts")
+        conn.execute(SONGS_FTS_SCHEMA)
+        rebuild = True
+    if conn.execute("select count(*) from albums_fts").fetchone()[0] == 0 \
+            and conn.execute("select count(*) from albums").fetchone()[0] > 0:
+        rebuild = True
+    if rebuild:
+        print('Building the search index of the existing albums.')
+        rebuild_index(conn)
+    return True
+
+
+def song_rows(seq, songs):
+    # songs_fts rows of the songs [(title, performer)] of album seq, in rowid order.
+    return [(seq * SONG_SLOTS + idx, search_text(title), search_text(performer))
+            for (idx, (title, performer)) in enumerate(songs)]
+
+
+def index_albums(conn, seqs):
+    # (re)index the albums and the songs of the given seqs.
+    for seq in seqs:
+        row = conn.execute("select title, performer, performer_zh from albums where seq=?", (seq,)).fetchone()
+        if row is None:
+            continue
+        conn.execute(ALBUM_FTS_INSERT, (seq,) + tuple(search_text(text) for text in row))
+        conn.execute(SONG_FTS_DELETE, (seq * SONG_SLOTS, (seq + 1) * SONG_SLOTS))
+        conn.executemany(SONG_FTS_INSERT, song_rows(seq, conn.execute(ALBUM_SONGS, (seq,)).fetchall()))
+
+
+def rebuild_index(conn):
+    started = time.perf_counter()
+    with conn:
+        conn.execute("DELETE FROM albums_fts")
+        conn.execute("DELETE FROM songs_fts")
+        conn.executemany(ALBUM_FTS_INSERT, (
+            (seq, search_text(title), search_text(performer), search_text(performer_zh))
+            for (seq, title, performer, performer_zh) in conn.execute(
+                "select seq, title, performer, performer_zh from albums where seq is not null")))
+        for (seq,) in conn.execute("select distinct albumid from songs where albumid is not null").fetchall():
+            conn.executemany(SONG_FTS_INSERT, song_rows(seq, conn.execute(ALBUM_SONGS, (seq,)).fetchall()))
+        conn.execute("INSERT INTO albums_fts(albums_fts) VALUES ('optimize')")
+        conn.execute("INSERT INTO songs_fts(songs_fts) VALUES ('optimize')")
+    print(f'Indexed the albums and songs in {time.perf_counter() - started:.2f}s.')
+
+
+def search(conn, query, limit=20):
+    # returns (albums, songs): [(seq, title, performer, release_date, path, score)] and
+    # [(title, performer, track, album seq, album title, album path, score)], best first.
+    expression = match_query(query)
+    if expression == '':
+        return [], []
+    albums = conn.execute(ALBUMS_QUERY, (expression, limit)).fetchall()
+    songs = []
+    for (rowid, score) in conn.execute(SONGS_QUERY, (expression, limit)).fetchall():
+        row = conn.execute(SONG_AT, divmod(rowid, SONG_SLOTS)).fetchone()
+        if row is not None:
+            songs.append(row + (score,))
+    return albums, songs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("query", nargs='*',
+                        help="words to find in album and song titles and performers")
+    parser.add_argument("-s", "--sqlite", type=str, required=True,
+                        help="path to sqlite3 db file")
+    parser.add_argument("-n", "--limit", type=int, default=20,
+                        help="number of albums and of songs to show. Default to 20.")
+    parser.add_argument("--rebuild", default=False, action='store_true',
+                        help="whether to index the whole DB again")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    from library_db import connect, ensure_schema
+    conn = connect(args.sqlite)
+    ensure_schema(conn)
+    if args.rebuild:
+        rebuild_index(conn)
+    if len(args.query) > 0:
+        started = time.perf_counter()
+        (albums, songs) = search(conn, ' '.join(args.query), args.limit)
+        elapsed = time.perf_counter() - started
+        for (seq, title, performer, release_date, path, score) in albums:
+            print(f'album {seq:>6} {title} / {performer} ({release_date}) {path}')
+        for (title, performer, track, album_seq, album_title, path, score) in songs:
+            print(f'song  {album_seq:>6} {track:>3} {title} / {performer} [{album_title}] {path}')
+        print(f'{len(albums)} albums and {len(songs)} songs in {elapsed * 1000:.1f} ms.')
+    conn.close()
@@ -1,25 +1,28 @@
 import sqlite3
 import argparse
 import os
-import re
+import sys
+import time
+import queue
 import logging
-import pandas as pd
-import pprint
-
-from mutagen.flac import FLAC
-from mutagen.apev2 import APEv2File
-from mutagen.mp3 import MP3
-from mutagen.wave import WAVE
-from mutagen.wavpack import WavPack
-from mutagen.dsdiff import DSDIFF
-from mutagen.dsf import DSF
-from mutagen.mp4 import MP4
-# import mutagen
+import threading
+from collections import deque
+
+from folder_manifest import folder_fingerprint, loose_fingerprint, load_manifest, load_move_index
+from folder_walker import walk_folders
+from bounded_pool import bounded_map
+from library_db import LibraryWriter
+from scan_metrics import ScanMetrics
+from fast_tags import fast_func_map, read_tags
+from cue_sheet import load_cue_sheet, CueParseError
+# mutagen format modules are imported by the readers on first use, so a rescan
+# that opens no music file does not pay for them.
 
 logger = logging.getLogger('tag_loader')
 
 
 def get_mp4_meta(filename):
+    from mutagen.mp4 import MP4
     audio = MP4(filename)
     logger.debug(audio.tags)
     if audio.tags is None:  # corrupted file. Skip.        
@@ -63,6 +66,7 @@ def get_mp4_metadata(audio):
 
 
 def get_wav_meta(filename):
+    from mutagen.wave import WAVE
     audio = WAVE(filename)
     logger.debug(audio.tags)
     if audio.tags is None:  # corrupted file. Skip.
@@ -71,6 +75,7 @@ def get_wav_meta(filename):
 
 
 def get_mp3_meta(filename):
+    from mutagen.mp3 import MP3
     audio = MP3(filename)
     logger.debug(audio.tags)
     if audio.tags is None:  # corrupted file. Skip.
@@ -79,6 +84,7 @@ def get_mp3_meta(filename):
 
 
 def get_dff_meta(filename):
+    from mutagen.dsdiff import DSDIFF
     audio = DSDIFF(filename)
     logger.debug(audio.tags)
     if audio.tags is None:  # corrupted file. Skip.
@@ -87,6 +93,7 @@ def get_dff_meta(filename):
 
 
 def get_dsf_meta(filename):
+    from mutagen.dsf import DSF
     audio = DSF(filename)
     logger.debug(audio.tags)
     if audio.tags is None:  # corrupted file. Skip.
@@ -130,12 +137,14 @@ def get_mp3_id3_metadata(audio):
 
 
 def get_flac_meta(filename):
+    from mutagen.flac import FLAC
     audio = FLAC(filename)
     logger.debug(audio.tags)
     return get_metadata(audio)
 
 
 def get_ape_meta(filename):
+    from mutagen.apev2 import APEv2File
     audio = APEv2File(filename)
     logger.debug(audio.tags)
     return get_metadata(audio)
@@ -179,111 +188,16 @@ def get_metadata(audio):
 
 
 def parse_cue(filename):
-    album = ""
-    performer = ""
-    year = ""
-    encodings = ['utf8', 'gbk', 'big5']
-    err_str_list = []
-    song_list = []
-    for encoding in encodings:
-        with open(filename, 'r', encoding=encoding) as IN:
-            '''
-            REM DATE 1987
-            PERFORMER "Erich Kunzel, CINCINNATI POPS ORCHESTRA"
-            TITLE "Pomp & Pizazz"
-            FILE "Erich Kunzel, CINCINNATI POPS ORCHESTRA - Pomp & Pizazz.wav" WAVE
-              TRACK 01 AUDIO
-                TITLE "Olympic Fanfare"
-                PERFORMER "Williams, John"
-                INDEX 01 00:00:00
-              TRACK 02 AUDIO
-                TITLE "Towards a New Life, Op.35c"
-                PERFORMER "Suk, Josef"
-                INDEX 00 04:21:00
-                INDEX 01 04:22:32
-            '''
-            '''
-            Another cue format
-            FILE "01 - Call My Name.flac" WAVE
-                TITLE "Call My Name"
-                TRACK 01 AUDIO
-                INDEX 01 00:00:00
-            FILE "02 - Crazy Chick.flac" WAVE
-                TITLE "Crazy Chick"
-                TRACK 02 AUDIO
-                INDEX 01 00:00:00 
-            '''
-
-            line = "dummy line"
-            try:
-                song_idx = -1
-                song_performer = None
-                indexed = False
-                for line in IN.readlines():
-                    logger.debug(line.strip())
-                    match = re.match(r"^REM DATE\s+(.*)", line,
-                                     flags=re.IGNORECASE)
-                    if match:
-                        year = match.group(1)
-                        continue
-
-                    match = re.match(r"^PERFORMER\s+(.*)",
-                                     line, flags=re.IGNORECASE)
-                    if match:
-                        performer = match.group(1).replace("\"", "")
-                        continue
-
-                    match = re.match(r"^TITLE\s+\"(.*)\"",
-                                     line, flags=re.IGNORECASE)
-                    if match:
-                        album = match.group(1)
-
-                    match = re.match(r"^\s*TRACK\s+(\d+)\s+AUDIO",
-                                     line, flags=re.IGNORECASE)
-                    if match:
-                        indexed = False
-                        song_idx = (int)(match.group(1))
-
-                    match = re.match(r"^\s+TITLE\s+\"(.*)\"",
-                                     line, flags=re.IGNORECASE)
-                    if song_idx >= 0 and match:
-                        song_title = match.group(1)
-
-                    match = re.match(r"^\s+PERFORMER\s+(.*)",
-                                     line, flags=re.IGNORECASE)
-                    if song_idx >= 0 and match:
-                        song_performer = match.group(1).replace("\"", "")
-
-                    # a track can have two index lines. so we need skip the second index line.
-                    match = re.match(
-                        r"^\s+INDEX\s+\d+\s+(\d+):(\d+):(\d+)", line, flags=re.IGNORECASE)
-                    if match and not indexed:  # we are done with current song.
-                        indexed = True
-                        if song_performer is None:
-                            song_performer = performer
-                        song_list.append(
-                            (song_title.strip(), song_performer.strip(), song_idx))
-                        song_performer = None
-
-                # all lines parsed. break out of loop
-                break
-
-            except UnicodeDecodeError as e:
-                # need change to GBK encoding.
-                # fallback to second encoding value.
-                logger.error(e)
-                logger.error(line)
-                err_str_list.append(str(e))
+    try:
+        sheet = load_cue_sheet(filename)
+    except CueParseError as e:
+        # fall back to the tags of the music files in the folder.
+        logger.error(e)
+        return None
 
+    song_list = sheet.songs()
     logger.debug(song_list)
-    if len(album) == 0:
-        logger.error("Cannot find album name!")
-        logger.error(os.path.join(os.getcwd(), filename))
-        logger.error((album, performer, year))
-        logger.error("\n".join(err_str_list))
-        exit(1)
-
-    return (album.strip(), performer.strip(), year.strip(), song_list)
+    return (sheet.title.strip(), sheet.performer.strip(), sheet.date.strip(), song_list)
 
 
 music_func_map = {"flac": get_flac_meta,
@@ -298,10 +212,12 @@ music_func_map = {"flac": get_flac_meta,
                   }
 
 
-def handle_music_file(filename, root, music, max_seq, albums):
+def handle_music_file(filename, root, music, fast_tags=False):
     fullpath = os.path.join(root, filename)
     logger.debug(f'{music}: {fullpath}')
-    result_tuple = (music_func_map[music])(filename)
+    if fast_tags and music in fast_func_map:
+        return read_tags(fullpath, music, music_func_map[music])
+    result_tuple = (music_func_map[music])(fullpath)
     return result_tuple
 
 
@@ -309,125 +225,343 @@ def get_file_surfix(filename):
     return filename.split('.')[-1].lower()
 
 
-def get_albums(baseroot, max_seq, albums, recrawl_songs):
-    print(baseroot)
-
-    new_album_list = []
-    new_song_list = []
-    for (root, dirs, files) in os.walk(baseroot, topdown=True):
-        # print(root) full path to a folder
-        # print(dirs) subfolders within root
-        # print(files) files within root
-        os.chdir(root)
-        logger.debug(root)
-        # root is the path to the album
-        no_cue = True
-        result_tuple = None
-        album, album_performer, year = "", "", ""
-        song_list = []
-        cue_count = 0
+def is_mutagen_error(e):
+    # mutagen is already loaded when one of its readers raised.
+    from mutagen import MutagenError
+    return isinstance(e, MutagenError)
+
+
+def read_folder(root, files, fast_tags=False, stats=None):
+    # Read album info of one folder. This runs in worker processes when --jobs > 1,
+    # so it must not touch shared state and only returns plain tuples:
+    # (album, album_performer, year, [(song_title, song_performer, song_index), ...])
+    # stats, if given, gets a (stage, format, filename, seconds, error) tuple per file read.
+    logger.debug(root)
+    # root is the path to the album
+    result_tuple = None
+    album, album_performer, year = "", "", ""
+    song_list = []
+    cue_count = 0
+    for filename in files:
+        logger.info(filename)
+        surfix = get_file_surfix(filename)
+        if surfix == 'cue':
+            started = time.perf_counter()
+            result_tuple = handle_music_file(filename, root, 'cue')
+            if stats is not None:
+                stats.append(('cue', 'cue', filename, time.perf_counter() - started, result_tuple is None))
+            if result_tuple is not None:
+                # here I want to continue the check to see if there is another CUE file in the same folder.
+                cue_count += 1
+
+    if cue_count > 1:
+        logger.error(
+            f"More than one cue file found in {root}. =-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=!!!!!!")
+
+    if result_tuple is None:
         for filename in files:
-            logger.info(filename)
             surfix = get_file_surfix(filename)
-            if surfix == 'cue':
+            if surfix not in ['flac', 'ape', 'mp3', 'wav', 'dff', 'dsf', 'mp4', 'm4a']:
+                continue
+            started = time.perf_counter()
+            error = False
+            try:
                 result_tuple = handle_music_file(
-                    filename, root, 'cue', max_seq, albums)
-                if result_tuple is not None:
-                    # here I want to continue the check to see if there is another CUE file in the same folder.
-                    cue_count += 1
+                    filename, root, surfix, fast_tags)
+            except KeyError as e:
+                logger.error(e)
+                logger.error(f'{root}//{filename}')
+                exit(1)
+            except Exception as e:
+                if not is_mutagen_error(e):
+                    raise
+                # broken or truncated file, keep reading the rest of the folder.
+                logger.error(f'{os.path.join(root, filename)}: {e}')
+                result_tuple = None
+                error = True
+            if stats is not None:
+                stats.append(('tag', surfix, filename, time.perf_counter() - started, error))
+            if result_tuple is None:
+                continue
+
+            (album, album_performer, year,
+             song_title, song_performer, song_index) = result_tuple
+            # every track of a box set has the same performer, keep one string of it.
+            song_list.append(
+                (song_title, sys.intern(song_performer), song_index))
+    else:
+        (album, album_performer, year, song_list) = result_tuple
 
-        if cue_count > 1:
+    if len(album) == 0 and len(files) > 1:
+        logger.error(f"No music file found in {root}.")
+        logger.error(files)
+
+    return (album, sys.intern(album_performer), year, song_list)
+
+
+def read_folder_task(task):
+    (root, files, fast_tags) = task
+    stats = []
+    result = read_folder(root, files, fast_tags, stats)
+    return (root, result, stats)
+
+
+def init_worker(level):
+    # with fork start method the worker inherits the configured logger already.
+    if not logger.handlers:
+        logging.basicConfig(level=level)
+
+
+def check_track_ids(song_list, seq):
+    track_ids = set()
+    for song in song_list:
+        if song[-1] in track_ids:
             logger.error(
-                f"More than one cue file found in {root}. =-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=!!!!!!")
+                f"-----------------> {song[-1]} in {seq} is duplicated!")
+        track_ids.add(song[-1])
+
+
+def record_folder_stats(metrics, root, entries, stats):
+    # file sizes come from the stat of the walk, the reader does not stat again.
+    sizes = {entry[0]: entry[1] for entry in entries}
+    read_seconds = 0.0
+    for (stage, music, filename, seconds, error) in stats:
+        metrics.record(stage, music, seconds, sizes.get(filename, 0), error)
+        read_seconds += seconds
+    metrics.folder_read(root, [entry[0] for entry in entries], read_seconds)
+
+
+def root_events(baseroot, manifest, counts, full_scan=False, executor=None, fast_tags=False, metrics=None,
+                walk_threads=4, read_ahead=16, move_index=None, recrawl_songs=False):
+    '''
+    Walks baseroot and reads the folders that changed since the last scan.
+    Yields, in walk order of the folders read:
+        ('moved', root, fingerprint, entries, old_root)
+        ('read', root, fingerprint, entries, (album, album_performer, year, song_list), stats)
+    Unchanged folders are only counted. The manifest is only looked up here,
+    scan_roots() updates it with the album index and the DB, so the roots of
+    one scan can each be walked and read in their own thread.
+    '''
+    # (fingerprint, entries) of the folders being read, in walk order.
+    # A folder goes into the manifest together with its album rows.
+    manifest_updates = deque()
+    # moved folders walked since the last folder read, and the old folders they claimed.
+    moves = deque()
+    claimed = set()
+
+    def moved_from(root, fingerprint, entries):
+        # the manifest folder this new folder was moved from, if it is gone.
+        for key in (fingerprint, loose_fingerprint(entries)):
+            old_root = move_index.get(key)
+            if old_root is not None and old_root != root and old_root in manifest and old_root not in claimed \
+                    and not os.path.isdir(old_root):
+                return old_root
+        return None
 
-        if result_tuple is None:
-            for filename in files:
-                try:
-                    surfix = get_file_surfix(filename)
-                    if surfix in ['flac', 'ape', 'mp3', 'wav', 'dff', 'dsf', 'mp4', 'm4a']:
-                        result_tuple = handle_music_file(
-                            filename, root, surfix, max_seq, albums)
-                        if result_tuple is None:
-                            continue
-
-                        (album, album_performer, year,
-                         song_title, song_performer, song_index) = result_tuple
-                        song_list.append(
-                            (song_title, song_performer, song_index))
-                except KeyError as e:
-                    logger.error(e)
-                    logger.error(f'{root}//{filename}')
-                    exit(1)
+    def folders_to_read():
+        mark = time.perf_counter()
+        # only folders with a music or CUE file, listed ahead by walk_threads threads.
+        for (root, entries) in walk_folders(os.path.abspath(baseroot), walk_threads):
+            files = [entry[0] for entry in entries]
+            fingerprint = folder_fingerprint(entries)
+            old_fingerprint = manifest.get(root)
+            if metrics is not None:
+                now = time.perf_counter()
+                metrics.record('walk', 'folder', now - mark)
+                mark = now
+            if old_fingerprint == fingerprint and not full_scan and not recrawl_songs:
+                # nothing changed in the folder since last scan. With --song every album
+                # folder is read, its songs are compared with the DB.
+                counts['skipped'] += 1
+                if metrics is not None:
+                    metrics.folder_done(skipped=True)
+                continue
+            if old_fingerprint is None and move_index and not full_scan:
+                old_root = moved_from(root, fingerprint, entries)
+                if old_root is not None:
+                    # same files as a folder that is gone: update the paths, open no file.
+                    claimed.add(old_root)
+                    moves.append(('moved', root, fingerprint, entries, old_root))
+                    continue
+            if old_fingerprint is None:
+                counts['new'] += 1
+            elif old_fingerprint == fingerprint:
+                # read only because of --full or --song.
+                counts['unchanged'] += 1
+            else:
+                counts['reread'] += 1
+            manifest_updates.append((fingerprint, entries))
+            yield (root, files, fast_tags)
+            mark = time.perf_counter()
+
+    # Each stage pulls from the one before it: the walker lists a few folders ahead,
+    # the readers work on at most read_ahead folders, and the writer blocks
+    # end_folder() when its queue is full. Rows reach the DB folder by folder.
+    if executor is None:
+        results = map(read_folder_task, folders_to_read())
+    else:
+        # results come back in walk order no matter which worker finishes first,
+        # so album seq numbers are assigned exactly as in the serial mode.
+        results = bounded_map(executor, read_folder_task, folders_to_read(), read_ahead, chunksize=4)
+
+    for (root, result, stats) in results:
+        while moves:
+            yield moves.popleft()
+        (fingerprint, entries) = manifest_updates.popleft()
+        yield ('read', root, fingerprint, entries, result, stats)
+    while moves:
+        yield moves.popleft()
+
+
+def interleave_roots(streams, queue_size=16):
+    '''
+    Runs every root_events() stream in its own thread and yields (index of the
+    stream, event) round-robin: the first folder read in the first root, the
+    first one of the second root, ..., then the second folder of each root.
+    Moves are passed on as they come. The order only depends on the walk order
+    of each root, never on which disk is faster, so the same roots get the same
+    album seq numbers on every run. A root that is done drops out of the turn.
+    '''
+    queues = [queue.Queue(maxsize=queue_size) for stream in streams]
+
+    def produce(stream, events):
+        try:
+            for event in stream:
+                events.put(event)
+            events.put(None)
+        except BaseException as e:
+            events.put(e)
+
+    for (stream, events) in zip(streams, queues):
+        threading.Thread(target=produce, args=(stream, events), daemon=True).start()
+
+    active = list(enumerate(queues))
+    while active:
+        for (idx, events) in list(active):
+            while True:
+                event = events.get()
+                if event is None:
+                    active.remove((idx, events))
+                    break
+                if isinstance(event, BaseException):
+                    raise event
+                yield (idx, event)
+                if event[0] == 'read':
+                    break
+
+
+def scan_roots(baseroots, max_seq, album_index, recrawl_songs, manifest, writer, full_scan=False, executor=None,
+               fast_tags=False, metrics=None, walk_threads=4, read_ahead=16, move_index=None, parallel=True):
+    # move_index is folder_manifest.load_move_index(), without it moved folders are read again.
+    # With parallel two roots or more are walked and read at the same time, see interleave_roots(),
+    # otherwise one after another. Either way a duplicate album is caught across the roots.
+    # Returns (new albums, new songs, max_seq).
+
+    # paths of the albums added in this run by seq - first_seq - 1, to report duplicated folders.
+    # The seq is in album_index already, a list of references is all it takes.
+    first_seq = max_seq
+    new_album_paths = []
+    for baseroot in baseroots:
+        print(baseroot)
+    root_counts = [{'skipped': 0, 'reread': 0, 'unchanged': 0, 'new': 0, 'moved': 0, 'albums': 0, 'songs': 0, 'recrawled': 0}
+                   for baseroot in baseroots]
+    streams = [root_events(baseroot, manifest, counts, full_scan, executor, fast_tags, metrics, walk_threads,
+                           read_ahead, move_index, recrawl_songs) for (baseroot, counts) in zip(baseroots, root_counts)]
+    if len(streams) == 1 or not parallel:
+        events = ((idx, event) for (idx, stream) in enumerate(streams) for event in stream)
+    else:
+        events = interleave_roots(streams, read_ahead)
+
+    # the album index, the manifest and the writer are only used from here, in the calling thread.
+    for (idx, event) in events:
+        counts = root_counts[idx]
+        if event[0] == 'moved':
+            (kind, root, fingerprint, entries, old_root) = event
+            if old_root in manifest:
+                logger.info(f'{old_root} moved to {root}')
+                counts['moved'] += 1
+                del manifest[old_root]
+                manifest[root] = fingerprint
+                writer.move_folder(old_root, root, fingerprint, entries)
+                if metrics is not None:
+                    metrics.folder_done(skipped=True)
+                continue
+            # a folder of another root took the old folder first, read this one as new.
+            counts['new'] += 1
+            (root, result, stats) = read_folder_task((root, [entry[0] for entry in entries], fast_tags))
         else:
-            (album, album_performer, year, song_list) = result_tuple
-
-        if len(album) == 0 and len(files) > 1:
-            logger.error(f"No music file found in {root}.")
-            logger.error(files)
-        elif len(album) > 0:
+            (kind, root, fingerprint, entries, result, stats) = event
+        (album, album_performer, year, song_list) = result
+        manifest[root] = fingerprint
+        if metrics is not None:
+            record_folder_stats(metrics, root, entries, stats)
+        started = time.perf_counter()
+        song_count = counts['songs']
+        if len(album) > 0:
             # we find album info.
-            # Need check if album exists in albums dataframe.
+            # Need check if album exists in album index.
             # both album title and performaer must match.
-            # if not, add new album to albums dataframe
-
-            existing_album = albums.loc[(albums['title'] == album) & (
-                albums["performer"] == album_performer)]
-            if len(existing_album) == 0:
+            # if not, add new album to albums and to the index
+            # the index lives for the whole scan: with --jobs the strings arrive unpickled
+            # from a worker, share one object per performer across albums.
+            key = (album, sys.intern(album_performer))
+            song_seq = album_index.get(key)
+            if song_seq is None:
                 max_seq += 1
-                # dataframe row is [title, performer, release_date, seq]
-                # add new row to dataframe albums
-                # dataframe has no append() method.
-                new_album_list.append(
-                    [album, album_performer, year, max_seq, album_performer, root])
-
-                # song list is [(song_index, song_title, song_performer), ... )]
-                # need add the album's seq number to the end of tuples.
-                track_ids = []
-                for idx, song in enumerate(song_list):
-                    if song[-1] in track_ids:
-                        logger.error(
-                            f"-----------------> {song[-1]} in {max_seq} is duplicated!")
-                    track_ids.append(song[-1])
-                    song_list[idx] = song + (max_seq,)
-                new_song_list.extend(song_list)
+                album_index[key] = max_seq
+                new_album_paths.append(root)
+                # album row is [title, performer, release_date, seq, performer_zh, path]
+                album_row = [album, album_performer,
+                             year, max_seq, album_performer, root]
+                logger.info(album_row)
+                writer.add_album(album_row)
+                counts['albums'] += 1
+
+                # song list is [(song_title, song_performer, song_index), ... )]
+                # the writer adds the album's seq number when it writes them.
+                check_track_ids(song_list, max_seq)
+                writer.add_songs(max_seq, song_list)
+                counts['songs'] += len(song_list)
+            elif song_seq > first_seq:
+                # the same album was found in another folder during this run, maybe in another root.
+                logger.error(
+                    f"============== Duplicated album {album} {album_performer} {new_album_paths[song_seq - first_seq - 1]} {root}")
             else:
                 # print duplicate album info
                 logger.info("======================================")
-                logger.info(pprint.pformat(existing_album))
+                logger.info(f"{key} exists as album {song_seq}")
                 if recrawl_songs:
-                    song_seq = existing_album['seq']
-                    track_ids = []
-                    for idx, song in enumerate(song_list):
-                        if song[-1] in track_ids:
-                            logger.error(
-                                f"-----------------> {song[-1]} in {song_seq} is duplicated!")
-                        track_ids.append(song[-1])
-                        song_list[idx] = song + (song_seq,)
-                    new_song_list.extend(song_list)
+                    check_track_ids(song_list, song_seq)
+                    # only the rows that differ from the DB are written.
+                    writer.sync_songs(song_seq, song_list)
+                    counts['recrawled'] += 1
                 else:
-                    # the album is already in the albums dataframe, skip the song handling
+                    # the album is already in the albums table, skip the song handling
                     pass
 
-    sorted_album_list = sorted(new_album_list)
-    logger.info(pprint.pformat(sorted_album_list))
-    l_total = len(sorted_album_list)
-    for idx in range(l_total - 1):
-        # [album, album_performer, year, max_seq])
-        if sorted_album_list[idx][0] == sorted_album_list[idx+1][0] and sorted_album_list[idx][1] == sorted_album_list[idx+1][1]:
-            logger.error(
-                f"============== Duplicated album {sorted_album_list[idx][0]} {sorted_album_list[idx][1]} {sorted_album_list[idx+1][-1]} {sorted_album_list[idx][-1]}")
-    # pprint.pprint(sorted(new_song_list, key=lambda x: (x[3], x[2])))
+        if metrics is not None:
+            metrics.record('dedupe', 'folder', time.perf_counter() - started)
 
-    # add new album to albums dataframe
-    new_albums = pd.DataFrame(new_album_list, columns=[
-                              'title', 'performer', 'release_date', 'seq', 'performer_zh', 'path'])
-    # add new songs to songs dataframe
-    new_songs = pd.DataFrame(new_song_list, columns=[
-        'title', 'performer', 'seq', 'albumid'])
+        writer.add_manifest(root, fingerprint, entries)
+        writer.end_folder()
+        if metrics is not None:
+            metrics.folder_done(counts['songs'] - song_count)
+
+    for (baseroot, counts) in zip(baseroots, root_counts):
+        print(
+            f"{baseroot}: skipped {counts['skipped']} unchanged folders, re-read {counts['reread']} changed folders "
+            f"and {counts['unchanged']} unchanged folders, read {counts['new']} new folders, "
+            f"updated {counts['moved']} moved folders.")
+        print(f"{baseroot}: {counts['albums']} new albums, {counts['songs']} songs, "
+              f"songs of {counts['recrawled']} existing albums recrawled.")
+    return sum(counts['albums'] for counts in root_counts), sum(counts['songs'] for counts in root_counts), max_seq
 
-    print(new_albums)
-    print(new_songs)
-    return new_albums, new_songs, max_seq
+
+def get_albums(baseroot, max_seq, album_index, recrawl_songs, manifest, writer, full_scan=False, executor=None,
+               fast_tags=False, metrics=None, walk_threads=4, read_ahead=16, move_index=None):
+    # one root, read in the calling thread.
+    return scan_roots([baseroot], max_seq, album_index, recrawl_songs, manifest, writer, full_scan, executor,
+                      fast_tags, metrics, walk_threads, read_ahead, move_index)
 
 
 '''
@@ -461,12 +595,147 @@ def write_albums(sqlitefile, albums, debug):
 '''
 
 
-def load_albums_to_dataframe(sqlitefile):
-    # load albums from sqlite3 db file into pandas dataframe
+def load_album_index(sqlitefile):
+    # (title, performer) -> seq. Built once; get_albums adds the new albums to it.
+    album_index = {}
+    max_seq = 0
     with sqlite3.connect(sqlitefile) as CONN:
-        albums = pd.read_sql_query("select * from albums", CONN)
-        print(albums)
-        return albums
+        for (title, performer, seq) in CONN.execute("select title, performer, seq from albums order by seq"):
+            album_index.setdefault((title, sys.intern(performer) if performer else performer), seq)
+            max_seq = max(max_seq, seq or 0)
+    CONN.close()
+    print(f'{len(album_index)} albums in DB.')
+    return album_index, max_seq
+
+
+def load_album_paths(sqlitefile):
+    # folder path -> seq of the albums in the DB
+    with sqlite3.connect(sqlitefile) as CONN:
+        album_paths = {path: seq for (seq, path) in CONN.execute(
+            "select seq, path from albums where path is not null order by seq")}
+    CONN.close()
+    return album_paths
+
+
+def upsert_folder(root, result, album_index, album_paths, max_seq, writer):
+    # --watch: the album read from root replaces what the DB has for this folder.
+    # Returns the new max_seq.
+    (album, album_performer, year, song_list) = result
+    if len(album) == 0:
+        return max_seq
+    key = (album, album_performer)
+    seq = album_index.get(key)
+    old_seq = album_paths.get(root)
+    if seq is None and old_seq is not None:
+        # the album tags of the folder changed, keep its seq and rating.
+        for (old_key, value) in list(album_index.items()):
+            if value == old_seq:
+                del album_index[old_key]
+        album_index[key] = old_seq
+        seq = old_seq
+    elif seq is None:
+        max_seq += 1
+        album_index[key] = max_seq
+        album_paths[root] = max_seq
+        writer.add_album([album, album_performer, year, max_seq, album_performer, root])
+        writer.add_songs(max_seq, song_list)
+        print(f'New album {max_seq} {album} {album_performer} with {len(song_list)} songs: {root}')
+        return max_seq
+    elif seq != old_seq:
+        seq_path = next((path for (path, value) in album_paths.items() if value == seq), None)
+        if seq_path is not None and seq_path != root and os.path.isdir(seq_path):
+            logger.error(
+                f"============== Duplicated album {album} {album_performer} {seq_path} {root}")
+            return max_seq
+        # the album moved to this folder.
+        album_paths.pop(seq_path, None)
+
+    album_paths[root] = seq
+    writer.update_album(seq, [album, album_performer, year, root])
+    writer.sync_songs(seq, song_list)
+    print(f'Updated album {seq} {album} {album_performer} with {len(song_list)} songs: {root}')
+    return max_seq
+
+
+def watch_folders(dirs, sqlitefile, manifest, album_index, max_seq, fast_tags=False,
+                  quiet=2.0, poll_interval=30.0, walk_threads=4):
+    # keeps the DB in sync with the folders under dirs until Ctrl+C.
+    from folder_watcher import open_watcher, Debouncer
+    from folder_walker import list_folder, is_album_candidate
+
+    roots = [os.path.abspath(dir) for dir in dirs]
+    album_paths = load_album_paths(sqlitefile)
+    writer = LibraryWriter(sqlitefile)
+    watcher = open_watcher(roots, poll_interval, walk_threads)
+    debouncer = Debouncer(quiet)
+
+    def forget_folders(paths):
+        for path in paths:
+            del manifest[path]
+            writer.remove_manifest(path)
+            seq = album_paths.pop(path, None)
+            if seq is not None:
+                print(f'Folder of album {seq} is gone, the album stays in the DB: {path}')
+
+    def refresh_folder(root):
+        nonlocal max_seq
+        if not os.path.isdir(root):
+            prefix = os.path.join(root, '')
+            forget_folders([path for path in manifest if path == root or path.startswith(prefix)])
+            return
+        (subdirs, entries) = list_folder(root)
+        if not is_album_candidate(entries):
+            # no music file left in the folder.
+            forget_folders([root] if root in manifest else [])
+            return
+        fingerprint = folder_fingerprint(entries)
+        if manifest.get(root) == fingerprint:
+            return
+        result = read_folder(root, [entry[0] for entry in entries], fast_tags)
+        max_seq = upsert_folder(root, result, album_index, album_paths, max_seq, writer)
+        manifest[root] = fingerprint
+        writer.add_manifest(root, fingerprint, entries)
+
+    print(f'Watching {", ".join(roots)}. Press Ctrl+C to stop.')
+    try:
+        while True:
+            dirty = watcher.read_events(debouncer.timeout(time.monotonic()))
+            debouncer.touch(dirty, time.monotonic())
+            for root in debouncer.ready(time.monotonic()):
+                refresh_folder(root)
+                # one commit per folder, the DB is current as soon as a folder settles.
+                writer.flush()
+    except KeyboardInterrupt:
+        print('Stopped watching.')
+    finally:
+        watcher.close()
+        writer.close()
+
+
+def profile_folders(folders, fast_tags, profile_dir):
+    # read the slowest folders again under cProfile, one .prof file per folder.
+    # Open them with: python -m pstats <file>
+    import cProfile
+    os.makedirs(profile_dir, exist_ok=True)
+    for (rank, (seconds, root, files)) in enumerate(folders):
+        profiler = cProfile.Profile()
+        profiler.runcall(read_folder, root, files, fast_tags)
+        filename = os.path.join(profile_dir, f'slow_folder_{rank + 1:02d}.prof')
+        profiler.dump_stats(filename)
+        print(f'{seconds * 1000:9.1f} ms {root} -> {filename}')
+
+
+def print_report(sqlitefile, first_seq):
+    # optional report of the albums and songs added by this run. Only this path needs pandas.
+    import pandas as pd
+    with sqlite3.connect(sqlitefile) as CONN:
+        new_albums = pd.read_sql_query(
+            "select * from albums where seq > ? order by seq", CONN, params=(first_seq,))
+        new_songs = pd.read_sql_query(
+            "select * from songs where albumid > ? order by albumid", CONN, params=(first_seq,))
+    CONN.close()
+    print(new_albums)
+    print(new_songs)
 
 
 def set_logger(args, logfile):
@@ -498,6 +767,43 @@ if __name__ == "__main__":
                         help="path to sqlite3 db file")
     parser.add_argument("--song", default=False, action='store_true',
                         help="whether to recrawl songs for existing albums")
+    parser.add_argument("--full", default=False, action='store_true',
+                        help="whether to re-read folders that are unchanged since the last scan")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes reading music files. Default to 1 (no worker process).")
+    parser.add_argument("--serial-roots", default=False, action='store_true',
+                        help="whether to scan the folders of --dir one after another instead of at the same time")
+    parser.add_argument("--walk-threads", type=int, default=4,
+                        help="number of threads listing folders ahead of the readers. Default to 4, 1 lists in the main thread.")
+    parser.add_argument("--read-ahead", type=int, default=0,
+                        help="number of folders handed to the worker processes ahead of the DB writes. Default to 4 per job.")
+    parser.add_argument("--write-queue", type=int, default=2,
+                        help="number of batches waiting for the DB writer thread before the scan blocks. "
+                             "Default to 2, 0 writes in the main thread.")
+    parser.add_argument("--fast-tags", default=False, action='store_true',
+                        help="whether to read FLAC, MP3, DSF and MP4 tags with the header-only readers in fast_tags.py")
+    parser.add_argument("--report", default=False, action='store_true',
+                        help="whether to print the albums and songs added by this run. Needs pandas.")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="number of rows written to the DB per commit. Default to 1000.")
+    parser.add_argument("--hash", default=False, action='store_true',
+                        help="after the scan, hash the audio of new and changed music files into audio_hashes, see audio_hash.py")
+    parser.add_argument("--watch", default=False, action='store_true',
+                        help="after the scan, keep watching the folders and update the DB when they change")
+    parser.add_argument("--debounce", type=float, default=2.0,
+                        help="--watch reads a folder once it had no change for this many seconds. Default to 2.")
+    parser.add_argument("--poll-interval", type=float, default=30.0,
+                        help="--watch walks the folders this often where inotify is not available. Default to 30 seconds.")
+    parser.add_argument("--progress", default=False, action='store_true',
+                        help="whether to show a progress line with folders per second and ETA on stderr")
+    parser.add_argument("--stats", default=False, action='store_true',
+                        help="whether to print counters and latency per stage and format at the end")
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="JSON file for the counters and latency per stage and format")
+    parser.add_argument("--profile-slowest", type=int, default=0,
+                        help="read the N slowest folders again under cProfile at the end. Default to 0.")
+    parser.add_argument("--profile-dir", type=str, default='.',
+                        help="folder for the .prof files of --profile-slowest. Default to current folder.")
     parser.add_argument("--debug", default=False, action='store_true',
                         help="whether to enable debug")
     parser.add_argument("--info", default=False, action='store_true',
@@ -512,35 +818,60 @@ if __name__ == "__main__":
     else:
         set_logger(args, None)
 
-    albums = load_albums_to_dataframe(args.sqlite)
-    # get the max value of seq in albums
-    max_seq = albums['seq'].max()
-    # set max_seq to 0 if it is nan
-    if pd.isna(max_seq):
-        max_seq = 0
+    # creates the tables on first run.
+    writer = LibraryWriter(args.sqlite, args.batch_size, queue_size=args.write_queue)
+
+    album_index, max_seq = load_album_index(args.sqlite)
+    first_seq = max_seq
     print(f'max seq: {max_seq}')
 
-    dirs = args.dir.split(';')
-    new_album_count = 0
-    new_song_count = 0
-    for dir in dirs:
-        if dir == '':
-            continue
-        albums, new_songs, max_seq = get_albums(
-            dir, max_seq, albums, args.song)
-        # write albums dataframe and new_songs dataframe back to sqlite3 database
-        print(albums)
-        albums.to_sql('albums', sqlite3.connect(
-            args.sqlite), if_exists='append', index=False)
-        new_songs.to_sql('songs', sqlite3.connect(
-            args.sqlite), if_exists='append', index=False)
-
-        new_album_count += len(albums)
-        new_song_count += len(new_songs)
+    manifest = load_manifest(args.sqlite)
+    print(f'{len(manifest)} folders in manifest.')
+    move_index = None if args.full else load_move_index(args.sqlite)
+
+    # the folder count of the last scan is the ETA estimate.
+    metrics = ScanMetrics(expected_folders=len(manifest), progress=args.progress,
+                          slowest=max(args.profile_slowest, 10))
+    writer.metrics = metrics
+
+    executor = None
+    if args.jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker,
+                                       initargs=(logging.getLogger().level,))
+
+    dirs = [dir for dir in args.dir.split(';') if dir != '']
+    # each root is walked and read in its own thread, sharing the worker processes;
+    # seq numbers are handed out round-robin over the roots, the same on every run.
+    new_album_count, new_song_count, max_seq = scan_roots(
+        dirs, max_seq, album_index, args.song, manifest, writer, args.full, executor, args.fast_tags, metrics,
+        args.walk_threads, args.read_ahead or args.jobs * 4, move_index, not args.serial_roots)
+
+    metrics.end_progress()
+    writer.close()
+    if args.hash:
+        from audio_hash import hash_library
+        hash_library(dirs, args.sqlite, executor, args.jobs,
+                     walk_threads=args.walk_threads)
+    if executor is not None:
+        executor.shutdown()
+
+    if args.stats:
+        metrics.print_summary()
+    if args.metrics is not None:
+        metrics.write_summary(args.metrics)
+        print(f'Wrote scan metrics to {args.metrics}')
+    if args.profile_slowest > 0:
+        profile_folders(metrics.slowest_folders()[:args.profile_slowest], args.fast_tags, args.profile_dir)
+
+    if args.report:
+        print_report(args.sqlite, first_seq)
 
     print(
         f'Found {new_album_count} albums and {new_song_count} songs.')
 
-    exit(0)
+    if args.watch:
+        watch_folders(dirs, args.sqlite, manifest, album_index, max_seq,
+                      args.fast_tags, args.debounce, args.poll_interval, args.walk_threads)
 
-    write_albums(args.sqlite, albums, args.debug)
+    exit(0)
@@ -0,0 +1,149 @@
+import sys
+import json
+import time
+import heapq
+import threading
+
+'''
+Counters and timers of a music_tag_loader.py scan.
+
+Every measurement is recorded under a stage and a format:
+
+    walk    listing and stat of a folder, per folder
+    cue     parse_cue(), per CUE sheet
+    tag     one music_func_map reader, per music file, format is the file suffix
+    dedupe  album index lookup and row building, per folder
+    db      one LibraryWriter flush, per commit
+
+Tag and CUE timings are taken where the file is read, in the worker process
+when --jobs > 1, and sent back with the folder result. The walk of each root
+and the DB writer record from their own threads, hence the lock.
+'''
+
+STAGES = ['walk', 'cue', 'tag', 'dedupe', 'db']
+
+
+def percentile(ordered, fraction):
+    if len(ordered) == 0:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class StageStats:
+    __slots__ = ('count', 'bytes', 'errors', 'seconds', 'timings')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.timings = []
+
+    def add(self, seconds, size=0, error=False):
+        self.count += 1
+        self.bytes += size
+        self.seconds += seconds
+        self.timings.append(seconds)
+        if error:
+            self.errors += 1
+
+    def summary(self):
+        ordered = sorted(self.timings)
+        return {'count': self.count, 'bytes': self.bytes, 'errors': self.errors,
+                'seconds': self.seconds,
+                'p50_ms': percentile(ordered, 0.5) * 1000,
+                'p95_ms': percentile(ordered, 0.95) * 1000,
+                'max_ms': (ordered[-1] if ordered else 0.0) * 1000}
+
+
+class ScanMetrics:
+    def __init__(self, expected_folders=0, progress=False, slowest=10, stream=sys.stderr):
+        # expected_folders comes from the manifest of the last scan, it is only an ETA hint.
+        self.expected_folders = expected_folders
+        self.progress = progress
+        self.stream = stream
+        self.stats = {}
+        self.folders = 0
+        self.skipped = 0
+        self.songs = 0
+        self.slowest_count = slowest
+        # min heap of (seconds, path, files) of the slowest folders to read
+        self.slowest = []
+        self.started = time.perf_counter()
+        self.last_progress = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, stage, music, seconds, size=0, error=False):
+        key = (stage, music)
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = StageStats()
+            stats.add(seconds, size, error)
+
+    def folder_read(self, root, files, seconds):
+        # seconds is the time spent reading the files of the folder
+        if self.slowest_count <= 0:
+            return
+        item = (seconds, root, list(files))
+        with self.lock:
+            if len(self.slowest) < self.slowest_count:
+                heapq.heappush(self.slowest, item)
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def folder_done(self, songs=0, skipped=False):
+        with self.lock:
+            self.folders += 1
+            self.songs += songs
+            if skipped:
+                self.skipped += 1
+            if self.progress:
+                now = time.perf_counter()
+                if now - self.last_progress >= 0.5:
+                    self.last_progress = now
+                    self.print_progress(now)
+
+    def print_progress(self, now):
+        elapsed = now - self.started
+        rate = self.folders / elapsed if elapsed > 0 else 0
+        if self.expected_folders > self.folders and rate > 0:
+            remaining = (self.expected_folders - self.folders) / rate
+            eta = f'ETA {int(remaining // 60)}m{int(remaining % 60):02d}s'
+        else:
+            eta = 'ETA ?'
+        self.stream.write(f'\r{self.folders} folders ({self.skipped} unchanged), {self.songs} songs, '
+                          f'{rate:.1f} folders/s, {eta}   ')
+        self.stream.flush()
+
+    def end_progress(self):
+        if self.progress:
+            self.print_progress(time.perf_counter())
+            self.stream.write('\n')
+            self.stream.flush()
+
+    def slowest_folders(self):
+        return sorted(self.slowest, reverse=True)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        stages = {}
+        for ((stage, music), stats) in sorted(self.stats.items(), key=lambda item: (STAGES.index(item[0][0]), item[0][1])):
+            stages.setdefault(stage, {})[music] = stats.summary()
+        return {'seconds': elapsed, 'folders': self.folders, 'skipped': self.skipped, 'songs': self.songs,
+                'folders_per_second': self.folders / elapsed if elapsed > 0 else 0,
+                'stages': stages,
+                'slowest_folders': [{'path': root, 'seconds': seconds, 'files': len(files)}
+                                    for (seconds, root, files) in self.slowest_folders()]}
+
+    def print_summary(self):
+        print(f"{'stage':<7} {'format':<7} {'count':>8} {'MB':>9} {'errors':>6} {'total s':>9} "
+              f"{'p50 ms':>8} {'p95 ms':>8} {'max ms':>9}")
+        for (stage, formats) in self.summary()['stages'].items():
+            for (music, stats) in formats.items():
+                print(f"{stage:<7} {music:<7} {stats['count']:>8} {stats['bytes'] / 1e6:>9.1f} {stats['errors']:>6} "
+                      f"{stats['seconds']:>9.3f} {stats['p50_ms']:>8.3f} {stats['p95_ms']:>8.3f} {stats['max_ms']:>9.3f}")
+
+    def write_summary(self, filename):
+        with open(filename, 'w', encoding='utf8') as OUT:
+            json.dump(self.summary(), OUT, ensure_ascii=False, indent=1)
@@ -1,7 +1,6 @@
 import sqlite3
 import argparse
 import os
-import re
 import logging
 
 from mutagen.flac import FLAC
@@ -14,50 +13,106 @@ from mutagen.mp4 import MP4, MP4Tags
 from mutagen.id3 import ID3, TIT2, TALB, TRCK, TPE1, TDRC, TPE2
 from mutagen.easyid3 import EasyID3
 
+from cue_sheet import load_cue_sheet
+
 
 # import mutagen
 
 logger = logging.getLogger('tag_loader')
 
 
-def set_wav_meta(filename, album, year, total, band, title_info, track_num):
+def set_wav_meta(filename, album, year, total, band, title_info, track_num, dry_run=False):
     audio = WAVE(filename)
-    audio.pprint()
     logger.debug(audio.tags)
-    set_mp3_metadata(audio, album, year, total, band, title_info, track_num)
+    return set_mp3_metadata(audio, album, year, total, band, title_info, track_num, dry_run)
 
 
-def set_flac_meta(filename, album, year, total, band, title_info, track_num):
+def set_flac_meta(filename, album, year, total, band, title_info, track_num, dry_run=False):
     audio = FLAC(filename)
     logger.debug(audio.tags)
-    set_metadata(audio, album, year, total, band, title_info, track_num)
+    if audio.tags is None:
+        audio.add_tags()
+    return set_metadata(audio, album, year, total, band, title_info, track_num, dry_run)
 
 
-def set_mp3_meta(filename, album, year, total, band, title_info):
+def set_mp3_meta(filename, album, year, total, band, title_info, track_num, dry_run=False):
     audio = MP3(filename)
     logger.debug(audio.tags)
-    set_mp3_metadata(audio, album, year, total, band, title_info)
+    return set_mp3_metadata(audio, album, year, total, band, title_info, track_num, dry_run)
 
 
-def set_mp4_meta(filename, album, year, total, band, title_info):
+def set_mp4_meta(filename, album, year, total, band, title_info, track_num, dry_run=False):
     audio = MP4(filename)
     logger.debug(audio.tags)
-    set_mp4_metadata(audio, album, year, total, band, title_info)
+    return set_mp4_metadata(audio, album, year, total, band, title_info, track_num, dry_run)
 
 
-def set_dff_meta(filename, album, year, total, band, title_info, track_num):
+def set_dff_meta(filename, album, year, total, band, title_info, track_num, dry_run=False):
     audio = DSDIFF(filename)
     logger.debug(audio.tags)
-    set_mp3_metadata(audio, album, year, total, band, title_info, track_num)
+    return set_mp3_metadata(audio, album, year, total, band, title_info, track_num, dry_run)
 
 
-def set_dsf_meta(filename, album, year, total, band, title_info, track_num):
+def set_dsf_meta(filename, album, year, total, band, title_info, track_num, dry_run=False):
     audio = DSF(filename)
     logger.debug(audio.tags)
-    set_mp3_metadata(audio, album, year, total, band, title_info, track_num)
+    return set_mp3_metadata(audio, album, year, total, band, title_info, track_num, dry_run)
+
+
+# padding reserved when a tag outgrows its space, see PaddingPolicy. --padding sets it.
+padding_reserve = 64 * 1024
 
 
-def set_mp3_metadata(audio, album, year, total, band, title_info, track_num):
+class PaddingPolicy:
+    '''
+    Padding callback for mutagen's save(). A tag that still fits keeps all of
+    its padding, so it is patched in place; mutagen's default would trim
+    large padding and move the audio data. A tag that does not fit gets
+    reserve bytes of padding, so the next edits fit again.
+    resized tells whether the save had to move the data behind the tag, moved how much.
+    For ID3 tags mutagen counts the old tag in info.size, tag_size takes it out:
+    a DSF tag, or a WAV id3 chunk, at the end of the file moves no audio.
+    '''
+
+    def __init__(self, reserve, tag_size=0):
+        self.reserve = reserve
+        self.tag_size = tag_size
+        self.resized = False
+        self.moved = 0
+
+    def __call__(self, info):
+        if info.padding >= 0:
+            return info.padding
+        self.resized = True
+        self.moved += max(info.size - self.tag_size, 0)
+        return self.reserve
+
+
+def save_changes(audio, changes, dry_run):
+    # changes are [(field, old value, new value)]. Nothing is written when the tags
+    # already hold the requested values, which spares rewriting big DSF/WAV files.
+    # Returns (changes, bytes moved by a resize or None when written in place or not at all).
+    if len(changes) == 0 or dry_run:
+        return (changes, None)
+    if isinstance(audio, APEv2File):
+        # APEv2 sits at the end of the file and has no padding.
+        audio.save()
+        return (changes, None)
+    policy = PaddingPolicy(padding_reserve, audio.tags.size if isinstance(audio.tags, ID3) else 0)
+    audio.save(padding=policy)
+    return (changes, policy.moved if policy.resized and policy.moved > 0 else None)
+
+
+id3_frame_map = {'TIT2': TIT2,
+                 'TPE1': TPE1,
+                 'TPE2': TPE2,
+                 'TRCK': TRCK,
+                 'TALB': TALB,
+                 'TDRC': TDRC,
+                 }
+
+
+def set_mp3_metadata(audio, album, year, total, band, title_info, track_num, dry_run=False):
     '''
     {'TIT2': TIT2(encoding=<Encoding.UTF16: 1>, text=['2']),  # track title
     'TALB': TALB(encoding=<Encoding.UTF16: 1>, text=['3']),     # album title
@@ -66,17 +121,27 @@ def set_mp3_metadata(audio, album, year, total, band, title_info, track_num):
     'TPE2': TPE2(encoding)   #band name
     Please see "ID3 v2_4 Tags" section in https://www.exiftool.org/TagNames/ID3.html
     '''
-    audio['TIT2'] = TIT2(encoding=3, text=[title_info[0]])
-    audio['TPE1'] = TPE1(encoding=3, text=[title_info[1]])
-    audio['TPE2'] = TPE2(encoding=3, text=[band])
-    audio['TRCK'] = TRCK(encoding=3, text=[f'{track_num}/{total}'])
-    audio['TALB'] = TALB(encoding=3, text=[album])
-    audio['TDRC'] = TDRC(encoding=3, text=[year])
-
-    audio.save()
-
-
-def set_mp4_metadata(audio, album, year, total, band, title_info, track_num):
+    if audio.tags is None:
+        audio.add_tags()
+    wanted = {'TIT2': title_info[0],
+              'TPE1': title_info[1],
+              'TPE2': band,
+              'TRCK': f'{track_num}/{total}',
+              'TALB': album,
+              'TDRC': year,
+              }
+    changes = []
+    for (key, value) in wanted.items():
+        frame = audio.tags.get(key)
+        old = [str(text) for text in frame.text] if frame is not None else None
+        if old != [value]:
+            changes.append((key, old, [value]))
+            audio[key] = id3_frame_map[key](encoding=3, text=[value])
+
+    return save_changes(audio, changes, dry_run)
+
+
+def set_mp4_metadata(audio, album, year, total, band, title_info, track_num, dry_run=False):
     # audio should be a MP4 file object
     '''
         album = audio["\xa9alb"][0]
@@ -87,85 +152,66 @@ def set_mp4_metadata(audio, album, year, total, band, title_info, track_num):
         album_performer = audio['aART'][0]
         year = str(audio["\xa9day"][0])
     '''
-    audio["\xa9nam"] = [title_info[0]]      # track title
-    audio['\xa9ART'] = [title_info[1]]  # artist
-    audio['aART'] = [band]   # band
-    audio['trkn'] = [f'({track_num}, {total})']  # track number
-    audio['\xa9alb'] = [album]   # album title
-    audio['\xa9day'] = [year]    # date
-
-    audio.save()
-
-
-def set_ape_meta(filename, title_info):
+    if audio.tags is None:
+        audio.add_tags()
+    wanted = {"\xa9nam": [title_info[0]],      # track title
+              '\xa9ART': [title_info[1]],  # artist
+              'aART': [band],   # band
+              'trkn': [(int(track_num), int(total))],  # track number
+              '\xa9alb': [album],   # album title
+              '\xa9day': [year],    # date
+              }
+    changes = []
+    for (key, value) in wanted.items():
+        old = audio.tags.get(key)
+        if old != value:
+            changes.append((key, old, value))
+            audio[key] = value
+
+    return save_changes(audio, changes, dry_run)
+
+
+def set_ape_meta(filename, album, year, total, band, title_info, track_num, dry_run=False):
     audio = APEv2File(filename)
     logger.debug(audio.tags)
-    set_metadata(audio, title_info)
-
-
-def set_metadata(audio, album, year, total, band, title_info, track_num):
-    audio["ALBUM"] = [album]
-    audio['ALBUMARTIST'] = [band]
-    audio['ARTIST'] = [title_info[1]]
-    # performer = audio['ALBUM ARTIST'][0]
-
-    audio["DATE"] = [year]
-    audio["TITLE"] = [title_info[0]]
-    audio["TRACKNUMBER"] = [str(track_num)]
-    audio["TRACKTOTAL"] = [str(total)]
-
-    audio.save()
+    if audio.tags is None:
+        audio.add_tags()
+    return set_metadata(audio, album, year, total, band, title_info, track_num, dry_run)
+
+
+def set_metadata(audio, album, year, total, band, title_info, track_num, dry_run=False):
+    wanted = {"ALBUM": album,
+              'ALBUMARTIST': band,
+              'ARTIST': title_info[1],
+              # performer = audio['ALBUM ARTIST'][0]
+              "DATE": year,
+              "TITLE": title_info[0],
+              "TRACKNUMBER": str(track_num),
+              "TRACKTOTAL": str(total),
+              }
+    changes = []
+    for (key, value) in wanted.items():
+        old = audio.tags.get(key)
+        if old is not None:
+            # a list for Vorbis comments, an APETextValue for APE tags
+            old = [str(text) for text in old]
+        if old != [value]:
+            changes.append((key, old, [value]))
+            audio[key] = [value]
+
+    return save_changes(audio, changes, dry_run)
 
 
 def parse_cue(filename):
-    album = ""
-    performer = ""
-    year = ""
-    encodings = ['utf8', 'gbk', 'big5']
-    err_str_list = []
-    for encoding in encodings:
-        with open(filename, 'r', encoding=encoding) as IN:
-            try:
-                for line in IN.readlines():
-                    match = re.match("^REM DATE\s+(.*)", line,
-                                     flags=re.IGNORECASE)
-                    if match:
-                        year = match.group(1)
-                        continue
-
-                    match = re.match("^PERFORMER\s+(.*)",
-                                     line, flags=re.IGNORECASE)
-                    if match:
-                        performer = match.group(1).replace("\"", "")
-                        continue
-
-                    match = re.match("^TITLE\s+\"(.*)\"",
-                                     line, flags=re.IGNORECASE)
-                    if match:
-                        album = match.group(1)
-
-                # all lines parsed. break out of loop
-                break
-
-            except UnicodeDecodeError as e:
-                # need change to GBK encoding.
-                # fallback to second encoding value.
-                logger.debug(e)
-                err_str_list.append(str(e))
-
-    if len(album) == 0:
-        logger.error(os.path.join(os.getcwd(), filename))
-        logger.error((album, performer, year))
-        logger.error("\n".join(err_str_list))
-        exit(1)
-
-    return (album, performer, year)
+    sheet = load_cue_sheet(filename)
+    return (sheet.title, sheet.performer, sheet.date)
 
 
 music_func_map = {"flac": set_flac_meta,
                   'ape': set_ape_meta,
                   'mp3': set_mp3_meta,
                   'mp4': set_mp4_meta,
+                  'm4a': set_mp4_meta,
                   'wav': set_wav_meta,
                   'dff': set_dff_meta,
                   'dsf': set_dsf_meta,
@@ -173,35 +219,114 @@ music_func_map = {"flac": set_flac_meta,
                   }
 
 
-def handle_music_file(filename, album, year, total, band, title_info, track_num):
-    print(filename)
+def handle_music_file(filename, album, year, total, band, title_info, track_num, dry_run=False):
+    # returns ([(field, old value, new value)] that were (or with dry_run would be) written,
+    #          bytes moved when the tag had to grow or None)
     surfix = filename.split('.')[-1].lower()
-    (music_func_map[surfix])(filename, album,
-                             year, total, band, title_info, track_num)
+    return (music_func_map[surfix])(filename, album,
+                                    year, total, band, title_info, track_num, dry_run)
+
+
+def tag_file_task(task):
+    # runs in the writer pool. Returns (changes, moved, error), a failed file does not stop the others.
+    (filename, album, year, total, band, title_info, track_num, dry_run) = task
+    try:
+        (changes, moved) = handle_music_file(filename, album, year, total, band, title_info, track_num, dry_run)
+        return (changes, moved, None)
+    except Exception as e:
+        logger.error(f'{filename}: {e!r}')
+        return (None, None, repr(e))
 
 
 def is_music_file(filename):
     norm_filename = filename.lower()
     return norm_filename.endswith('flac') or norm_filename.endswith('ape') or norm_filename.endswith('mp3') or \
         norm_filename.endswith('wav') or norm_filename.endswith(
-            'dff') or norm_filename.endswith('dsf') or norm_filename.endswith('mp4')
+            'dff') or norm_filename.endswith('dsf') or norm_filename.endswith('mp4') or norm_filename.endswith('m4a')
 
 
-def set_tags(baseroot, album, year, total, band, song_title_list):
-    print(baseroot)
+def list_music_files(baseroot):
+    return sorted(file for file in os.listdir(baseroot) if is_music_file(file))
 
-    oldpath = os.getcwd()
-    os.chdir(baseroot)
 
-    music_file_list = [file for file in os.listdir(".") if is_music_file(file)]
-    sorted_music_file_list = sorted(music_file_list)
+def check_album(baseroot, total, song_title_list):
+    # returns the problems that keep the album from being tagged, checked before any file is written.
+    if not os.path.isdir(baseroot):
+        return [f'{baseroot} is not a folder']
+    problems = []
+    count = len(list_music_files(baseroot))
+    if count == 0:
+        problems.append('no music file in the folder')
+    if str(total).strip() != str(count):
+        problems.append(f'{count} music files but TOTAL is {total}')
+    if len(song_title_list) != count:
+        problems.append(f'{count} music files but {len(song_title_list)} song titles')
+    for title_info in song_title_list:
+        if len(title_info) < 2:
+            problems.append(f'no performer for song {"|".join(title_info)}')
+    return problems
 
-    for idx, filename in enumerate(sorted_music_file_list):
-        handle_music_file(filename, album, year, total, band,
-                          song_title_list[idx], idx+1)
 
-    os.chdir(oldpath)
-    return idx+1
+def set_albums(albums, dry_run=False, jobs=1):
+    '''
+    albums are [(baseroot, album, year, total, band, song_title_list), ...].
+    The files of all albums go to one pool of jobs writers; mutagen spends its
+    time in file I/O, so threads are enough.
+    Returns {baseroot: {'files', 'written', 'skipped', 'skipped_bytes', 'resized', 'failed'}}
+    where resized are the [(filename, bytes moved)] whose tag outgrew its padding.
+    '''
+    tasks = []
+    summaries = {}
+    for (baseroot, album, year, total, band, song_title_list) in albums:
+        summaries[baseroot] = {'files': 0, 'written': 0, 'skipped': 0, 'skipped_bytes': 0,
+                               'resized': [], 'failed': []}
+        for idx, filename in enumerate(list_music_files(baseroot)):
+            tasks.append((baseroot, (os.path.join(baseroot, filename), album, year, total, band,
+                                     song_title_list[idx], idx+1, dry_run)))
+
+    if jobs > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=jobs)
+        results = pool.map(tag_file_task, [task for (baseroot, task) in tasks])
+    else:
+        pool = None
+        results = map(tag_file_task, [task for (baseroot, task) in tasks])
+
+    current = None
+    try:
+        # results come back in file order, so the output reads as in the serial mode.
+        for ((baseroot, task), (changes, moved, error)) in zip(tasks, results):
+            if baseroot != current:
+                print(baseroot)
+                current = baseroot
+            filename = task[0]
+            print(filename)
+            summary = summaries[baseroot]
+            summary['files'] += 1
+            if error is not None:
+                summary['failed'].append((filename, error))
+                continue
+            for (key, old, new) in changes:
+                if dry_run:
+                    print(f'    {key!r}: {old!r} -> {new!r}')
+                else:
+                    logger.info(f'{filename} {key!r}: {old!r} -> {new!r}')
+            if moved is not None:
+                summary['resized'].append((filename, moved))
+            if len(changes) > 0:
+                summary['written'] += 1
+            else:
+                summary['skipped'] += 1
+                summary['skipped_bytes'] += os.path.getsize(filename)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return summaries
+
+
+def set_tags(baseroot, album, year, total, band, song_title_list, dry_run=False, jobs=1):
+    # returns {'files', 'written', 'skipped', 'skipped_bytes', 'resized', 'failed'}
+    return set_albums([(baseroot, album, year, total, band, song_title_list)], dry_run, jobs)[baseroot]
 
 
 def parse_song_file(filename):
@@ -223,13 +348,93 @@ def parse_song_file(filename):
     return (song_title_list[0][1], song_title_list[1][1], song_title_list[2][1], song_title_list[3][1], song_title_list[4:])
 
 
+def parse_manifest(filename):
+    '''
+    One album per line, the folder and its title file separated with |.
+    Relative paths are relative to the manifest file, # starts a comment.
+    D:\\box\\CD01|CD01.txt
+    D:\\box\\CD02|CD02.txt
+    '''
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    pairs = []
+    # folder -> line it was first listed on; the albums are tagged concurrently.
+    folders = {}
+    with open(filename, 'r', encoding="utf8") as IN:
+        for (line_no, line) in enumerate(IN.readlines(), 1):
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            fields = line.split('|')
+            if len(fields) != 2:
+                raise ValueError(f'{filename} line {line_no}: expect folder|title file, got {line}')
+            folder = os.path.normpath(os.path.join(base_dir, fields[0].strip()))
+            key = os.path.normcase(folder)
+            if key in folders:
+                raise ValueError(f'{filename} line {line_no}: {folder} is already listed on line {folders[key]}')
+            folders[key] = line_no
+            pairs.append((folder, os.path.join(base_dir, fields[1].strip())))
+    return pairs
+
+
+def load_albums(pairs):
+    # returns (albums, problems) where problems are [(folder, title file, problem)].
+    albums = []
+    problems = []
+    for (baseroot, title_file) in pairs:
+        try:
+            album, year, total, band, song_title_list = parse_song_file(title_file)
+        except (OSError, IndexError, UnicodeDecodeError) as e:
+            problems.append((baseroot, title_file, f'cannot read title file: {e}'))
+            continue
+        for problem in check_album(baseroot, total, song_title_list):
+            problems.append((baseroot, title_file, problem))
+        albums.append((baseroot, album, year, total, band, song_title_list))
+    return albums, problems
+
+
+def print_report(summaries, dry_run):
+    print(f"{'written':>7} {'skipped':>7} {'failed':>6}  folder")
+    for (baseroot, summary) in summaries.items():
+        print(f"{summary['written']:>7} {summary['skipped']:>7} {len(summary['failed']):>6}  {baseroot}")
+    for summary in summaries.values():
+        for (filename, moved) in summary['resized']:
+            print(f'RESIZED {filename}: tag outgrew its padding, {moved} bytes moved')
+        for (filename, error) in summary['failed']:
+            print(f'FAILED {filename}: {error}')
+
+    files = sum(summary['files'] for summary in summaries.values())
+    written = sum(summary['written'] for summary in summaries.values())
+    skipped = sum(summary['skipped'] for summary in summaries.values())
+    skipped_bytes = sum(summary['skipped_bytes'] for summary in summaries.values())
+    failed = sum(len(summary['failed']) for summary in summaries.values())
+    resized = sum(len(summary['resized']) for summary in summaries.values())
+    moved = sum(moved for summary in summaries.values() for (filename, moved) in summary['resized'])
+    print(f"Processed {files} songs in {len(summaries)} folders.")
+    if dry_run:
+        print(f"Dry run: {written} files would be written, {skipped} already hold these tags, {failed} failed.")
+    else:
+        print(f"Wrote {written} files, skipped {skipped} unchanged files "
+              f"({skipped_bytes / 1e6:.1f} MB not rewritten), {failed} failed.")
+        print(f"{written - resized} files patched in place, {resized} needed more room "
+              f"({moved / 1e6:.1f} MB of audio data moved).")
+    return failed
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-d", "--dir", type=str, default='.',
                         help="folder containing the music files to set tags.")
-    parser.add_argument("-f", "--file", type=str, required=True,
+    parser.add_argument("-f", "--file", type=str, default=None,
                         help="path to title and performer file. The file is CSV file with | as separator.")
+    parser.add_argument("-m", "--manifest", type=str, default=None,
+                        help="file listing many folder|title file pairs, one album per line, instead of -d and -f")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of files written at the same time. Default to 1.")
+    parser.add_argument("--padding", type=int, default=64,
+                        help="KB of padding reserved when a tag outgrows its space. Default to 64.")
+    parser.add_argument("--dry-run", default=False, action='store_true',
+                        help="print the tag changes of every file without writing them")
     parser.add_argument("--debug", default=False, action='store_true',
                         help="whether to enable debug")
     args = parser.parse_args()
@@ -239,9 +444,28 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.ERROR)
 
-    album, year, total, band, song_title_list = parse_song_file(args.file)
-    print(album, year, total, band, song_title_list)
+    padding_reserve = args.padding * 1024
 
-    count = set_tags(args.dir, album, year, total, band, song_title_list)
+    if args.manifest is not None:
+        try:
+            pairs = parse_manifest(args.manifest)
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.file is not None:
+        pairs = [(args.dir, args.file)]
+    else:
+        parser.error('either -f or --manifest is required')
+
+    albums, problems = load_albums(pairs)
+    for (baseroot, album, year, total, band, song_title_list) in albums:
+        print(album, year, total, band, song_title_list)
+    if len(problems) > 0:
+        # nothing is written unless every album checks out.
+        for (baseroot, title_file, problem) in problems:
+            print(f'{baseroot} ({title_file}): {problem}')
+        print(f'{len(problems)} problems found, no file was changed.')
+        exit(1)
 
-    print(f'Processed {count} songs.')
+    summaries = set_albums(albums, args.dry_run, args.jobs)
+    failed = print_report(summaries, args.dry_run)
+    exit(1 if failed > 0 else 0)
@@ -0,0 +1,78 @@
+import unittest
+
+from cue_sheet import parse_cue_text
+
+'''
+Layouts of CUE sheets that parse_cue_text() must read.
+
+    python -m unittest test_cue_sheet
+'''
+
+HEADER_FIRST = '''REM DATE 1987
+PERFORMER "Erich Kunzel, CINCINNATI POPS ORCHESTRA"
+TITLE "Pomp & Pizazz"
+FILE "Erich Kunzel, CINCINNATI POPS ORCHESTRA - Pomp & Pizazz.wav" WAVE
+  TRACK 01 AUDIO
+    TITLE "Olympic Fanfare"
+    PERFORMER "Williams, John"
+    INDEX 01 00:00:00
+  TRACK 02 AUDIO
+    TITLE "Towards a New Life, Op.35c"
+    PERFORMER "Suk, Josef"
+    INDEX 00 04:21:00
+    INDEX 01 04:22:32
+'''
+
+TITLE_BEFORE_TRACK = '''PERFORMER "Band"
+TITLE "Singles"
+FILE "01 - Call My Name.flac" WAVE
+    TITLE "Call My Name"
+    TRACK 01 AUDIO
+    INDEX 01 00:00:00
+FILE "02 - Crazy Chick.flac" WAVE
+    TITLE "Crazy Chick"
+    TRACK 02 AUDIO
+    INDEX 01 00:00:00
+'''
+
+HEADER_AFTER_FILE = '''FILE "album.wav" WAVE
+REM DATE 2001
+PERFORMER "Album Band"
+TITLE "Late Header"
+  TRACK 01 AUDIO
+    TITLE "First"
+    INDEX 01 00:00:00
+  TRACK 02 AUDIO
+    TITLE "Second"
+    PERFORMER "Guest"
+    INDEX 01 03:00:00
+'''
+
+
+class CueSheetTest(unittest.TestCase):
+    def test_header_first(self):
+        sheet = parse_cue_text(HEADER_FIRST)
+        self.assertEqual((sheet.title, sheet.performer, sheet.date),
+                         ('Pomp & Pizazz', 'Erich Kunzel, CINCINNATI POPS ORCHESTRA', '1987'))
+        self.assertEqual(sheet.songs(), [('Olympic Fanfare', 'Williams, John', 1),
+                                         ('Towards a New Life, Op.35c', 'Suk, Josef', 2)])
+        self.assertEqual(sheet.tracks[1].indexes, {0: '04:21:00', 1: '04:22:32'})
+
+    def test_title_before_track(self):
+        sheet = parse_cue_text(TITLE_BEFORE_TRACK)
+        self.assertEqual((sheet.title, sheet.performer), ('Singles', 'Band'))
+        self.assertEqual(sheet.songs(), [('Call My Name', 'Band', 1), ('Crazy Chick', 'Band', 2)])
+        self.assertEqual([track.file for track in sheet.tracks], ['01 - Call My Name.flac', '02 - Crazy Chick.flac'])
+
+    def test_header_after_file(self):
+        sheet = parse_cue_text(HEADER_AFTER_FILE)
+        self.assertEqual((sheet.title, sheet.performer, sheet.date), ('Late Header', 'Album Band', '2001'))
+        self.assertEqual(sheet.songs(), [('First', 'Album Band', 1), ('Second', 'Guest', 2)])
+
+    def test_missing_title(self):
+        sheet = parse_cue_text(HEADER_AFTER_FILE.replace('TITLE "Late Header"\n', ''))
+        self.assertEqual(sheet.title, '')
+
+
+if __name__ == "__main__":
+    unittest.main()
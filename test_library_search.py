@@ -0,0 +1,46 @@
+import sqlite3
+import unittest
+
+from library_db import ensure_schema, ALBUM_INSERT, SONG_INSERT
+from library_search import index_albums, rebuild_index, search
+
+'''
+songs_fts hits must lead back to the one song they index.
+
+    python -m unittest test_library_search
+'''
+
+
+class LibrarySearchTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        if not ensure_schema(self.conn):
+            self.skipTest('SQLite without FTS5')
+        # a box set whose track numbers restart on the second disc.
+        self.conn.execute(ALBUM_INSERT, ('Box Set', 'Band', '2000', 1, 'Band', '/music/box'))
+        self.conn.executemany(SONG_INSERT, [('Alpha', 'Band', '1', 1), ('Beta', 'Band', '2', 1),
+                                            ('Gamma', 'Band', '1', 1), ('Delta', 'Band', '2', 1)])
+        index_albums(self.conn, [1])
+
+    def titles(self, query):
+        (albums, songs) = search(self.conn, query)
+        return [song[0] for song in songs]
+
+    def test_repeated_track_numbers(self):
+        self.assertEqual(self.titles('Gamma'), ['Gamma'])
+        self.assertEqual(self.titles('Delta'), ['Delta'])
+        self.assertEqual(sorted(self.titles('Band')), ['Alpha', 'Beta', 'Delta', 'Gamma'])
+
+    def test_reindex_after_delete(self):
+        self.conn.execute("DELETE FROM songs WHERE title='Beta'")
+        index_albums(self.conn, [1])
+        self.assertEqual(self.titles('Delta'), ['Delta'])
+        self.assertEqual(self.titles('Beta'), [])
+
+    def test_rebuild(self):
+        rebuild_index(self.conn)
+        self.assertEqual(self.titles('Gamma'), ['Gamma'])
+
+
+if __name__ == "__main__":
+    unittest.main()